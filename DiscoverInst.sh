@@ -17,6 +17,13 @@ rm result.*
 rm svmfmap.txt
 rm cluster.*out*
 
+# This analyzes one process; the ranks of a parallel job are in rank-<rank>
+# directories, which aggregateranks.py reads all together
+if ls -d rank-* > /dev/null 2>&1
+then
+    echo "Samples of several ranks found: use aggregateranks.py for all of them"
+fi
+
 id=$(ls gmon-0.* | cut -d "." -f2 | sort | head -n 1)
 gmon_regexp="gmon-*.$id"
 
@@ -1,6 +1,6 @@
 #!/bin/bash
 #
-# Usage: script <exec-file> <regexp>
+# Usage: script <exec-file> [<regexp>] <elbow|silhouette>
 #
 # this script should not need any setting of a path, it figures
 # it out on its own
@@ -17,7 +17,7 @@ echo "Using IncProf path ${INCPROF_PATH}"
 if [ "$#" -lt 1 ]
 then
     echo "Illegal number of parameters!!!"
-    echo "Usage: DiscoverInst <exec-file> <elbow|silhouette>"
+    echo "Usage: DiscoverInst <exec-file> [<regexp>] <elbow|silhouette>"
     exit
 fi
 # Remove previous generated files
@@ -33,12 +33,13 @@ procid=$(ls gmon-0.* | cut -d "." -f2 | sort | head -n 1)
 # Formulate gmon filename regex 
 gmon_regexp="gmon-*.$procid"
 
-# If the regexp was given by the user, use it
-# JEC: Doesn't work because of hardcoded args on algorithm2.py
-# TODO: Fix the algorithm2 invocation to use other variables names
+# If the regexp was given by the user, use it; the clustering method
+# is the last argument
+method=$2
 if [ "$#" -eq 3 ]
 then
     gmon_regexp=$2
+    method=$3
 fi
 
 # Generate the SVM file which is used as an input for Kmeans clustering
@@ -54,5 +55,5 @@ python ${INCPROF_PATH}/gensvm.py $1 "$gmon_regexp" rank.svm > gmon.svm
 
 # print the best instrumentation points for elbowk
 echo "### find phases and inst points"
-python ${INCPROF_PATH}/algorithm2.py gmon.data svmfmap.txt rank.svm gmon.svm $2 $3 > instPoints.out
+python ${INCPROF_PATH}/algorithm2.py gmon.data svmfmap.txt rank.svm gmon.svm $method > instPoints.out
 
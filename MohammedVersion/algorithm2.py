@@ -4,7 +4,13 @@
 
 #
 # Find the instrumantation points
-# Usage: algorithm2.py <data-file> <svmfmap> <rank-file> <svm-file> <executable> <gmon-regex>
+# Usage: algorithm2.py [--jobs N] [--silhouette METHOD] [--sample-size N] <data-file> <svmfmap> <rank-file> <svm-file> <elbow|silhouette>
+#
+# "--jobs N" runs the k-means K sweep in N worker processes. The
+# silhouette method is "exact" (default), "sampled" (estimated from
+# --sample-size intervals per cluster, default 300) or "simplified"
+# (distances to centroids); adding "+check" (e.g. "sampled+check") also
+# computes the exact scores and prints the error of the approximation
 
 #
 # This script will use the cluster information to produce a list of functions that is 
@@ -33,6 +39,8 @@ from sklearn.preprocessing import scale
 import numpy as np
 from sklearn.metrics import silhouette_score
 import csv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import kmeanssweep
 #import pandas as pd  # not used right now
 #import matplotlib.pyplot as plt
 #import matplotlib.colors as colors
@@ -135,45 +143,35 @@ def runKmeans(X, cluster_range):
    labelss = []
    #
    # Run clustering for K=1 to K=9, save results 
+   # (the K values are clustered concurrently by kmeanssweep.py)
    #
    #k = range(2,9)
-   for i in cluster_range:
-      # kmeans is an object of KMeans class, bellow KMeans is the constructor.
-      kmeans = KMeans(n_clusters=i,n_init=30)
-      #Compute k-means clustering
-
-      kmeans.fit(X)
+   sweep = kmeanssweep.sweepKMeans(X, cluster_range, 30, jobs=sweepJobs,
+                                   silhouette=silhouetteMethod,
+                                   sampleSize=silhouetteSample)
+   for (kmeans, labels, silhouette_avg, silhouette_err) in sweep:
       label = kmeans.labels_
       labelss.append(label)
-      #distortions.append(sum(np.min(cdist(X, kmeans.cluster_centers_,'euclidean'),axis=1)) / X.shape[0]) 
-      
-#      distortions.append(np.average(np.min(cdist(X, kmeans.cluster_centers_, 'euclidean'), axis=1)))
-      pdist = []
       # Transform X to a cluster-distance space.
       alldist = kmeans.transform(X)
       clustdist.append(alldist)
       #Coordinates of cluster centers
       centroid = kmeans.cluster_centers_
       centroids.append(centroid)
-      #Predict the closest cluster each sample in X belongs to.
-      labels = kmeans.predict(X)
-      #label = kmeans.labels_
-      #silhout.append(silhouette_score(X,label,metric='euclidean'))
-     # distortions.append(np.sum(np.min(cdist(X, kmeans.cluster_centers_, 'euclidean'),axis=1)) / X.shape[0])
       # Sum of squared distances of samples to their closest cluster center.
       interia = kmeans.inertia_
-      # The silhouette_score gives the average value for all the samples.
-      # This gives a perspective into the density and separation of the formed
-      # clusters
-
-      # This condition to avoid error when # of clusters is 1
-      # It assumes that the silhouette value when k=1 is 1
-      if i==1:
-          silhouette_avg = 1
-      else:
-          silhouette_avg = silhouette_score(X, labels,metric = 'euclidean')
+      # The silhouette_score gives the average value for all the samples
+      # (taken as 1 when # of clusters is 1); an approximate score comes
+      # with an error bound, and can be checked against the exact one
       silhout.append(silhouette_avg)
-      #cross = pd.crosstab(X,labels)
+      if silhouetteMethod != "exact":
+         print "K={0} {1} silhouette {2:.4f} error bound {3}".format(
+               kmeans.n_clusters, silhouetteMethod, silhouette_avg,
+               "none" if silhouette_err is None else "{0:.4f}".format(silhouette_err))
+      if silhouetteCheck:
+         exact = kmeanssweep.silhouetteScore(X, labels, kmeans, "exact")[0]
+         print "K={0} exact silhouette {1:.4f} error {2:.4f}".format(
+               kmeans.n_clusters, exact, abs(silhouette_avg-exact))
 
       interias.append(interia)
       if basedist == 0:
@@ -418,15 +416,45 @@ def printClusters(functions3,clust,coverage,phaseCov):
 #
 # Main program
 #
-if len(sys.argv) != 6:
-   print "Usage: {0} <svm-file> <svmfmap> <rank-file> <svmfile> <executable> <gmon-regex>".format(sys.argv[0])
+usage = "Usage: {0} [--jobs N] [--silhouette METHOD] [--sample-size N] <data-file> <svmfmap> <rank-file> <svm-file> <elbow|silhouette>".format(sys.argv[0])
+sweepJobs = 1
+silhouetteMethod = "exact"
+silhouetteCheck = False
+silhouetteSample = 300
+args = []
+i = 1
+try:
+   while i < len(sys.argv):
+      if sys.argv[i] == "--jobs":
+         sweepJobs = int(sys.argv[i+1])
+         i += 1
+      elif sys.argv[i] == "--silhouette":
+         silhouetteMethod = sys.argv[i+1]
+         i += 1
+      elif sys.argv[i] == "--sample-size":
+         silhouetteSample = int(sys.argv[i+1])
+         i += 1
+      else:
+         args.append(sys.argv[i])
+      i += 1
+except (IndexError, ValueError):
+   print usage
+   exit(1)
+if len(args) != 5:
+   print usage
+   exit(1)
+if silhouetteMethod.endswith("+check"):
+   silhouetteMethod = silhouetteMethod[:-len("+check")]
+   silhouetteCheck = True
+if silhouetteMethod not in ("exact", "sampled", "simplified"):
+   print "Unknown silhouette method: {0}".format(silhouetteMethod)
    exit(1)
    
-datafile = open(sys.argv[1])
-idmapFilename = sys.argv[2]
-rfile = open(sys.argv[3])
-ssfile = open(sys.argv[4])
-method = sys.argv[5]
+datafile = open(args[0])
+idmapFilename = args[1]
+rfile = open(args[2])
+ssfile = open(args[3])
+method = args[4]
 idmap = None
 if idmapFilename != "":
    idmap = loadIdMap(idmapFilename,True)
@@ -505,7 +533,7 @@ pathToOptK.append(optK)
    optcentroids = centroid[optK-1]
    optlabel = labels[optK-1]
    clust = kmeanrun[0][optK-1]
-   datafile = open(sys.argv[1])
+   datafile = open(args[0])
    UnsClusters = findIntervals(datafile,rank,distances,clust)
    P1 = findInstPoint(UnsClusters,clust)
    Phases = P1[0]
@@ -39,6 +39,9 @@ import sys;
 import os;
 import glob;
 import subprocess;
+# the flat profile parser is shared with the scripts one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import flatprofile;
 recordDiff = True
 progFile = "none"
 lastData = {}
@@ -99,38 +102,16 @@ def gensvm(filename, fileNum):
          inTable = False
          #print "Out of flat profile table"
       if inTable == True:
-         # change function match from \w to non-newline because 
-         # of C++ class/template names (:,<>,spaces,...)
-         v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-         #print "line = ", line
-         #print "v = ", v
-         # short is 1 if the line have missing last 3 values
-         short = 0
-         if v == None:
-            v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-            short = 1
-
+         # function names run to the end of the line because of C++
+         # class/template names (:,<>,spaces,...); a short line (missing
+         # the last 3 values) has 0 calls and 0 self ms/call
+         v = flatprofile.parseFlatLine(line)
          if v != None:
-            fpct = float(v.group(1))
-            fttime = float(v.group(2))
-            fstime = float(v.group(3))
-            if short == 0:
-               sms_call = float(v.group(5)) # self ms/call, added to skip functions with 0 value
-               fcalls = int(v.group(4))
-               # 5 and 6 are self ms/call and tot ms/call
-               if not (v.group(7) in funcIDMap):
-                  funcIDMap[v.group(7)] = nextFunctionID
-                  #print "hi", v.group(5), v.group(6), funcIDMap[v.group(7)], v.group(7)
-                  nextFunctionID += 1
-               fid = funcIDMap[v.group(7)]
-            else:
-               # to skip functions with blank # of calls, make fcalls = -1
-               fcalls = 0
-               sms_call = 0  # if it's blank, make it 0
-               if not (v.group(4) in funcIDMap):
-                  funcIDMap[v.group(4)] = nextFunctionID
-                  nextFunctionID += 1
-               fid = funcIDMap[v.group(4)]
+            (fname, fpct, fttime, fstime, fcalls, sms_call) = v[:6]
+            if not (fname in funcIDMap):
+               funcIDMap[fname] = nextFunctionID
+               nextFunctionID += 1
+            fid = funcIDMap[fname]
 
             while len(fdata) <= fid:
                fdata.append(None)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------
+#
+# Aggregate the samples of all ranks (processes) of a parallel job
+#
+# Usage: aggregateranks.py [--jobs N] [--per-rank DIR] [--npz FILE] [--times] <executable> <data-directory> > <svm-format-filename>
+
+#
+# gensvm.py reads the samples of one process; this script reads those
+# of every process of a job (libipr puts each rank's files in its own
+# rank-<rank> subdirectory of the data directory, with an
+# ipr-rank.<pid> file giving its rank, job size and host). Processes
+# without a rank file (all pids directly in the data directory) are
+# numbered after the ranked ones, in pid order.
+#
+# The samples of each process can be gmon files, a delta log or a
+# sample container; they are decoded directly (see gmonread.py), one
+# process per task, by "--jobs N" worker processes. Functions get one
+# ID space across all processes, in the order they are first seen
+# (ranks in order), so the same feature is the same function in every
+# rank. Each line holds what changed in one interval of one process, as
+# gensvm.py computes it, labeled with the interval (sample) number.
+#
+# By default all lines go to stdout as one data file (rank-major), and
+# the interval, rank, host and pid of each line to svmranks.txt, so
+# "cluster.py --ranks svmranks.txt" clusters all ranks together and
+# shows each rank's phases over time. With "--per-rank DIR", each
+# rank's lines go to DIR/rank-<rank>.svm instead. The function names go
+# to svmfmap.txt in either case. With "--npz FILE", the merged data is
+# also written as a binary interval dataset (see intervaldata.py), and
+# with "--times" each process's interval times are normalized with its
+# own ipr-times.<pid> (see gensvm.py --times).
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import re
+import os
+import sys
+import glob
+import json
+import argparse
+import multiprocessing
+import gmonread
+import intervaldata
+
+# symbol table of the executable, loaded once in each worker
+symbolTable = None
+
+#---------------------------------------------------------------------
+# Find the processes whose samples are in a data directory
+# - returns a list of (rank, host, pid, directory), sorted by rank
+#---------------------------------------------------------------------
+def findProcesses(dataDir):
+   procs = []
+   ranked = set()
+   rankFiles = glob.glob(os.path.join(dataDir, "ipr-rank.*")) + \
+               glob.glob(os.path.join(dataDir, "rank-*", "ipr-rank.*"))
+   for fname in rankFiles:
+      for line in open(fname):
+         fields = line.split()
+         if len(fields) < 4 or fields[0].startswith("#"):
+            continue
+         procs.append((int(fields[0]), fields[2], int(fields[3]),
+                       os.path.dirname(fname)))
+         ranked.add((os.path.dirname(fname), int(fields[3])))
+   # processes without a rank file
+   pids = set()
+   for fname in os.listdir(dataDir):
+      v = re.match(r"(gmon-0|ipr-samples|ipr-delta)\.(\d+)$", fname)
+      if v is not None and (dataDir, int(v.group(2))) not in ranked:
+         pids.add(int(v.group(2)))
+   nextRank = max([p[0] for p in procs] + [-1]) + 1
+   for pid in sorted(pids):
+      procs.append((nextRank, "-", pid, dataDir))
+      nextRank += 1
+   procs.sort()
+   return procs
+
+#---------------------------------------------------------------------
+# Cumulative flat profiles of the samples of one process, in sample
+# order, as (sample number, flat profile) pairs
+#---------------------------------------------------------------------
+def processSamples(dirname, pid):
+   fname = os.path.join(dirname, "ipr-samples.{0}".format(pid))
+   if gmonread.isSampleContainer(fname):
+      container = gmonread.SampleContainer(fname)
+      for i in range(len(container)):
+         gmon = gmonread.decodeGmonData(container.sampleData(i),
+                                        symbolTable, fname)
+         if gmon is not None:
+            yield (container.sampleNumber(i),
+                   gmonread.flatProfile(gmon, symbolTable))
+      container.close()
+      return
+   fname = os.path.join(dirname, "ipr-delta.{0}".format(pid))
+   if gmonread.isDeltaLog(fname):
+      for (sample, gmon) in gmonread.readDeltaLog(fname, symbolTable):
+         yield (sample, gmonread.flatProfile(gmon, symbolTable))
+      return
+   files = []
+   for fname in glob.glob(os.path.join(dirname, "gmon-*.{0}".format(pid))):
+      v = re.match(r"gmon-(\d+)\.", os.path.basename(fname))
+      if v is not None:
+         files.append((int(v.group(1)), fname))
+   for (sample, fname) in sorted(files):
+      gmon = gmonread.readGmonFile(fname, symbolTable)
+      if gmon is not None:
+         yield (sample, gmonread.flatProfile(gmon, symbolTable))
+
+#---------------------------------------------------------------------
+# Set up a worker process: load the symbol table
+#---------------------------------------------------------------------
+def initWorker(progFile):
+   global symbolTable
+   symbolTable = gmonread.SymbolTable(progFile)
+
+#---------------------------------------------------------------------
+# Read the samples of one process (a task of the worker pool)
+# - task is (rank, host, pid, directory, normalize)
+# - returns the task and a list of (sample number, changes) per
+#   interval, the changes a list of (function name, time, calls) of
+#   the functions whose time changed by more than 0.001 seconds; times
+#   are scaled to the mean interval length if normalizing
+#---------------------------------------------------------------------
+def readProcess(task):
+   (rank, host, pid, dirname, normalize) = task
+   scales = {}
+   timesFile = os.path.join(dirname, "ipr-times.{0}".format(pid))
+   if normalize and os.path.isfile(timesFile):
+      scales = gmonread.intervalScales(timesFile)
+   intervals = []
+   prev = {}
+   for (sample, entries) in processSamples(dirname, pid):
+      cur = {}
+      for (name, fpct, fttime, fstime, fcalls) in entries:
+         cur[name] = (fstime, fcalls)
+      changes = []
+      for name in sorted(set(cur) | set(prev)):
+         (t, c) = cur.get(name, (0.0, 0))
+         (pt, pc) = prev.get(name, (0.0, 0))
+         dtime = (t - pt) * scales.get(sample, 1.0)
+         if abs(dtime) > 0.001:
+            changes.append((name, round(dtime, 3), c - pc))
+      intervals.append((sample, changes))
+      prev = cur
+   return (task, intervals)
+
+#
+# Main program
+#
+argParser = argparse.ArgumentParser(description='Aggregate the samples of all ranks of a parallel job')
+argParser.add_argument('progFile', metavar='exec-binary-filename', type=str, help='profiled executable')
+argParser.add_argument('dataDir', metavar='data-directory', type=str, help='libipr data directory (IPR_DATADIR) of the job')
+argParser.add_argument('--jobs', action='store', type=int, default=1, metavar='N', help='read processes with N worker processes (default 1)')
+argParser.add_argument('--per-rank', action='store', metavar='DIR', dest='perRank', help='write one data file per rank to DIR instead of one merged file to stdout')
+argParser.add_argument('--npz', action='store', metavar='FILE', help='also write the merged data as a binary interval dataset (see intervaldata.py)')
+argParser.add_argument('--times', action='store_true', help='normalize interval times with each process\'s ipr-times.<pid> file')
+args = argParser.parse_args()
+
+procs = findProcesses(args.dataDir)
+if len(procs) == 0:
+   sys.stderr.write("aggregateranks: no samples in {0}\n".format(args.dataDir))
+   sys.exit(1)
+tasks = [p + (args.times,) for p in procs]
+if args.jobs > 1 and len(tasks) > 1:
+   pool = multiprocessing.Pool(args.jobs, initWorker, (args.progFile,))
+   results = pool.imap(readProcess, tasks)
+else:
+   pool = None
+   initWorker(args.progFile)
+   results = (readProcess(t) for t in tasks)
+
+if args.perRank is not None and not os.path.isdir(args.perRank):
+   os.makedirs(args.perRank)
+intervalWriter = None
+if args.npz is not None:
+   intervalWriter = intervaldata.IntervalWriter(args.npz)
+rankf = open("svmranks.txt", "w")
+funcIDMap = {}
+# processes are written out as they are read, in rank order, so
+# function IDs are the same whatever the number of workers
+for ((rank, host, pid, dirname, normalize), intervals) in results:
+   if args.perRank is not None:
+      outf = open(os.path.join(args.perRank, "rank-{0}.svm".format(rank)), "w")
+   else:
+      outf = sys.stdout
+   for (sample, changes) in intervals:
+      for (name, dtime, dcalls) in changes:
+         if name not in funcIDMap:
+            funcIDMap[name] = len(funcIDMap) + 1
+      features = sorted((funcIDMap[n]*10+1, t, c) for (n, t, c) in changes)
+      outf.write("{0} {1}\n".format(sample, " ".join(
+                 "{0}:{1}".format(f, t) for (f, t, c) in features)))
+      rankf.write("{0} {1} {2} {3}\n".format(sample, rank, host, pid))
+      if intervalWriter is not None:
+         intervalWriter.add(sample, [f for (f, t, c) in features],
+                            [t for (f, t, c) in features],
+                            [c for (f, t, c) in features])
+   if args.perRank is not None:
+      outf.close()
+rankf.close()
+if pool is not None:
+   pool.close()
+   pool.join()
+outf = open("svmfmap.txt", "w")
+json.dump(funcIDMap, outf, sort_keys=True)
+outf.close()
+if intervalWriter is not None:
+   intervalWriter.close(funcIDMap)
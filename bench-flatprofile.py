@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+#
+# Microbenchmark of flat profile parsing
+# Usage: bench-flatprofile.py [#lines] [#repeats]
+#
+# Builds a large synthetic gprof report (full and short flat profile
+# lines, with C and C++ style names) and times the old two-pattern
+# parsing loop (full line match, then short line match, with the
+# patterns given as strings at each call) against the single-pass
+# parser in flatprofile.py. Both must give the same entries.
+#
+# Works with both Python 2 and Python 3
+#
+
+import re
+import sys
+import time
+import random
+import flatprofile
+
+#
+# Make a synthetic gprof -b report with numLines flat profile lines
+#
+def makeReport(numLines):
+   random.seed(1)
+   names = ["p1g", "main", "frame_dummy", "void miniFE::cg_solve<miniFE::CSRMatrix<double, int, int>, miniFE::Vector<double, int, int>, miniFE::matvec_std<miniFE::CSRMatrix<double, int, int>, miniFE::Vector<double, int, int> > >(miniFE::CSRMatrix<double, int, int>&, miniFE::Vector<double, int, int> const&)", "std::vector<int, std::allocator<int> >::operator[](unsigned long)"]
+   lines = ["Flat profile:\n", "\n",
+            "Each sample counts as 0.01 seconds.\n",
+            "  %   cumulative   self              self     total           \n",
+            " time   seconds   seconds    calls   s/call   s/call  name    \n"]
+   cumulative = 0.0
+   for i in range(numLines):
+      name = "{0}_{1}".format(random.choice(names), i)
+      pct = random.uniform(0, 100)
+      selftime = random.uniform(0, 300)
+      cumulative += selftime
+      if random.random() < 0.7:
+         calls = random.randint(1, 10000000)
+         lines.append("{0:6.2f} {1:10.2f} {2:8.2f} {3:8d} {4:8.2f} {5:8.2f}  {6}\n".format(
+                      pct, cumulative, selftime, calls, selftime/calls,
+                      selftime*2/calls, name))
+      else:
+         lines.append("{0:6.2f} {1:10.2f} {2:8.2f}                             {3}\n".format(
+                      pct, cumulative, selftime, name))
+   lines.append("\n")
+   lines.append("\t\t     Call graph\n")
+   return lines
+
+#
+# The flat profile loop as it was in gensvm.py before flatprofile.py
+#
+def oldReadFlatProfile(inf):
+   entries = []
+   inTable = False
+   for line in inf:
+      if line.find("Flat profile") >= 0:
+         inTable = True
+      if line.find("Call graph") >= 0:
+         inTable = False
+      if inTable == False:
+         continue
+      v = re.match(r"\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
+      if v != None:
+         entries.append((v.group(7), float(v.group(1)), float(v.group(2)),
+                         float(v.group(3)), int(v.group(4))))
+         continue
+      v = re.match(r"\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
+      if v != None:
+         entries.append((v.group(4), float(v.group(1)), float(v.group(2)),
+                         float(v.group(3)), 0))
+   return entries
+
+#
+# Time a parser, returning the best time over the repeats
+#
+def timeParser(parser, report, repeats):
+   best = None
+   for i in range(repeats):
+      start = time.time()
+      entries = parser(report)
+      elapsed = time.time() - start
+      if best is None or elapsed < best:
+         best = elapsed
+   return (best, entries)
+
+#
+# Main program
+#
+numLines = 200000
+repeats = 3
+if len(sys.argv) > 1:
+   numLines = int(sys.argv[1])
+if len(sys.argv) > 2:
+   repeats = int(sys.argv[2])
+report = makeReport(numLines)
+(oldTime, oldEntries) = timeParser(oldReadFlatProfile, report, repeats)
+(newTime, newEntries) = timeParser(flatprofile.readFlatProfile, report, repeats)
+if oldEntries != newEntries:
+   print("ERROR: parsers give different entries")
+   sys.exit(1)
+print("{0} flat profile lines, best of {1}".format(numLines, repeats))
+print("two-pattern loop: {0:10.0f} lines/sec".format(numLines/oldTime))
+print("flatprofile.py:   {0:10.0f} lines/sec".format(numLines/newTime))
+print("speedup:          {0:10.2f}x".format(oldTime/newTime))
@@ -6,6 +6,24 @@
 # - we use this to decide which samples of execution belong to the same phase
 #
 # Usage: program <input-file> [idmap-file] [flip]
+# - with "--alg minibatch" the input file is read and clustered in
+#   chunks, so very long runs need not fit in memory
+# - the input file can also be a binary interval dataset (.npz, see
+#   intervaldata.py); then the idmap file is optional, since the
+#   dataset has the function names
+# - with "--times" and libipr's sample times file (ipr-times.<pid>),
+#   each interval is scaled to the mean interval length before
+#   clustering, for runs whose intervals differ in length (IPR_ADAPTIVE);
+#   interval labels are taken as sample numbers, which is what gensvm.py
+#   gives them when the first sample has data (do not also use
+#   gensvm.py --times, which already normalizes)
+# - with "--threads" and the svmthreads.txt file that gensvm.py writes
+#   for a libipr per-thread sample log, the input lines are per-thread
+#   intervals; the best K clustering is then also shown as a timeline
+#   of each thread's phases, with the intervals in which the threads
+#   are in different phases. "--ranks" does the same for the per-rank
+#   intervals of a parallel job, with the svmranks.txt file that
+#   aggregateranks.py writes
 #--------------------------------------------------------------
 
 #--------------------------------------------------------------
@@ -44,16 +62,31 @@
 import re
 import sys
 import os
+import io
+import random
 import argparse
 import sklearn.datasets
 import sklearn.cluster
+import sklearn.metrics
 import math
 import json
 import numpy as np
+import scipy.sparse
+import intervaldata
+import kmeanssweep
+import gmonread
 
 # set true for lots of debugging out (will interfere with output formats)
 debug = False
 
+# interval length scale factor of each sample, if normalizing (--times)
+intervalScales = None
+
+# (interval, thread or rank) of each input line, for per-thread data
+# (--threads) or per-rank data (--ranks), and which of the two it is
+unitRows = None
+unitKind = "thread"
+
 # Idea for selecting best K: compare to "gold standard" params
 # generated from synthetic data
 #1 [ 1.000, 0.677, 0.462, 0.363, 0.306, 0.253, 0.223, 0.201, ]
@@ -114,11 +147,13 @@ def loadIdMap(filename,flip):
 # of real is lower, it selects too many clusters
 #--------------------------------------------------------------
 def findOptimalK (clParams):
+   # clParams may have fewer than 8 K values (see doMiniBatchClustering)
+   nk = len(clParams)
    dist = []
-   for i in range(0,8):
+   for i in range(0,nk):
       # compute distance between optimal and actual
       d = 0.0
-      for j in range(0,8):
+      for j in range(0,nk):
          d += abs(clParams[j] - optClusterParams[i][j])
       dist.append(d)
    # find min dist and return index+1 of it -- this is optimal K
@@ -126,7 +161,7 @@ def findOptimalK (clParams):
    mink = 0
    amind = 999
    amink = 0
-   for i in range(0,8):
+   for i in range(0,nk):
       if dist[i] < mind*0.95:  # % threshold to decide better
          mind = dist[i]
          mink = i+1
@@ -144,7 +179,7 @@ def findOptKElbow(clParams):
    maxk = 0
    amaxd = 0
    amaxk = 0
-   for i in range(1,7): # need free ends at both ends
+   for i in range(1,len(clParams)-1): # need free ends at both ends
       d1 = abs(clParams[i-1]-clParams[i])
       d2 = abs(clParams[i]-clParams[i+1])
       # ad hoc metric for finding elbow: diff of differences
@@ -164,32 +199,23 @@ def findOptKElbow(clParams):
    return (maxk, round(maxd,3), amaxk, round(amaxd,3))
 
 #--------------------------------------------------------------
-# Find the closest interval data point to a cluster centroid
-# - X is a csr_matrix and so behaves a bit weirdly
+# Find the closest interval data point to each cluster centroid
+# - X is a csr_matrix; distances are manhattan distances, computed
+#   for all data points and all centroids at once on the sparse data
+# - returns the index of the closest data point for each centroid
+#--------------------------------------------------------------
+def findClosestRealDatapoints(X,centroids):
+  dists = sklearn.metrics.pairwise.manhattan_distances(X,np.asarray(centroids))
+  # argmin gives the first closest, as the old per-point loop did
+  return np.argmin(dists,axis=0)
+
+#--------------------------------------------------------------
+# Print the closest interval data point to a cluster centroid
+# - dp is the data point (row of X) and mindp its index
 #--------------------------------------------------------------
-def findClosestRealDatapoint(X,centroid):
+def printClosestRealDatapoint(dp,centroid,mindp):
   print("Find closest real data point------------------------")
-  dim1 = X.shape[0] # num of elements (intervals) in X
-  dim2 = X.shape[1] # num of attributes (functions w/ data)
-  #print("X shape {0}  centroid length {1}".format(X.shape,len(centroid)))
-  mindist = 99999999.0
-  mindp = 0
-  # loop over all datapoints to find closest
-  for n in range(dim1):
-     dp = X[n]
-     dist = 0.0
-     #print(dp)
-     # loop through attributes (dimensions) and compute distance
-     # - this is manhattan distance, I believe
-     for i in range(dim2):
-        delta = dp[(0,i)] - centroid[i]
-        dist += math.sqrt(delta*delta)
-     if dist < mindist:
-        # new closest datapoint, so save info
-        mindist = dist
-        mindp = n
-  #print("X shape {0}  centroid length {1}".format(X.shape,len(centroid)))
-  print("Closest dp: {0} :\n{1}".format(mindp,X[mindp]))
+  print("Closest dp: {0} :\n{1}".format(mindp,dp))
   print("Centroid:\n{0}".format(centroid))
   print("END closest real data point------------------------")
   return True
@@ -211,8 +237,13 @@ def countClusterMagnitude(clusterId, labeledData):
 # - also identifies instrumentation site by finding data
 #   dimension (attribute) that a cluster has significantly but
 #   that is not shared by other clusters
+# - closest is a list of (index, data point) of the closest data
+#   point to each centroid; if None, it is found in X
 #--------------------------------------------------------------
-def printClusterCentroidInfo(centroids,sizes):
+def printClusterCentroidInfo(centroids,sizes,closest=None):
+   # closest data points are found before centroids get normalized below
+   if closest is None:
+      closest = [(d, X[d]) for d in findClosestRealDatapoints(X,centroids)]
    n = 1
    for c in centroids: 
       print("Cluster {0}:".format(n-1))
@@ -221,7 +252,8 @@ def printClusterCentroidInfo(centroids,sizes):
       if sizes[n-1] < 5: # genericise this size threshold
          n += 1
          continue
-      closestReal = findClosestRealDatapoint(X,c)
+      closestReal = printClosestRealDatapoint(closest[n-1][1],c,
+                                              closest[n-1][0])
       normalize(c) # is already???
       # we should do: save up all functions
       # that are not shared with other clusters, then iterate and find
@@ -282,17 +314,19 @@ def doKMeansClustering():
    # Run clustering for K=1 to K=8, save results and print metrics
    #
    print("K  metrics")
+   # K values are clustered together (see kmeanssweep.py), then the
+   # results are reported one K at a time as before
+   sweep = kmeanssweep.sweepKMeans(X, range(1,9), 20, jobs=sweepJobs,
+                                   warmStart=warmStart)
    for i in range(1,9):
       #print("dtype {0}".format(X.dtype))
       #for j in X:
       #   print j.shape,
       #print("")
-      # k_means returns tuple of (?, data-cluster-id-list, total-pt-dist, ?)
-      #if i==3 or i==4:
-      #   c = sklearn.cluster.k_means(X,2,n_init=30)
-      #else:
+      # c is tuple of (centroids, data-cluster-id-list, total-pt-dist)
       print("clustering K={0}".format(i))
-      c = sklearn.cluster.k_means(X,i,n_init=20)
+      kmeans = sweep[i-1][0]
+      c = (kmeans.cluster_centers_, kmeans.labels_, kmeans.inertia_)
       print("  done")
       if basedist == 0:
          basedist = c[2]
@@ -301,7 +335,17 @@ def doKMeansClustering():
       centroids.append(c[0])
       cld.append(c[1])
       clparms.append(c[2]/basedist)
-   #
+   printKMeansResults(centroids,cld,clparms,None)
+
+#--------------------------------------------------------------
+# Select the best K values from the clusterings for K=1 to K=8,
+# write the cluster files, and print results
+# - centroids, cld and clparms hold the centroids, the cluster of each
+#   data point and the relative total point distance, for each K
+# - closest holds, for each K, the closest data point to each centroid
+#   as in printClusterCentroidInfo(), or is None
+#--------------------------------------------------------------
+def printKMeansResults(centroids,cld,clparms,closest):
    # Find "best" K using a couple of different methods, and print them
    bestk = findOptimalK(clparms)
    elbowk = findOptKElbow(clparms)
@@ -314,12 +358,12 @@ def doKMeansClustering():
    #
    #print elbowk[0]
    print("V\K:",end="")
-   for i in range(1,9):
+   for i in range(1,len(cld)+1):
       print("{0} ".format(i), end="")
    print("")
    for j in range(0,len(cld[0])):
       print("{0:3d}:".format(j),end="")
-      for i in range(0,8):
+      for i in range(0,len(cld)):
          print(cld[i][j],end="")
          # print cluster data in a seprate file
          # Print the the elbowk cluster elements vertically
@@ -331,6 +375,8 @@ def doKMeansClustering():
       print
    felbowk.close()
    fbestk.close()
+   if unitRows is not None:
+      printUnitPhases(cld[bestk[0]-1])
    # compute sizes of clustersin best and elbow
    clSizeBest = []
    n = 0
@@ -343,15 +389,205 @@ def doKMeansClustering():
       clSizeElbow.append(countClusterMagnitude(n, cld[elbowk[0]-1]))
       n += 1
    # Print out info based on two ideal clustering counts
+   if closest is None:
+      closest = [None] * len(centroids)
    print("'Optimal' K = {0} Centroids".format(bestk[0]))
-   printClusterCentroidInfo(centroids[bestk[0]-1],clSizeBest)
+   printClusterCentroidInfo(centroids[bestk[0]-1],clSizeBest,
+                            closest[bestk[0]-1])
    if bestk[0] == elbowk[0]:
       exit()
    print("------------------------------------------------------------------")
    print("Elbow K = {0} Centroids".format(elbowk[0]))
-   printClusterCentroidInfo(centroids[elbowk[0]-1],clSizeElbow)
+   printClusterCentroidInfo(centroids[elbowk[0]-1],clSizeElbow,
+                            closest[elbowk[0]-1])
    findSignificantFeatures(centroids[elbowk[0]-1])
 
+#--------------------------------------------------------------
+# Print the phase (cluster) of each thread or rank in each interval,
+# one row per thread or rank, from the cluster of each input line (see
+# --threads and --ranks); "." is an interval with no data for it.
+# Intervals in which the threads (ranks) are in different phases are
+# counted, as a measure of phase imbalance between them
+#--------------------------------------------------------------
+def printUnitPhases(clusters):
+   phases = {}
+   for (row, (interval, unit)) in enumerate(unitRows):
+      if row < len(clusters):
+         phases[(interval, unit)] = clusters[row]
+   intervals = sorted(set(i for (i, u) in phases))
+   units = sorted(set(u for (i, u) in phases))
+   print("{0} phases (one column per interval {1}-{2}):".format(
+         unitKind.capitalize(), intervals[0], intervals[-1]))
+   for u in units:
+      line = "".join(str(phases.get((i, u), ".")) for i in intervals)
+      print("  {0} {1:4d}: {2}".format(unitKind, u, line))
+   mixed = [i for i in intervals
+            if len(set(phases[(i, u)] for u in units if (i, u) in phases)) > 1]
+   print("Intervals with {0}s in different phases: {1} of {2}".format(
+         unitKind, len(mixed), len(intervals)))
+
+#--------------------------------------------------------------
+# Scale the rows of an interval matrix by the length of their
+# intervals (see --times); labels are the rows' interval labels
+#--------------------------------------------------------------
+def scaleIntervals(X,labels):
+   if intervalScales is None:
+      return X
+   scales = np.array([intervalScales.get(int(l), 1.0) for l in labels])
+   return scipy.sparse.diags(scales).dot(X).tocsr()
+
+#--------------------------------------------------------------
+# Scan a data file (libsvm text or .npz dataset) without loading it
+# - returns (#intervals, #features, sample), where sample is a matrix
+#   of up to sampleSize intervals picked at random from the whole file
+#   (None if there are no intervals)
+#--------------------------------------------------------------
+def scanIntervals(filename,sampleSize):
+   if intervaldata.isIntervalFile(filename):
+      data = intervaldata.loadIntervals(filename)
+      count = len(data["labels"])
+      if count == 0:
+         return (0, 0, None)
+      nfeatures = int(data["indices"].max()) if len(data["indices"]) else 0
+      rows = sorted(random.sample(range(count), min(sampleSize,count)))
+      sample = scipy.sparse.vstack([intervalMatrix(data,i,i+1,nfeatures)
+                                    for i in rows], format="csr")
+      return (count, nfeatures, scaleIntervals(sample, data["labels"][rows]))
+   # reservoir sample of the text lines, so memory stays bounded
+   count = 0
+   nfeatures = 0
+   lines = []
+   for line in open(filename, "rb"):
+      fields = line.split(b"#")[0].split()
+      if len(fields) == 0:
+         continue
+      for field in fields[1:]:
+         nfeatures = max(nfeatures, int(field.split(b":")[0]))
+      if count < sampleSize:
+         lines.append(line)
+      else:
+         r = random.randint(0, count)
+         if r < sampleSize:
+            lines[r] = line
+      count += 1
+   if count == 0:
+      return (0, 0, None)
+   return (count, nfeatures, parseIntervalLines(lines,nfeatures))
+
+#--------------------------------------------------------------
+# Make a matrix of intervals first to last-1 of a .npz dataset
+# (memory-mapped columns are only sliced, not read as a whole)
+#--------------------------------------------------------------
+def intervalMatrix(data,first,last,nfeatures):
+   indptr = data["indptr"][first:last+1]
+   start = indptr[0]
+   end = indptr[-1]
+   return scipy.sparse.csr_matrix((data["time"][start:end],
+                                   data["indices"][start:end]-1,
+                                   indptr-start),
+                                  shape=(last-first,nfeatures))
+
+#--------------------------------------------------------------
+# Make a matrix of intervals from libsvm text lines
+# (scaled by interval length, see --times)
+#--------------------------------------------------------------
+def parseIntervalLines(lines,nfeatures):
+   Xc, yc = sklearn.datasets.load_svmlight_file(io.BytesIO(b"".join(lines)),
+                                                n_features=nfeatures,
+                                                zero_based=False)
+   return scaleIntervals(Xc, yc)
+
+#--------------------------------------------------------------
+# Read a data file in chunks of batchSize intervals
+# - yields (index of first interval, matrix of the chunk's intervals)
+#--------------------------------------------------------------
+def readIntervalChunks(filename,batchSize,nfeatures):
+   if intervaldata.isIntervalFile(filename):
+      data = intervaldata.loadIntervals(filename)
+      count = len(data["labels"])
+      for first in range(0, count, batchSize):
+         last = min(first+batchSize, count)
+         yield (first, kmeanssweep.prepareData(
+                scaleIntervals(intervalMatrix(data,first,last,nfeatures),
+                               data["labels"][first:last])))
+      return
+   first = 0
+   lines = []
+   for line in open(filename, "rb"):
+      if len(line.split(b"#")[0].split()) == 0:
+         continue
+      lines.append(line)
+      if len(lines) == batchSize:
+         yield (first, kmeanssweep.prepareData(
+                parseIntervalLines(lines,nfeatures)))
+         first += len(lines)
+         lines = []
+   if len(lines) > 0:
+      yield (first, kmeanssweep.prepareData(
+             parseIntervalLines(lines,nfeatures)))
+
+#--------------------------------------------------------------
+# Do mini-batch KMeans clustering, reading the data file in chunks,
+# and print results as doKMeansClustering() does
+# - the data is never loaded as a whole: one chunk of batchSize
+#   intervals is in memory at a time, plus the cluster of each interval
+# - the models for K=1 to K=8 are trained together from the same
+#   chunks; they start from a random sample of the whole run (chunks
+#   are in time order, so the first chunk may miss later phases),
+#   and then go over the data numPasses times
+# - a final pass assigns intervals to clusters, sums up the total
+#   point distance and finds the closest data point to each centroid
+# - K values larger than the number of intervals are skipped
+#--------------------------------------------------------------
+def doMiniBatchClustering(filename,batchSize,numPasses):
+   (count, nfeatures, sample) = scanIntervals(filename,batchSize)
+   if count == 0:
+      print("No intervals in {0}".format(filename))
+      exit(1)
+   maxK = min(8, count)
+   print("K  metrics")
+   if maxK < 8:
+      print("Only {0} intervals: skipping K={1} to K=8".format(count, maxK+1))
+   models = []
+   for i in range(1,maxK+1):
+      models.append(sklearn.cluster.MiniBatchKMeans(n_clusters=i,
+                                                    batch_size=batchSize,
+                                                    n_init=3))
+      models[i-1].partial_fit(kmeanssweep.prepareData(sample))
+   sample = None
+   for p in range(numPasses):
+      for (first, chunk) in readIntervalChunks(filename,batchSize,nfeatures):
+         for kmeans in models:
+            kmeans.partial_fit(chunk)
+   cld = [np.zeros(count, dtype=np.int8) for kmeans in models]
+   inertias = [0.0] * len(models)
+   closest = [[(0, None, np.inf)] * i for i in range(1,maxK+1)]
+   for (first, chunk) in readIntervalChunks(filename,batchSize,nfeatures):
+      for i in range(len(models)):
+         dists = models[i].transform(chunk)
+         labels = np.argmin(dists, axis=1)
+         cld[i][first:first+chunk.shape[0]] = labels
+         inertias[i] += float(np.sum(dists[np.arange(len(labels)),labels]**2))
+         # manhattan distances, as findClosestRealDatapoints() uses
+         mdists = sklearn.metrics.pairwise.manhattan_distances(chunk,
+                                       models[i].cluster_centers_)
+         mins = np.argmin(mdists, axis=0)
+         for c in range(len(mins)):
+            if mdists[mins[c],c] < closest[i][c][2]:
+               closest[i][c] = (first+mins[c], chunk[mins[c]],
+                                mdists[mins[c],c])
+   centroids = []
+   clparms = []
+   for i in range(1,maxK+1):
+      print("clustering K={0}".format(i))
+      print("  done")
+      print("{0} {1:.4f}, {2:.4f}".format(i,inertias[i-1],
+                                          inertias[i-1]*i*i*i))
+      centroids.append(models[i-1].cluster_centers_)
+      clparms.append(inertias[i-1]/inertias[0] if inertias[0] > 0 else 0.0)
+   closest = [[(d[0], d[1]) for d in cl] for cl in closest]
+   printKMeansResults(centroids,cld,clparms,closest)
+
 #--------------------------------------------------------------
 # Work in Progress: experiment with DBSCAN clustering
 # -- not sure yet how to process the results
@@ -454,11 +690,18 @@ def findSignificantFeatures(clusters):
 flip = False
 argParser = argparse.ArgumentParser(description='Gprof data manipulator')
 argParser.add_argument('svmfile', metavar='SVM-file', type=str, help='name of SVM data file')
-argParser.add_argument('namefile', metavar='name-map-file', type=str, help='name of id->name mapping file')
+argParser.add_argument('namefile', metavar='name-map-file', type=str, nargs='?', default="", help='name of id->name mapping file (optional for a .npz dataset)')
 argParser.add_argument('--debug', action='store_true', help='turn on debugging info (default off)')
 argParser.add_argument('--flip', action='store_true', help='flip name map format (default: off)')
-argParser.add_argument('--alg', action='store', default='kmeans', metavar='<kmeans|dbscan>', help='clustering algorithm (default: kmeans)')
+argParser.add_argument('--alg', action='store', default='kmeans', metavar='<kmeans|minibatch|dbscan>', help='clustering algorithm (default: kmeans)')
 argParser.add_argument('--eps', action='store', type=float, default=0.07, metavar='0.0-3.0', help='DBSCAN epsilon parameter')
+argParser.add_argument('--jobs', action='store', type=int, default=1, metavar='N', help='run k-means for the K values with N worker processes (default 1)')
+argParser.add_argument('--batch', action='store', type=int, default=1024, metavar='N', help='minibatch: intervals read and clustered at a time, at least 8 (default 1024)')
+argParser.add_argument('--passes', action='store', type=int, default=5, metavar='N', help='minibatch: passes over the data (default 5)')
+argParser.add_argument('--warmstart', action='store_true', help='start each K from the centroids of K-1, one k-means run per K (default off)')
+argParser.add_argument('--times', action='store', metavar='FILE', help='scale intervals to the mean interval length, using the libipr times file (ipr-times.<pid>)')
+argParser.add_argument('--threads', action='store', metavar='FILE', help='per-thread input lines, with the interval and thread of each in FILE (svmthreads.txt from gensvm.py)')
+argParser.add_argument('--ranks', action='store', metavar='FILE', help='per-rank input lines, with the interval and rank of each in FILE (svmranks.txt from aggregateranks.py)')
 args = argParser.parse_args()
 debug = args.debug
 algorithm = args.alg
@@ -466,6 +709,24 @@ dataFilename = args.svmfile
 idmapFilename = args.namefile
 flip = args.flip
 dbscanEps = args.eps
+sweepJobs = args.jobs
+warmStart = args.warmstart
+batchSize = args.batch
+if batchSize < 8:
+   # the first mini-batch must have at least as many intervals as
+   # the largest K
+   argParser.error("--batch must be at least 8")
+numPasses = args.passes
+if args.times is not None:
+   intervalScales = gmonread.intervalScales(args.times)
+if args.ranks is not None:
+   args.threads = args.ranks
+   unitKind = "rank"
+if args.threads is not None:
+   unitRows = []
+   for line in open(args.threads):
+      fields = line.split()
+      unitRows.append((int(fields[0]), int(fields[1])))
 
 #
 # Load Id Map if available
@@ -487,7 +748,34 @@ if idmapFilename != "":
 # StandardScaler works but then how to interpret results?
 # - hard to select instrumentation site
 #
-X, y = sklearn.datasets.load_svmlight_file(dataFilename)
+if algorithm == "minibatch":
+   # data is read in chunks while clustering
+   X = None
+   y = None
+   if idMap is None and intervaldata.isIntervalFile(dataFilename):
+      idMap = {}
+      names = intervaldata.functionNames(intervaldata.loadIntervals(dataFilename))
+      for f in names:
+         idMap[str(f*10+1)] = names[f]
+elif intervaldata.isIntervalFile(dataFilename):
+   # binary dataset: build the same matrix load_svmlight_file would
+   # (feature indices start at 1, so column = index-1) straight from
+   # the memory-mapped columns
+   data = intervaldata.loadIntervals(dataFilename)
+   X = scipy.sparse.csr_matrix((data["time"], data["indices"]-1,
+                                data["indptr"]))
+   y = np.asarray(data["labels"], dtype=np.float64)
+   if idMap is None:
+      idMap = {}
+      names = intervaldata.functionNames(data)
+      for f in names:
+         idMap[str(f*10+1)] = names[f]
+else:
+   X, y = sklearn.datasets.load_svmlight_file(dataFilename)
+   # 32-bit indices, as the sklearn distance functions want
+   X = kmeanssweep.prepareData(X)
+if X is not None and intervalScales is not None:
+   X = kmeanssweep.prepareData(scaleIntervals(X, y))
 # normalize columns (features)
 #print("X RAW-------------------------------------------------"
 #print X
@@ -514,6 +802,8 @@ if debug:
 
 if algorithm == "kmeans":
    doKMeansClustering()
+elif algorithm == "minibatch":
+   doMiniBatchClustering(dataFilename,batchSize,numPasses)
 elif algorithm == "dbscan":
    doDbscanClustering(0,dbscanEps)
 
@@ -3,6 +3,7 @@
 #
 # Find the instrumantation points
 # Usage: findinst.py <cluster-file> <svm-file> <svmfmap>
+# (the svm-file can also be a binary interval dataset, see intervaldata.py)
 
 #
 # This script will use the cluster information to prduce a list of function that is 
@@ -18,6 +19,7 @@ import glob;
 import subprocess;
 import math
 import json
+import intervaldata
 
 recordDiff = True
 progFile = "none"
@@ -62,6 +64,46 @@ def loadIdMap(filename,flip):
 
 
 
+#
+# Read the intervals of an SVM file (findmostused.py output) or of a
+# binary interval dataset
+# - returns a list of intervals, each a list of (function ID, value)
+#   pairs, with the value as the text file has it
+#
+def readIntervals(filename):
+   intervals = []
+   if intervaldata.isIntervalFile(filename):
+      data = intervaldata.loadIntervals(filename)
+      for i in range(len(data["labels"])):
+         (indices, time, calls) = intervaldata.intervalEntries(data, i)
+         tmp = []
+         for (index, t, c) in zip(indices.tolist(), time.tolist(), calls.tolist()):
+            # count data (index ID*10+2) is an integer; so are the
+            # whole-number markers findmostused.py puts in time data
+            if index % 10 == 2:
+               value = str(c)
+            elif t == int(t):
+               value = str(int(t))
+            else:
+               value = str(t)
+            tmp.append((int(index/10), value))
+         intervals.append(tmp)
+      return intervals
+   sfile = open(filename)
+   for line in sfile:
+      # split the line to array of function indices
+      strs = line.split(" ")
+      tmp = []
+      # Create list of pairs
+      for s in strs[1:]:
+         if s != "\n":
+            tmp.append((int(int(s.split(":")[0])/10), s.split(":")[1]))
+      intervals.append(tmp)
+   sfile.close()
+   return intervals
+
+
+
 #
 # Main program
 #
@@ -70,7 +112,7 @@ if len(sys.argv) != 4:
    exit(1)
    
 cfile = open(sys.argv[1])
-sfile = open(sys.argv[2])
+intervals = readIntervals(sys.argv[2])
 idmapFilename = sys.argv[3]
 
 clust = []
@@ -96,17 +138,7 @@ for i in range(0,int(max(clust))+1):
 	functions.append([])
 
 m = 0
-for line in sfile:
-
-        # split the line to array of function indices
-        strs = line.split(" ")
-	k = 0
-        tmp = []
-        # Create list of pairs
-        for s in strs:
-                if s != "\n" and k != 0:
-                        tmp.append((int(int(s.split(":")[0])/10), s.split(":")[1]))
-		k += 1
+for tmp in intervals:
 
 	# TODO: Find the function with counts > 0 and add it to a list of list by functionID, then find the function name from the svmfmap
 	# and print the cluster it belong to and if instrument the function body or the loop, (body | loop)
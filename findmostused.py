@@ -2,7 +2,10 @@
 
 #
 # Find the most used functions and create a new svm file according to some percent
-# Usage: findmostused.py <svm-format-filename> <0/1>  > <svm-format-filename>
+# Usage: findmostused.py <svm-format-filename> <0/1> [npz-output-filename] > <svm-format-filename>
+# The input can be a gendata.py text file or binary dataset (.npz, see
+# intervaldata.py); the result is written as text and, if a file name
+# is given, also as a binary dataset
 # 0 time only / 1 both time and count
 
 
@@ -16,6 +19,7 @@ import sys;
 import os;
 import glob;
 import subprocess;
+import intervaldata;
 funcIDCountlist = [0] * 10000
 funcTimelist = [0.0] * 10000
 
@@ -31,31 +35,64 @@ def progress(count, total, status=''):
     sys.stderr.flush()  # As suggested by Rom Ruben (see: http://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console/27871113#comment50529068_27871113)
 
 
+#
+# Read the intervals of a data file, either gendata.py text output
+# (<step> <index>:<time>:<count> ...) or a binary interval dataset
+# - returns a list of intervals, each a list of (index, time, count);
+#   the time is kept as the text of the value (text file) or as a
+#   float (dataset), and is only converted to a string for output
+# - also returns the function name map (name -> ID) if there is one
+#
+def readIntervals(filename):
+   intervals = []
+   if intervaldata.isIntervalFile(filename):
+      data = intervaldata.loadIntervals(filename)
+      indptr = data["indptr"].tolist()
+      indices = data["indices"].tolist()
+      time = data["time"].tolist()
+      calls = data["calls"].tolist()
+      for i in range(len(indptr)-1):
+         intervals.append(list(zip(indices[indptr[i]:indptr[i+1]],
+                                   time[indptr[i]:indptr[i+1]],
+                                   calls[indptr[i]:indptr[i+1]])))
+      names = intervaldata.functionNames(data)
+      return (intervals, dict((names[f], f) for f in names))
+   f = open("{0}".format(filename))
+   for line in f:
+      strs = line.split(" ")
+      entries = []
+      for s in strs[1:]:
+         if s != "\n":
+            v = s.split(":")
+            entries.append((int(v[0]), v[1], int(v[2])))
+      intervals.append(entries)
+   f.close()
+   return (intervals, {})
+
+
 #
 # Main program
 #
-if len(sys.argv) != 3:
-   print "Usage: {0} <svm-format-filename> <0/1/2>".format(sys.argv[0])
+if len(sys.argv) != 3 and len(sys.argv) != 4:
+   print "Usage: {0} <svm-format-filename> <0/1/2> [npz-output-filename]".format(sys.argv[0])
    exit(1)
    
 svmFile = sys.argv[1]
 # with count is 1 and without count is 0
 with_count = int(sys.argv[2])
+# the result can also be written as a binary interval dataset
+npzFile = None
+if len(sys.argv) == 4:
+   npzFile = sys.argv[3]
 
-f = open("{0}".format(svmFile))
+(intervals, funcNames) = readIntervals(svmFile)
 
 nlines = 0
 # read the file and get the functions count
-for line in f:
-	strs = line.split(" ")
-	#print (strs)
-	i = 0
-	for s in strs:
-		if s != "\n" and i != 0:
-			funcID = int(s.split(":")[0])
-			funcIDCountlist[funcID] += 1
-		i += 1
-     	nlines += 1
+for entries in intervals:
+	for (funcID, value, count) in entries:
+		funcIDCountlist[funcID] += 1
+	nlines += 1
 
 # find the percentage for each function
 m = 0
@@ -64,9 +101,6 @@ for fid in funcIDCountlist:
 		funcIDCountlist[m] = float(funcIDCountlist[m]) / nlines * 100
 	m += 1
 
-f.close()
-
-
 # sort the functionIDs by percentage
 B = sorted(funcIDCountlist,key=float,reverse=True)
 sortfuncID = []
@@ -76,9 +110,11 @@ for v in B:
                 funcIDCountlist[funcIDCountlist.index(v)] = 0
 
 	
-f = open("{0}".format(svmFile))
+writer = None
+if npzFile is not None:
+	writer = intervaldata.IntervalWriter(npzFile)
 step = 1
-for line in f:
+for entries in intervals:
 	found = 0
 	print "{0}".format(step-1),
 
@@ -86,15 +122,8 @@ for line in f:
         # keep the most used function
         # The solution is to mark every function with the highst used one
 
-        # split the line to array of function indeces
-        strs = line.split(" ")
-	k=0
-	tmp = []
 	# Create list of triples
-        for s in strs:
-		if s != "\n" and k != 0:
-			tmp.append((int(s.split(":")[0]), s.split(":")[1], int(s.split(":")[2])))
-		k += 1
+	tmp = list(entries)
 
 	# sort the list by the third item smaller value
 	tmp.sort(key=lambda x: x[2])
@@ -116,15 +145,7 @@ for line in f:
 				break
 			k += 1
 
-	# split the line to array of function indeces
-	strs = line.split(" ")
-        #print (strs)
-        k = 0
-	tmp = []
-        for s in strs:
-       	        if s != "\n" and k != 0:
-               	        tmp.append(int(s.split(":")[0]))
-                k += 1
+	tmp = [e[0] for e in entries]
 	# sort the line array by the sorted function IDs
 	Z = sorted(tmp, key=lambda x: sortfuncID.index(x))
 	# write the most used function in that line
@@ -162,8 +183,14 @@ for line in f:
 		print str(t[0])+":"+str(t[1]),
 
 	print ""
+	if writer is not None:
+		# count data (index ID*10+2) goes in the calls column, the rest
+		# in the time column
+		writer.add(step-1, [t[0] for t in refine_list],
+		           [float(t[1]) if t[0] % 10 != 2 else 0.0 for t in refine_list],
+		           [int(t[1]) if t[0] % 10 == 2 else 0 for t in refine_list])
 #	print "-------------"
 	step += 1
 
-
-
+if writer is not None:
+	writer.close(funcNames)
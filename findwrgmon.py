@@ -2,57 +2,367 @@
 
 #
 # Find the address and offset of hidden "write_gmon" in libc
-# Usage: findwrgmon.py <pathname-of-libc>
+# Usage: findwrgmon.py [--all] [--cache] [--cachedir DIR] [--disasm] [<pathname-of-libc> ...]
 
 # Based on manual inspection, the hidden "write_gmon" function is
-# the function code that is just before the exposed "moncontrol" 
-# function. So we find the beginning of a function just before the 
+# the function code that is just before the exposed "moncontrol"
+# function. So we find the beginning of a function just before the
 # moncontrol symbol, and output its address and offset from moncontrol
 #
-# This uses "objdump -d" to dump the C library and then searches the 
-# output using a pipe
+# The ELF file is read directly (section headers, symbol tables, build-id
+# note), the same way libipr searches when it starts:
+# - a write_gmon symbol in the library's .symtab, or in its separate
+#   debug file (/usr/lib/debug/.build-id/xx/yyyy.debug), is used if
+#   there is one
+# - else write_gmon is the first function prologue after the end of
+#   the last exported (.dynsym) function before moncontrol
+# - else the code before moncontrol is scanned back for a 16-byte
+#   aligned function prologue right after the end of another function
+# An address found in the code (rather than from a write_gmon symbol)
+# is confirmed only if the exported _mcleanup(), which calls write_gmon
+# near its start, has a direct call to it.
+# Only the few KB of code before moncontrol are read, so this takes
+# milliseconds instead of disassembling the whole library. Prologues
+# are recognized by their bytes (endbr64/endbr32, push of the frame
+# pointer or of a callee-saved register, sub $n,%rsp), so a library
+# built without frame pointers is handled too; on other architectures
+# the symbol tables are trusted.
+#
+# With several libraries, or with --all (every C library found in the
+# usual system directories), one line "<build-id> <offset> <path>" is
+# printed per library. With --cache, each offset is also written to
+# libipr's cache (gmonoffset-<build-id> in IPR_CACHEDIR, default
+# $HOME/.cache/libipr, or in --cachedir), so that a job prolog can fill
+# the cache once per node; as in libipr, an offset that is not confirmed
+# is not cached, since every later run would trust it. With --disasm, objdump shows just the code
+# from write_gmon to moncontrol, to check the result by eye
+#
+# Works with both Python 2 and Python 3
+
+import os
+import sys
+import glob
+import struct
+import argparse
+import subprocess
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+STT_FUNC = 2
+NT_GNU_BUILD_ID = 3
+EM_386 = 3
+EM_X86_64 = 62
+
+# largest distance searched back from moncontrol (as in libipr)
+scanWindow = 16384
+
+# where --all looks for C libraries
+libcPatterns = ["/lib*/libc.so.6", "/lib*/*/libc.so.6",
+                "/usr/lib*/libc.so.6", "/usr/lib*/*/libc.so.6",
+                "/lib*/libc-*.so", "/lib*/*/libc-*.so",
+                "/usr/lib*/libc-*.so", "/usr/lib*/*/libc-*.so"]
+
+#---------------------------------------------------------------------
+# The parts of an ELF file needed here: section headers, function
+# symbols and the build-id
+#---------------------------------------------------------------------
+class ElfFile(object):
+   #
+   # constructor: read the headers of the ELF file; self.ok is False
+   # if it is not a (readable) ELF file
+   #
+   def __init__(self, filename):
+      self.filename = filename
+      self.ok = False
+      self.sections = []
+      self.buildId = ""
+      try:
+         self.inf = open(filename, "rb")
+      except IOError:
+         return
+      ident = self.inf.read(16)
+      if len(ident) < 16 or ident[:4] != b"\x7fELF":
+         return
+      self.is64 = ident[4:5] == b"\x02"
+      self.endian = "<" if ident[5:6] == b"\x01" else ">"
+      e = self.endian
+      if self.is64:
+         hdr = struct.unpack(e+"HHIQQQIHHHHHH", self.inf.read(48))
+      else:
+         hdr = struct.unpack(e+"HHIIIIIHHHHHH", self.inf.read(36))
+      self.machine = hdr[1]
+      (shoff, shentsize, shnum) = (hdr[5], hdr[10], hdr[11])
+      # section headers as (type, address, offset, size, link)
+      self.inf.seek(shoff)
+      data = self.inf.read(shnum*shentsize)
+      for i in range(len(data) // max(shentsize, 1)):
+         if self.is64:
+            sh = struct.unpack_from(e+"IIQQQQIIQQ", data, i*shentsize)
+         else:
+            sh = struct.unpack_from(e+"IIIIIIIIII", data, i*shentsize)
+         self.sections.append((sh[1], sh[3], sh[4], sh[5], sh[6]))
+      self.ok = True
+      self.buildId = self.readBuildId()
+   #
+   # close the file
+   #
+   def close(self):
+      if hasattr(self, "inf"):
+         self.inf.close()
+   #
+   # read size bytes at file offset
+   #
+   def read(self, offset, size):
+      self.inf.seek(offset)
+      return self.inf.read(size)
+   #
+   # read size bytes at an address of the file (relative to the load
+   # address); returns None if no section holds them
+   #
+   def readAddress(self, addr, size):
+      for (stype, saddr, soff, ssize, link) in self.sections:
+         if saddr > 0 and saddr <= addr and addr + size <= saddr + ssize:
+            return self.read(soff + addr - saddr, size)
+      return None
+   #
+   # build-id in hex from the note sections, or "" if there is none
+   #
+   def readBuildId(self):
+      e = self.endian
+      for (stype, saddr, soff, ssize, link) in self.sections:
+         if stype != SHT_NOTE:
+            continue
+         data = self.read(soff, ssize)
+         p = 0
+         while p + 12 <= len(data):
+            (namesz, descsz, ntype) = struct.unpack_from(e+"III", data, p)
+            name = data[p+12:p+12+namesz]
+            p += 12 + ((namesz + 3) & ~3)
+            if ntype == NT_GNU_BUILD_ID and name == b"GNU\0":
+               return "".join(["{0:02x}".format(b) for b in
+                               bytearray(data[p:p+descsz])])
+            p += (descsz + 3) & ~3
+      return ""
+   #
+   # function symbols of a symbol table type, as a list of
+   #   (name, address, size)
+   #
+   def functions(self, symtabType):
+      e = self.endian
+      funcs = []
+      for (stype, saddr, soff, ssize, link) in self.sections:
+         if stype != symtabType or link >= len(self.sections):
+            continue
+         strtab = self.read(self.sections[link][2], self.sections[link][3])
+         data = self.read(soff, ssize)
+         entsize = 24 if self.is64 else 16
+         for off in range(0, len(data) - entsize + 1, entsize):
+            if self.is64:
+               (name, info, other, shndx, value, size) = \
+                  struct.unpack_from(e+"IBBHQQ", data, off)
+            else:
+               (name, value, size, info, other, shndx) = \
+                  struct.unpack_from(e+"IIIBBH", data, off)
+            if info & 0xf != STT_FUNC or shndx == 0:
+               continue
+            nend = strtab.find(b"\0", name)
+            funcs.append((strtab[name:nend].decode("utf-8", "replace"),
+                          value, size))
+      return funcs
 
-import re;
-import sys;
-import os;
-import subprocess;
-import platform;
+#---------------------------------------------------------------------
+# Look through the symbol tables of an ELF file (the C library or its
+# debug file) for write_gmon, and for the end of the last function
+# that ends before monAddr
+# - returns (write_gmon address or None, end of the previous function)
+#---------------------------------------------------------------------
+def searchSymbols(elf, monAddr, prevEnd):
+   for symtabType in (SHT_SYMTAB, SHT_DYNSYM):
+      for (name, value, size) in elf.functions(symtabType):
+         if name == "write_gmon":
+            return (value, prevEnd)
+         end = value + size
+         if size > 0 and end <= monAddr and end > prevEnd:
+            prevEnd = end
+   return (None, prevEnd)
+
+#---------------------------------------------------------------------
+# Check for a function start at code[i]: a common x86 prologue
+# instruction (endbr, push of a frame or callee-saved register, stack
+# allocation); other architectures trust the symbol tables
+#---------------------------------------------------------------------
+def isPrologue(code, i, machine):
+   if machine not in (EM_386, EM_X86_64):
+      return True
+   c = code[i:i+4]
+   if c[:3] == b"\xf3\x0f\x1e" and c[3:4] in (b"\xfa", b"\xfb"):
+      return True   # endbr64/endbr32
+   if c[:1] in (b"\x55", b"\x53", b"\x56", b"\x57"):
+      return True   # push %rbp/%rbx/%rsi/%rdi
+   if c[:1] == b"\x41" and c[1:2] in (b"\x54", b"\x55", b"\x56", b"\x57"):
+      return True   # push %r12-%r15
+   if c[:1] == b"\x48" and c[1:2] in (b"\x83", b"\x81") and c[2:3] == b"\xec":
+      return True   # sub $n,%rsp
+   if c[:1] in (b"\x83", b"\x81") and c[1:2] == b"\xec":
+      return True   # sub $n,%esp
+   return False
+
+#---------------------------------------------------------------------
+# Check that the byte before code[i] can end a function or its
+# padding: ret, int3, nop, or the zero bytes that end multi-byte nops
+#---------------------------------------------------------------------
+def followsFunctionEnd(code, i):
+   return code[i-1:i] in (b"\xc3", b"\xcc", b"\x90", b"\x00")
+
+#---------------------------------------------------------------------
+# Check a write_gmon address that was found in the code: it must be
+# the target of one of the first direct calls (call rel32) in
+# _mcleanup()
+#---------------------------------------------------------------------
+def calledFromMcleanup(elf, wrAddr):
+   if elf.machine not in (EM_386, EM_X86_64):
+      return False
+   for (name, value, size) in elf.functions(SHT_DYNSYM):
+      if name == "_mcleanup":
+         break
+   else:
+      return False
+   code = elf.readAddress(value, 128+4)
+   if code is None:
+      return False
+   for i in range(128):
+      if code[i:i+1] != b"\xe8":
+         continue
+      (disp,) = struct.unpack_from(elf.endian+"i", code, i+1)
+      if value + i + 5 + disp == wrAddr:
+         return True
+   return False
+
+#---------------------------------------------------------------------
+# Find write_gmon in a C library
+# - returns (build-id, moncontrol address, write_gmon address,
+#   confirmed), with None for what is not found; confirmed is True if
+#   the address is that of a write_gmon symbol, or calledFromMcleanup()
+#   confirms it
+#---------------------------------------------------------------------
+def findGmonWriter(libfname):
+   elf = ElfFile(libfname)
+   if not elf.ok:
+      elf.close()
+      return (None, None, None, False)
+   monAddr = None
+   for (name, value, size) in elf.functions(SHT_DYNSYM):
+      if name == "moncontrol":
+         monAddr = value
+         break
+   if monAddr is None:
+      elf.close()
+      return (elf.buildId, None, None, False)
+   (wrAddr, prevEnd) = searchSymbols(elf, monAddr, 0)
+   if wrAddr is None and len(elf.buildId) > 2:
+      debugElf = ElfFile("/usr/lib/debug/.build-id/{0}/{1}.debug".format(
+                         elf.buildId[:2], elf.buildId[2:]))
+      if debugElf.ok:
+         (wrAddr, prevEnd) = searchSymbols(debugElf, monAddr, prevEnd)
+      debugElf.close()
+   confirmed = wrAddr is not None
+   if wrAddr is None:
+      # code window before moncontrol, starting 16-byte aligned
+      start = max((monAddr & ~15) - scanWindow, 0)
+      if prevEnd > 0 and monAddr - prevEnd < scanWindow:
+         start = (prevEnd + 15) & ~15
+      code = elf.readAddress(start, monAddr - start)
+      if code is not None and prevEnd > 0 and monAddr - prevEnd < scanWindow:
+         for i in range(0, len(code), 16):
+            if isPrologue(code, i, elf.machine):
+               wrAddr = start + i
+               break
+      elif code is not None:
+         for i in range(((monAddr & ~15) - 16) - start, 0, -16):
+            if isPrologue(code, i, elf.machine) and followsFunctionEnd(code, i):
+               wrAddr = start + i
+               break
+      if wrAddr is not None:
+         confirmed = calledFromMcleanup(elf, wrAddr)
+   elf.close()
+   return (elf.buildId, monAddr, wrAddr, confirmed)
+
+#---------------------------------------------------------------------
+# Write an offset to libipr's cache directory, as libipr does (under
+# a temporary name, then renamed)
+#---------------------------------------------------------------------
+def writeCache(cacheDir, buildId, offset):
+   if not os.path.isdir(cacheDir):
+      os.makedirs(cacheDir)
+   fname = os.path.join(cacheDir, "gmonoffset-" + buildId)
+   tmpname = "{0}.{1}".format(fname, os.getpid())
+   outf = open(tmpname, "w")
+   outf.write("{0}\n".format(offset))
+   outf.close()
+   os.rename(tmpname, fname)
+   return fname
 
 #
 # Main program
 #
-if len(sys.argv) != 2:
-   print "Usage: {0} <c-library-filename>".format(sys.argv[0])
-   exit(1)
-   
-libfname = sys.argv[1]
-
-arch = platform.architecture()[0]
-#arch = "32bit"
-if arch=="32bit":
-   keyInsn = "push   %ebp"  # 32-bit first insn in function
-else:
-   keyInsn = "push   %rbp"  # 64-bit first insn in function
-
-p = subprocess.Popen(["/usr/bin/objdump","-d",libfname],stdout=subprocess.PIPE)
-
-lastaddr = 0
-for line in p.stdout:
-   #print line
-   v = re.match("\s*0*([^\s]*) <moncontrol@*.*>:", line)
-   if v != None:
-      print "moncontrol at {0}, write_gmon at {1}".format(v.group(1),lastaddr),
-      print "decimal offset:", int(lastaddr,16)-int(v.group(1),16)
-      print "export IPR_GMONOFFSET={0}".format(int(lastaddr,16)-int(v.group(1),16))
-      break
-   v = re.match("\s*([^\s:]*):\t([^\t]*)\t([^\n\r]*)", line)
-   if v == None:
-      continue;
-   #print v.group(1), v.group(2), v.group(3) 
-   insn = v.group(3)
-   addr = v.group(1)
-   if insn == keyInsn:
-      #print v.group(1), v.group(2), v.group(3) 
-      lastaddr = addr
+argParser = argparse.ArgumentParser(description='Find the write_gmon offset in C libraries')
+argParser.add_argument('--all', action='store_true', help='check every C library in the usual system directories')
+argParser.add_argument('--cache', action='store_true', help='write the offsets to the libipr cache')
+argParser.add_argument('--cachedir', help='libipr cache directory (default IPR_CACHEDIR or $HOME/.cache/libipr)')
+argParser.add_argument('--disasm', action='store_true', help='disassemble the code from write_gmon to moncontrol')
+argParser.add_argument('libc', nargs='*', help='C library filename')
+args = argParser.parse_args()
+
+libfnames = list(args.libc)
+if args.all:
+   seen = set(os.path.realpath(f) for f in libfnames)
+   for pattern in libcPatterns:
+      for f in sorted(glob.glob(pattern)):
+         if os.path.realpath(f) not in seen:
+            seen.add(os.path.realpath(f))
+            libfnames.append(f)
+if len(libfnames) == 0:
+   argParser.print_usage()
+   sys.exit(1)
 
+cacheDir = args.cachedir
+if cacheDir is None:
+   cacheDir = os.environ.get("IPR_CACHEDIR")
+if cacheDir is None:
+   cacheDir = os.path.join(os.path.expanduser("~"), ".cache", "libipr")
 
+batch = len(libfnames) > 1 or args.all
+status = 0
+for libfname in libfnames:
+   (buildId, monAddr, wrAddr, confirmed) = findGmonWriter(libfname)
+   if wrAddr is None:
+      if buildId is None:
+         sys.stderr.write("{0}: not an ELF file\n".format(libfname))
+      elif monAddr is None:
+         sys.stderr.write("{0}: no moncontrol symbol\n".format(libfname))
+      else:
+         sys.stderr.write("{0}: write_gmon not found\n".format(libfname))
+      status = 1
+      continue
+   offset = wrAddr - monAddr
+   if batch:
+      print("{0} {1} {2}".format(buildId or "-", offset, libfname))
+   else:
+      print("moncontrol at {0:x}, write_gmon at {1:x} decimal offset: {2}".format(
+            monAddr, wrAddr, offset))
+      print("export IPR_GMONOFFSET={0}".format(offset))
+   if args.cache:
+      if not confirmed:
+         sys.stderr.write("{0}: offset not confirmed, not cached\n".format(libfname))
+      elif buildId:
+         fname = writeCache(cacheDir, buildId, offset)
+         if not batch:
+            print("cached in {0}".format(fname))
+      else:
+         sys.stderr.write("{0}: no build-id, not cached\n".format(libfname))
+   if args.disasm:
+      sys.stdout.flush()
+      subprocess.call(["objdump", "-d", "--start-address={0}".format(wrAddr),
+                       "--stop-address={0}".format(monAddr + 16), libfname])
+sys.exit(status)
@@ -0,0 +1,67 @@
+#---------------------------------------------------------------------
+#
+# Parsing of the flat profile table in gprof text reports
+#
+# A flat profile data line is either a full line or a short line that
+# is missing the calls and per-call columns:
+#
+#  %   cumulative   self              self     total
+# time   seconds   seconds    calls   s/call   s/call  name
+# 58.67    291.42   291.42        1   291.42   291.89  void miniFE::cg_solve
+#  0.05    291.58     0.15                             main
+#
+# Both forms are recognized by one precompiled pattern, so each line is
+# matched only once. The function name is everything up to the end of
+# the line, because C++ names have spaces, ':', '<', '>', and so on.
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import re
+
+# a full line is a short line with the three optional columns present
+flatLinePattern = re.compile(r"\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)"
+                             r"(?:\s*(\d+)\s*(\d+\.\d+)\s*(\d+\.\d+))?"
+                             r"\s*([^\n\r]*)")
+
+#---------------------------------------------------------------------
+# Parse one flat profile data line
+# - returns (name, pct, cumulative secs, self secs, calls, self
+#   per-call, total per-call), or None if the line is not a data line;
+#   the last three are 0 on a short line
+#---------------------------------------------------------------------
+def parseFlatLine(line):
+   v = flatLinePattern.match(line)
+   if v is None:
+      return None
+   (pct, cumtime, selftime, calls, selfcall, totcall, name) = v.groups()
+   if calls is None:
+      return (name, float(pct), float(cumtime), float(selftime), 0, 0.0, 0.0)
+   return (name, float(pct), float(cumtime), float(selftime), int(calls),
+           float(selfcall), float(totcall))
+
+#---------------------------------------------------------------------
+# Read the flat profile table from an open gprof report
+# - the table runs from the "Flat profile" line to the "Call graph"
+#   line (or the end of the report)
+# - returns a list of (name, pct, cumulative secs, self secs, calls)
+#   tuples, in the order of the table
+#---------------------------------------------------------------------
+def readFlatProfile(inf):
+   entries = []
+   inTable = False
+   match = flatLinePattern.match
+   for line in inf:
+      if not inTable:
+         if line.find("Flat profile") >= 0:
+            inTable = True
+         continue
+      if line.find("Call graph") >= 0:
+         break
+      v = match(line)
+      if v is None:
+         continue
+      (pct, cumtime, selftime, calls, selfcall, totcall, name) = v.groups()
+      entries.append((name, float(pct), float(cumtime), float(selftime),
+                      int(calls) if calls is not None else 0))
+   return entries
@@ -20,7 +20,12 @@ import glob
 import argparse
 import copy
 import math
+import io
+import tempfile
 import CallGraph
+import gmonread
+import samplecache
+import flatprofile
 
 debug = False
 doDot = False
@@ -29,11 +34,15 @@ maxDepth = 3
 #---------------------------------------------------------------------
 # Read gprof data and create call graph objects
 # param filename is the filename that the gprof output exists in
+# param text is the gprof output itself, if it is already in memory
 #---------------------------------------------------------------------
-def createProfileGraph(filename,id):
+def createProfileGraph(filename,id,text=None):
    inCGTable = False    # true when we are processing DG data lines
    inFlatTable = False  # true when we are processing flat data lines
-   inf = open(filename)
+   if text is not None:
+      inf = io.StringIO(text)
+   else:
+      inf = open(filename)
    if inf is None:
       print("ERROR: no such file ({0})".format(filename))
       return None
@@ -258,26 +267,16 @@ def processFlatProfileLine(line, cgraph):
    totalExecutionTime = 0.0
    # line is either a full data line or a "short" line
    if debug: print("flat line: {0}".format(line),end="")
-   # try to match full line first
-   v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-   short = 0
-   if v == None:
-      # now try to match short line
-      v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-      short = 1
+   v = flatprofile.parseFlatLine(line)
    if v == None:
       print("Unknown flat profile line: {0}".format(line), end='')
       return False
-   fpct = float(v.group(1))
-   totalExecutionTime = float(v.group(2))  # last line will be final total
-   fstime = float(v.group(3))
-   if short == 0:
-      fcalls = int(v.group(4))
-      # 5 and 6 are self ms/call and tot ms/call (TODO)
-      funcName = v.group(7)
-   else:
-      fcalls = 0
-      funcName = v.group(4)
+   # short lines have 0 calls; self and tot ms/call are not used (TODO)
+   funcName = v[0]
+   fpct = v[1]
+   totalExecutionTime = v[2]  # last line will be final total
+   fstime = v[3]
+   fcalls = v[4]
    if funcName in cgraph.flatProfileData:
       print("Error: already in flat profile: {0}".format(funcName))
    cgraph.flatProfileData[funcName] = (fpct,fstime,fcalls)
@@ -312,6 +311,44 @@ def reduceCGSequence(cgs, factor):
       cg.applyMergeFactor(count+1)
    return newcgs
 
+#---------------------------------------------------------------------
+# Run gprof on a profile data file and return the text report
+#---------------------------------------------------------------------
+def gprofReport(exeFile, proFile):
+   textFile = "{0}.txt".format(proFile)
+   print("do gprof report generation ({0})".format(proFile))
+   os.system("gprof {0} {1} > {2}".format(exeFile, proFile, textFile))
+   inf = open(textFile)
+   report = inf.read()
+   inf.close()
+   os.system("rm -f {0}".format(textFile))
+   return report
+
+#---------------------------------------------------------------------
+# Return the gprof reports of all samples in a libipr sample container,
+# as a list of (sample number, report); each sample is written out to
+# a temporary gmon file for gprof
+#---------------------------------------------------------------------
+def containerReports(exeFile, containerFile, cache):
+   reports = []
+   container = gmonread.SampleContainer(containerFile)
+   for i in range(len(container)):
+      data = container.sampleData(i)
+      report = None
+      if cache is not None:
+         report = cache.getData(data, "report")
+      if report is None:
+         (fd, proFile) = tempfile.mkstemp(prefix="gmon.")
+         os.write(fd, data)
+         os.close(fd)
+         report = gprofReport(exeFile, proFile)
+         os.unlink(proFile)
+         if cache is not None:
+            cache.putData(data, "report", report)
+      reports.append((container.sampleNumber(i), report))
+   container.close()
+   return reports
+
 #---------------------------------------------------------------------
 # Main
 #---------------------------------------------------------------------
@@ -324,6 +361,7 @@ argParser.add_argument('--bin', action='store', nargs=2, metavar='<filename>', h
 argParser.add_argument('--bindir', action='store', nargs=2, metavar='<name>', help='invoke gprof on all profiles in <exectuable directory> pair')
 argParser.add_argument('--dirpat', action='store', default=".*\.(\d+)", help='regex for filename parsing, must have one (\d+)')
 argParser.add_argument('--mode', action='store', default="time", help="SVM data: either 'time' or 'timecalls'")
+argParser.add_argument('--nocache', action='store_true', help='with --bindir, do not use or update the gprof report cache (default off)')
 args = argParser.parse_args()
 debug = args.debug
 doDot = args.dot
@@ -361,35 +399,53 @@ else:
    #   representing their ordering (of, e.g., intervals)
    #
    if debug: print("Processing directory {0}/".format(args.bindir[1]))
+   # gprof reports are kept in the directory's parse cache, keyed by
+   # the executable and profile contents, so reruns skip gprof
+   cache = None
+   if not args.nocache:
+      cache = samplecache.SampleCache(args.bindir[1], args.bindir[0])
    cgs = {}
    maxind = 0
+   # profiles are (index, profile name, report) in any order; a libipr
+   # sample container (IPR_CAPTURE=container) gives all its samples
+   profiles = []
    sd = os.scandir(args.bindir[1])
    for f in sd:
       if not f.is_file():
          print("filename {0} is not a regular file".format(f.name))
          continue
+      proFile = "{0}/{1}".format(args.bindir[1],f.name)
+      if gmonread.isSampleContainer(proFile):
+         for (ind, report) in containerReports(args.bindir[0], proFile, cache):
+            profiles.append((ind, "{0}[{1}]".format(proFile,ind), report))
+         continue
       v = re.match(dirPattern,f.name)
       if v is None:
          if debug: print("filename {0} does not match pattern |{1}|".format(
                          f.name, dirPattern))
          continue
       ind = int(v.group(1))
-      proFile = "{0}/{1}".format(args.bindir[1],f.name)
-      textFile = "{0}.txt".format(proFile)
-      print("do gprof report generation ({0})".format(proFile))
-      os.system("gprof {0} {1} > {2}".format(args.bindir[0], proFile, 
-                textFile))
-      cgraph = createProfileGraph(textFile,ind)
+      report = None
+      if cache is not None:
+         report = cache.get(proFile, "report")
+      if report is None:
+         report = gprofReport(args.bindir[0], proFile)
+         if cache is not None:
+            cache.put(proFile, "report", report)
+      profiles.append((ind, proFile, report))
+   for (ind, proFile, report) in profiles:
+      cgraph = createProfileGraph("{0}.txt".format(proFile),ind,report)
       if cgraph is None:
          print("No profile info could be read for {0}".format(proFile))
          continue
-      os.system("rm -f {0}".format(textFile))
       cgs[ind] = cgraph
       if ind > maxind: maxind = ind
       # default action: print nodes in call graph
       #for n in cgraph.nodeTable:
       #   node = cgraph.nodeTable[n]
       #   node.printMe()
+   if cache is not None:
+      cache.close()
    # convert dict into ordered list (use it instead of dict???)
    cglist = []
    for i in range(maxind+1):
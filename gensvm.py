@@ -2,7 +2,7 @@
 
 #
 # Generate SVM format lines from gprof profile data
-# Usage: gensvm.py <executable> <#samples> > <svm-format-filename>
+# Usage: gensvm.py [--native] [--jobs N] [--nocache] [--npz FILE] [--times FILE] <executable> <filenames-regexp> > <svm-format-filename>
 
 #
 # This script invokes gprof on each sample data file (a gmon.out file)
@@ -10,6 +10,33 @@
 # sample dataset in SVM format. It expects the gmon files to be named
 # "gmon-%d.out", where %d runs from 0 to #samples-1. It generates all
 # corresponding gprof-%d.out files, using the --brief option on gprof
+#
+# With --native, gprof is not run at all; the gmon files are decoded
+# directly (see gmonread.py) using the symbol table of the executable,
+# which gives the same flat profile data without a process per sample.
+# With --jobs N, samples are read (gprof run and report parsed, or gmon
+# file decoded) by N worker processes; the output is the same as serial.
+# Parsed samples are kept in a cache file in the sample directory (see
+# samplecache.py), so rerunning over unchanged data skips all parsing
+# Each sample's line is written out as soon as the sample is read, and
+# only the last changed sample is kept, so memory does not grow with
+# the number of samples
+# With --npz FILE, the same data is also written as a binary interval
+# dataset (see intervaldata.py), which the later scripts can load
+# without parsing; its (compact) columns are kept until the end
+# The sample files can also be one libipr delta log (IPR_CAPTURE=delta)
+# or sample container (IPR_CAPTURE=container), which hold all samples;
+# these are always decoded directly, the container from its memory map
+# Reading the samples and diffing them is shared with gendata.py (see
+# sampleread.py); this script only formats the output
+# With --times FILE (libipr's ipr-times.<pid>), each interval's times
+# are normalized to the mean interval length, for runs where the
+# intervals differ in length (IPR_ADAPTIVE)
+# The sample file can also be libipr's per-thread sample log
+# (IPR_THREADS=1, ipr-threads.<pid>); then there is one line per thread
+# per interval, labeled with the interval (sample) number, holding the
+# thread's own time in each function, and the interval and thread
+# number of each line go to svmthreads.txt (for cluster.py --threads)
 
 # LIBSVM format
 # https://stats.stackexchange.com/questions/61328/libsvm-data-format
@@ -39,13 +66,20 @@ import sys;
 import os;
 import glob;
 import subprocess;
+import argparse;
+import gmonread;
+import sampleread;
+import intervaldata;
 recordDiff = True
 progFile = "none"
 lastData = {}
-stepData = []
-funcIDMap = {}
-nextFunctionID = 1
 numFiles = 0
+# function IDs and the last step that changed (see sampleread.py)
+steps = sampleread.SampleSteps()
+# writer of the binary interval dataset, if one was asked for
+intervalWriter = None
+# interval length scale factor of each sample, if normalizing (--times)
+intervalScales = None
 
 
 # Show progress
@@ -61,185 +95,58 @@ def progress(count, total, status=''):
 
 
 #
-# Generate gprof file for one sample, and record its data
+# Output the data of one sample step in libsvm format
+# - the step is diffed against the last step that changed (see
+#   sampleread.SampleSteps), and times are multiplied by scale (see
+#   --times)
+# - feature indices are function ID*10+1, as in earlier versions
+# - the line is also added to the binary interval dataset, if any
 #
-def gensvm(filename, fileNum):
-   global nextFunctionID
-   global numFiles
-#   try:
-	#print "1"
-   if not(os.path.isfile(filename+".new")):
-	os.system("gprof -b {0} {1} > {1}.new".format(progFile,filename))
-	#print "2"
- #  except OSError:
-#	print "3"
-   #return
-   #print "{0}.new".format(filename)
-   inf = open("{0}.new".format(filename))
-   inTable = False
-   fdata = []
-   #funcIDMap = {}
-   #
-   # Not useful to look for index table, see above
-   #
-   #for line in inf:
-   #   #print line
-   #   if line.find("Index by function name") >= 0:
-   #      inTable = True
-   #      #print "In function index table"
-   #   if inTable == True:
-   #      pi = re.finditer("\s*\[(\d+)\] (\w*)", line)  #
-   #      for v in pi:
-   #         #print v.group(1), v.group(2)
-   #         funcIDMap[v.group(2)] = int(v.group(1))
-   #inf.seek(0,0)
-   inTable = False
-   for line in inf:
-      #print line
-      if line.find("Flat profile") >= 0:
-         inTable = True
-         #print "In flat profile table"
-      if line.find("Call graph") >= 0:
-         inTable = False
-         #print "Out of flat profile table"
-      if inTable == True:
-         #print line
-         # change function match from \w to non-newline because 
-         # of C++ class/template names (:,<>,spaces,...)
-         v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-	 #print "line = ", line
-	 #print "v = ", v
-	 # short is 1 if the line have missing last 3 values
-	 short = 0
-	 if v == None:
-		v = re.match("\s*(\d+\.\d+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([^\n\r]*)", line)
-		short = 1
-
-	 if v != None:
-            #print v.group(1), v.group(2), v.group(3), v.group(4) 
-	    #print v.group(5), v.group(6), v.group(7)
-	    fpct = float(v.group(1))
-            fttime = float(v.group(2))
-      	    fstime = float(v.group(3))
-	    if short == 0:
-		fcalls = int(v.group(4))
-		# 5 and 6 are self ms/call and tot ms/call
-	        if not (v.group(7) in funcIDMap):
-    			funcIDMap[v.group(7)] = nextFunctionID
-  				#print "hi", v.group(5), v.group(6), funcIDMap[v.group(7)], v.group(7)
-            		nextFunctionID += 1
-	        fid = funcIDMap[v.group(7)]
-	    else:
-		fcalls = 0
-            	if not (v.group(4) in funcIDMap):
-           	    funcIDMap[v.group(4)] = nextFunctionID
-	    	    nextFunctionID += 1
-    	    	fid = funcIDMap[v.group(4)]
-
-	    #print "fid=",fid,"len=",len(fdata)
-            while len(fdata) <= fid:
-               fdata.append(None)
-            fdata[fid] = (fpct, fttime, fstime, fcalls)
-	    #print "fdata[",fid,"]", fdata[fid]
-   #print fileNum,
-   # Put all function data together in one list for the sample step
-   # - must iterate through fdata (function data) and then add it to
-   # - the step list; we are using indices f*10 through f*10+9 for 
-   # - multiple data items per function 
-   step = []
-   for i,v in enumerate(fdata):
-      if v == None:
-         continue
-      #print v, "i=", i
-      #print "{0}:{1} {2}:{3}".format(i*10,v[0]/10.0,i*10+1,v[1]),
-      while len(step) <= i*10+5:
-         step.append(0)
-      #step[i*10] = v[0]/10.0
-      step[i*10+1] = v[2]   # self time
-      step[i*10+2] = v[3]   # num calls
-
-   while len(stepData) <= fileNum:
-      stepData.append(None)
+def outputStep(step, scale=1.0):
+   line = steps.diff(step, scale)
+   if line is None:
+      return
+   (stepNum, fids, times, calls) = line
+   print stepNum,
+   for (f, t) in zip(fids, times):
+      print "{0}:{1}".format(f*10+1,t), # Function index and the time diff
+   print ""
+   if intervalWriter is not None:
+      intervalWriter.add(stepNum, [f*10+1 for f in fids], times, calls)
 
-   stepData[fileNum] = step
-   #print "stepData[fileNum]=", stepData[fileNum]
 
 #
-# Output aggregate sample data in libsvm format
+# Output the data of one thread in one interval (from a thread log)
+# in libsvm format
+# - thread samples are of their interval already, so there is nothing
+#   to subtract; a line is output even if it is empty, to keep the
+#   lines in step with svmthreads.txt
 #
-def outputData(totSteps):
-   pstep = [0]*10000;
-   step_num = 0
-   mylist = [];
-   for i,step in enumerate(stepData):
-      #print "pstep=", pstep
-      #print "step=", step
-      if (not step):
-	 continue
-
-      check = 0
-      # Check if the line is empty
-      for k in range(10,len(step),10):
-         # added skip if close to zero since getting many 0s on minixyce
-         if abs(step[k+1]-pstep[k+1]) > 0:#0.001:
-	      #print "diff=", abs(step[k+1]-pstep[k+1])
-	      mylist = [];
-              check = 1 
-         # num calls is processed using fraction of total, to keep < 1
-         #if ((step[k+2]-pstep[k+2]) / float(step[k+2]) > 0.1):
-              #check = 1
-      if (check == 0 and not mylist):
-	      continue
-      if (check == 0):
-	 #print "step =", step_num
-	 #print "mylist", mylist
-         print step_num,
-	 for x in mylist:
-		 print "{0}:{1}".format(x+1,0),
-	 print ""
-	 step_num = step_num + 1
-	 continue
-
-      print step_num,
-      for k in range(10,len(step),10):
-	 #print "{0}:{1} {2}:{3} dd".format(k+1,step[k+1],k+2,step[k+2]),
-	 #print "{0}:{1} ".format(k,step[k]),
-	 #print "{0}:{1}-{2}:{3}".format(k+1,step[k+1],k+1,pstep[k+1]),
-         # added skip if close to zero since getting many 0s on minixyce
-	 c = 0
-	 if abs(step[k+1]-pstep[k+1]) > 0.001: # or abs(step[k+2]-pstep[k+2]):
-	     c = 1
-#	     if step[k+2] > 0 and (step[k+2]-pstep[k+2]) >  0.01: 
-#		     print "{0}:{1} {2}:{3}".format(k+1,round(step[k+1]-pstep[k+1],3),k+2,round((step[k+2]-pstep[k+2]) / float(step[k+2])/10,4)), # Function index and the time diff and one if function is called
-#	     else:
-#		     print "{0}:{1} {2}:0".format(k+1,round(step[k+1]-pstep[k+1],3),k+2), # Function index and the time diff and one if function is called
-
-             #########
-             # NOTE: This will not create a regular SVM file
-             #########
-#	     if (step[k+2] == 0 and pstep[k+2] == 0 or step[k+2]-pstep[k+2] == -1):
-#			step[k+2] = 1
-#             print "{0}:{1}:{2}".format(k+1,round(step[k+1]-pstep[k+1],3),step[k+2]-pstep[k+2]), # Function index and the time diff and count
+def outputThreadStep(sample, step, scale=1.0):
+   (fids, stime, calls) = step
+   print sample,
+   changed = []
+   for (f, t) in zip(fids, stime):
+      t = round(float(t)*scale,3)
+      if t > 0:
+         changed.append((int(f), t))
+         print "{0}:{1}".format(f*10+1,t),
+   print ""
+   if intervalWriter is not None:
+      intervalWriter.add(sample, [f*10+1 for (f, t) in changed],
+                         [t for (f, t) in changed], [0]*len(changed))
 
-	     print "{0}:{1}".format(k+1,round(step[k+1]-pstep[k+1],3)), # Function index and the time diff
-	     mylist.append(k)
-	     #print "{0}:1".format(k+1), # Function index only
-         # num calls is processed using fraction of total, to keep < 1
-#         if c == 1 and step[k+2] > 0 and ((step[k+2]-pstep[k+2]) / float(step[k+2])) >  0.01:
-#			print "{0}:{1}".format(k+2,round((step[k+2]-pstep[k+2]) / float(step[k+2])/10,4)),
-#			print "{0}:{1}".format(k+2,step[k+2]-pstep[k+2]),
-#	 else:
-#		if c == 1:
-#			print "{0}:0".format(k+2),
+#
+# Scale factor of sample i's interval (1 if not normalizing)
+#
+def intervalScale(i):
+   if intervalScales is None:
+      return 1.0
+   return intervalScales.get(i, 1.0)
 
-      print ""
-      pstep = step
-      pstep.extend([0]*10000)
-      step_num = step_num + 1
-      
-      
 # print function name mapping
 def outputFuncNames():
+   funcIDMap = steps.funcIDMap
    i = 1
    outf = open("svmfmap.txt","w")
    outf.write("{")
@@ -256,33 +163,48 @@ def outputFuncNames():
 #
 # Main program
 #
-if len(sys.argv) != 3:
-   print "Usage: {0} <exec-binary-filename> <filenames-regexp>".format(sys.argv[0])
-   exit(1)
-   
-progFile = sys.argv[1]
+argParser = argparse.ArgumentParser(description='Generate SVM data from gprof samples')
+argParser.add_argument('progFile', metavar='exec-binary-filename', type=str, help='profiled executable')
+argParser.add_argument('regexp', metavar='filenames-regexp', type=str, help='glob pattern of sample files')
+argParser.add_argument('--native', action='store_true', help='decode gmon files directly instead of running gprof (default off)')
+argParser.add_argument('--nocache', action='store_true', help='do not use or update the parse cache (default off)')
+argParser.add_argument('--jobs', action='store', type=int, default=1, metavar='N', help='read samples with N worker processes (default 1)')
+argParser.add_argument('--npz', action='store', metavar='FILE', help='also write the data as a binary interval dataset (see intervaldata.py)')
+argParser.add_argument('--times', action='store', metavar='FILE', help='normalize interval times to the mean interval length, using the libipr times file (ipr-times.<pid>)')
+args = argParser.parse_args()
+progFile = args.progFile
 #numFiles = int(sys.argv[2])
-filename_regexp = sys.argv[2]
+filename_regexp = args.regexp
+
+if args.times is not None:
+   intervalScales = gmonread.intervalScales(args.times)
+
+sampleread.setup(progFile, args.native)
 
 #print "start"
 
-i = 0
 listOfFiles = glob.glob(filename_regexp)
-total = len(listOfFiles)
-proc_num = listOfFiles[total-1].split(".")[1]
-pref_filename = listOfFiles[total-1].split("-")[0]
-#exit(0)
-for entry in listOfFiles:  
-   fname = pref_filename+"-"+str(i)+"."+str(proc_num)
-   #print (fname)
-   gensvm(fname, i)
-   i = i + 1
-   #progress(i, total+2, status='Extract Gproph files')
-	#print (entry)
-
-numFiles = i
+if args.npz is not None:
+   intervalWriter = intervaldata.IntervalWriter(args.npz)
+if len(listOfFiles) == 1 and gmonread.isThreadLog(listOfFiles[0]):
+   # per-thread samples: one line per thread per interval
+   symbolTable = gmonread.SymbolTable(progFile)
+   threadf = open("svmthreads.txt","w")
+   for (sample, thread, tid, entries) in gmonread.readThreadLog(listOfFiles[0],
+                                                                symbolTable):
+      outputThreadStep(sample, steps.step(entries), intervalScale(sample))
+      threadf.write("{0} {1} {2}\n".format(sample, thread, tid))
+   threadf.close()
+else:
+   # Each sample is output as soon as it is read, so memory use does
+   # not grow with the number of samples
+   for i,entries in enumerate(sampleread.readRun(listOfFiles, args.jobs,
+                                                 not args.nocache)):
+      outputStep(steps.step(entries), intervalScale(i))
+      #progress(i+1, total+2, status='Extract Gproph files')
+      numFiles = i + 1
 
-outputData(numFiles)
 outputFuncNames()
+if intervalWriter is not None:
+   intervalWriter.close(steps.funcIDMap)
 #progress(total, total, status='Write the SVM file')
-
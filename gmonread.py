@@ -0,0 +1,677 @@
+#---------------------------------------------------------------------
+#
+# Read raw gmon.out profile data directly, without invoking gprof
+#
+# The gmon.out format is what the hidden write_gmon() routine in the
+# C library writes out (see internal-gmon-source.c): a header followed
+# by tagged records,
+#   GMON_TAG_TIME_HIST: PC histogram header and histogram counters
+#   GMON_TAG_CG_ARC:    one call graph arc (frompc, selfpc, count)
+#   GMON_TAG_BB_COUNT:  basic-block counts (only with old -a style code)
+#
+# PCs are resolved to function names through the symbol table of the
+# executable, which is loaded only once for a whole set of samples. The
+# flat profile computed here follows the way gprof assigns histogram
+# bins and arcs to functions, so that scripts can use it in place of
+# parsing "gprof -b" output.
+#
+# It also reads the delta log that libipr writes with IPR_CAPTURE=delta
+# (see incprof.c), which holds all samples of a run as the histogram
+# and arc counts that changed in each interval, and the sample container
+# that it writes with IPR_CAPTURE=container, which holds the gmon data
+# of all samples of a run in one file, its sample times file, and the
+# per-thread PC samples it writes with IPR_THREADS=1.
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import bisect
+import subprocess
+
+debug = False
+
+GMON_MAGIC = b"gmon"
+GMON_TAG_TIME_HIST = 0
+GMON_TAG_CG_ARC = 1
+GMON_TAG_BB_COUNT = 2
+
+# libipr delta log and sample container
+DELTALOG_MAGIC = b"IPRDELTA"
+CONTAINER_MAGIC = b"IPRSAMPL"
+THREADLOG_MAGIC = b"IPRTHRDS"
+# sample encodings in a container (IPR_COMPRESS)
+ENCODE_DELTA = 1
+ENCODE_ZLIB = 2
+
+# gprof measures histogram addresses in 2-byte units
+HIST_UNIT = 2
+
+# ELF constants we need
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHF_EXECINSTR = 0x4
+STB_LOCAL = 0
+STT_NOTYPE = 0
+STT_FUNC = 2
+
+# functions that gprof never shows in the flat profile
+excludedNames = ("_gprof_mcount", "mcount", "_mcount", "__mcount",
+                 "__mcount_internal", "__mcleanup", "<locore>", "<hicore>")
+
+# suffixes that gcc puts on cloned functions (gprof keeps these)
+cloneTags = ("clone", "constprop", "isra", "part", "cold", "lto_priv")
+
+#---------------------------------------------------------------------
+# Check if a static function name is one that gprof would keep
+# - names with '$' or '.' are labels and such, except for gcc clones
+#   and nested functions, which end in ".<tag>.NNN" or ".NNN"
+#---------------------------------------------------------------------
+def isProfiledName(name):
+   if len(name) == 0 or name.find("$") >= 0:
+      return False
+   if name.startswith("__gnu_compiled") or name.startswith("___gnu_compiled"):
+      return False
+   parts = name.split(".")
+   for p in parts[1:]:
+      if not (p.isdigit() or p in cloneTags):
+         return False
+   return True
+
+#---------------------------------------------------------------------
+# Decide which of two symbols at the same address to keep, the same
+# way gprof does: prefer globals, then functions, then names with
+# fewer leading underscores; otherwise keep the one seen first
+#---------------------------------------------------------------------
+def isBetterAlias(sym, kept):
+   if sym[2] != kept[2]:
+      return sym[2]
+   if sym[3] != kept[3]:
+      return sym[3]
+   name = sym[4]
+   kname = kept[4]
+   if name[:1] != "_" and kname[:1] == "_":
+      return True
+   return len(name) > 0 and name[1:2] != "_" and kname[1:2] == "_"
+
+#---------------------------------------------------------------------
+# Demangle a list of C++ names with one c++filt invocation
+# - gprof demangles by default, so we must too to get the same names
+#---------------------------------------------------------------------
+def demangleNames(names):
+   mangled = [n for n in names if n.startswith("_Z")]
+   if len(mangled) == 0:
+      return {}
+   try:
+      p = subprocess.Popen(["c++filt"], stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+      out = p.communicate("\n".join(mangled).encode("utf-8"))[0]
+   except OSError:
+      sys.stderr.write("gmonread: c++filt not found, names not demangled\n")
+      return {}
+   demangled = out.decode("utf-8").split("\n")
+   if len(demangled) < len(mangled):
+      return {}
+   return dict(zip(mangled, demangled))
+
+#---------------------------------------------------------------------
+# Function symbol table of an executable, loaded from its ELF file
+# - addresses are kept sorted so that PCs can be looked up by bisection
+#---------------------------------------------------------------------
+class SymbolTable(object):
+   #
+   # constructor: read the symbols of the ELF file
+   #
+   def __init__(self, filename, demangle=True):
+      self.filename = filename
+      self.addrs = []     # sorted function start addresses
+      self.ends = []      # end address (exclusive) of each function
+      self.names = []     # (demangled) function name of each address
+      self.rawNames = []  # symbol name as in the ELF file
+      self.ptrSize = 8
+      self.endian = "<"
+      inf = open(filename, "rb")
+      syms = self.readElfSymbols(inf)
+      inf.close()
+      if len(syms) == 0:
+         sys.stderr.write("gmonread: no function symbols in {0}\n".format(
+                          filename))
+         return
+      # sort by address (stable, so symbol table order is kept for
+      # aliases), and keep only one symbol per address
+      syms.sort(key=lambda s: s[0])
+      keep = []
+      for s in syms:
+         if len(keep) > 0 and keep[-1][0] == s[0]:
+            if isBetterAlias(s, keep[-1]):
+               keep[-1] = s
+            continue
+         keep.append(s)
+      dmap = {}
+      if demangle:
+         dmap = demangleNames([s[4] for s in keep])
+      for i, s in enumerate(keep):
+         self.addrs.append(s[0])
+         if i+1 < len(keep):
+            self.ends.append(keep[i+1][0])
+         else:
+            self.ends.append(s[0] + max(s[1], 1))
+         self.names.append(dmap.get(s[4], s[4]))
+         self.rawNames.append(s[4])
+      if debug:
+         sys.stderr.write("gmonread: {0} function symbols\n".format(
+                          len(self.names)))
+   #
+   # read the ELF section headers and the (static or dynamic) symbol
+   # table; returns a list of tuples
+   #   (address, size, isGlobal, isFunc, name)
+   #
+   def readElfSymbols(self, inf):
+      ident = inf.read(16)
+      if ident[:4] != b"\x7fELF":
+         sys.stderr.write("gmonread: {0} is not an ELF file\n".format(
+                          self.filename))
+         return []
+      is64 = ident[4:5] == b"\x02"
+      self.endian = "<" if ident[5:6] == b"\x01" else ">"
+      e = self.endian
+      if is64:
+         self.ptrSize = 8
+         hdr = struct.unpack(e+"HHIQQQIHHHHHH", inf.read(48))
+      else:
+         self.ptrSize = 4
+         hdr = struct.unpack(e+"HHIIIIIHHHHHH", inf.read(36))
+      shoff = hdr[5]
+      shentsize = hdr[10]
+      shnum = hdr[11]
+      # read all section headers as
+      #   (type, flags, offset, size, link, entsize)
+      sections = []
+      for i in range(shnum):
+         inf.seek(shoff + i*shentsize)
+         if is64:
+            sh = struct.unpack(e+"IIQQQQIIQQ", inf.read(64))
+         else:
+            sh = struct.unpack(e+"IIIIIIIIII", inf.read(40))
+         sections.append((sh[1], sh[2], sh[4], sh[5], sh[6], sh[9]))
+      # use the full symbol table if there is one, else dynamic symbols
+      symsec = None
+      for stype in (SHT_SYMTAB, SHT_DYNSYM):
+         for s in sections:
+            if s[0] == stype:
+               symsec = s
+               break
+         if symsec is not None:
+            break
+      if symsec is None:
+         return []
+      inf.seek(sections[symsec[4]][2])
+      strtab = inf.read(sections[symsec[4]][3])
+      inf.seek(symsec[2])
+      data = inf.read(symsec[3])
+      syms = []
+      entsize = symsec[5]
+      for off in range(0, len(data) - entsize + 1, entsize):
+         if is64:
+            (name, info, other, shndx, value, size) = \
+               struct.unpack_from(e+"IBBHQQ", data, off)
+         else:
+            (name, value, size, info, other, shndx) = \
+               struct.unpack_from(e+"IIIBBH", data, off)
+         stype = info & 0xf
+         sbind = info >> 4
+         if stype not in (STT_FUNC, STT_NOTYPE) or value == 0:
+            continue
+         if shndx == 0 or shndx >= len(sections):
+            continue
+         if not (sections[shndx][1] & SHF_EXECINSTR):
+            continue
+         nend = strtab.find(b"\0", name)
+         sname = strtab[name:nend].decode("utf-8", "replace")
+         if sbind == STB_LOCAL and not isProfiledName(sname):
+            continue
+         if sname in excludedNames:
+            continue
+         syms.append((value, size, sbind != STB_LOCAL, stype == STT_FUNC,
+                      sname))
+      return syms
+   #
+   # find the index of the function containing pc, or -1 if none
+   #
+   def lookup(self, pc):
+      i = bisect.bisect_right(self.addrs, pc) - 1
+      if i < 0 or pc >= self.ends[i]:
+         return -1
+      return i
+
+#---------------------------------------------------------------------
+# Data from one gmon.out file
+#---------------------------------------------------------------------
+class GmonData(object):
+   #
+   # constructor
+   #
+   def __init__(self):
+      # list of (lowpc, highpc, profRate, counts) histogram records
+      self.hists = []
+      # list of (frompc, selfpc, count) call arcs
+      self.arcs = []
+      # list of (address, count) basic-block counts
+      self.bbcounts = []
+
+#---------------------------------------------------------------------
+# Decode one gmon.out file
+# - symtab gives the pointer size and byte order of the profiled program
+# - returns a GmonData object, or None if the file cannot be read
+#---------------------------------------------------------------------
+def readGmonFile(filename, symtab):
+   try:
+      inf = open(filename, "rb")
+   except IOError:
+      sys.stderr.write("gmonread: cannot open {0}\n".format(filename))
+      return None
+   data = inf.read()
+   inf.close()
+   return decodeGmonData(data, symtab, filename)
+
+#---------------------------------------------------------------------
+# Decode gmon.out data that is already in memory
+#---------------------------------------------------------------------
+def decodeGmonData(data, symtab, filename="<data>"):
+   e = symtab.endian
+   ptr = "Q" if symtab.ptrSize == 8 else "I"
+   histHdr = struct.Struct(e + ptr + ptr + "ii15sc")
+   arcRec = struct.Struct(e + ptr + ptr + "i")
+   bbRec = struct.Struct(e + ptr + ptr)
+   if data[:4] != GMON_MAGIC:
+      sys.stderr.write("gmonread: {0} is not a gmon file\n".format(filename))
+      return None
+   gmon = GmonData()
+   pos = 20  # cookie, version, and spare bytes
+   dlen = len(data)
+   while pos < dlen:
+      tag = struct.unpack_from("B", data, pos)[0]
+      pos += 1
+      if tag == GMON_TAG_TIME_HIST:
+         (lowpc, highpc, nbins, rate, dimen, abbrev) = \
+            histHdr.unpack_from(data, pos)
+         pos += histHdr.size
+         counts = struct.unpack_from(e + "{0}H".format(nbins), data, pos)
+         pos += nbins * 2
+         gmon.hists.append((lowpc, highpc, rate, counts))
+      elif tag == GMON_TAG_CG_ARC:
+         gmon.arcs.append(arcRec.unpack_from(data, pos))
+         pos += arcRec.size
+      elif tag == GMON_TAG_BB_COUNT:
+         ncounts = struct.unpack_from(e + ptr, data, pos)[0]
+         pos += symtab.ptrSize
+         for i in range(ncounts):
+            gmon.bbcounts.append(bbRec.unpack_from(data, pos))
+            pos += bbRec.size
+      else:
+         sys.stderr.write("gmonread: bad record tag {0} in {1}\n".format(
+                          tag, filename))
+         break
+   return gmon
+
+#---------------------------------------------------------------------
+# Check if a file is a libipr delta log (rather than a gmon file)
+#---------------------------------------------------------------------
+def isDeltaLog(filename):
+   try:
+      inf = open(filename, "rb")
+   except IOError:
+      return False
+   magic = inf.read(len(DELTALOG_MAGIC))
+   inf.close()
+   return magic == DELTALOG_MAGIC
+
+#---------------------------------------------------------------------
+# Read the samples of a libipr delta log
+# - the log is a header (magic, version, pointer size, histogram lowpc,
+#   highpc, #buckets and rate) followed by one record per interval:
+#   (sample number, #buckets, #arcs, spare) and then that many
+#   (bucket index, count) and (frompc, selfpc, count) deltas
+# - the deltas are added up, so this is a generator of
+#   (sample number, GmonData) with the same cumulative data that a
+#   gmon file written at the end of the interval would have
+# - a partly written last record (program killed) is ignored
+#---------------------------------------------------------------------
+def readDeltaLog(filename, symtab):
+   e = symtab.endian
+   inf = open(filename, "rb")
+   if os.fstat(inf.fileno()).st_size == 0:
+      inf.close()
+      return
+   data = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+   (magic, version, ptrSize) = struct.unpack_from(e + "8sII", data, 0)
+   if magic != DELTALOG_MAGIC:
+      sys.stderr.write("gmonread: {0} is not a delta log\n".format(filename))
+      data.close()
+      inf.close()
+      return
+   ptr = "Q" if ptrSize == 8 else "I"
+   header = struct.Struct(e + "8sII" + ptr + ptr + "Ii")
+   record = struct.Struct(e + "IIII")
+   arcSize = 3 * ptrSize
+   (magic, version, ptrSize, lowpc, highpc, nbuckets, rate) = \
+      header.unpack_from(data, 0)
+   counts = [0] * nbuckets
+   arcs = {}
+   pos = header.size
+   dlen = len(data)
+   while pos + record.size <= dlen:
+      (sample, nhist, narcs, spare) = record.unpack_from(data, pos)
+      pos += record.size
+      if pos + nhist*8 + narcs*arcSize > dlen:
+         break
+      hist = struct.unpack_from(e + "{0}I".format(2*nhist), data, pos)
+      pos += nhist*8
+      for i in range(0, len(hist), 2):
+         counts[hist[i]] += hist[i+1]
+      arcData = struct.unpack_from(e + (ptr+ptr+ptr.lower())*narcs, data, pos)
+      pos += narcs*arcSize
+      for i in range(0, len(arcData), 3):
+         key = (arcData[i], arcData[i+1])
+         arcs[key] = arcs.get(key, 0) + arcData[i+2]
+      gmon = GmonData()
+      gmon.hists.append((lowpc, highpc, rate, list(counts)))
+      gmon.arcs = [(k[0], k[1], c) for (k, c) in arcs.items()]
+      yield (sample, gmon)
+   data.close()
+   inf.close()
+
+#---------------------------------------------------------------------
+# Check if a file is a libipr sample container
+#---------------------------------------------------------------------
+def isSampleContainer(filename):
+   try:
+      inf = open(filename, "rb")
+   except IOError:
+      return False
+   magic = inf.read(len(CONTAINER_MAGIC))
+   inf.close()
+   return magic == CONTAINER_MAGIC
+
+#---------------------------------------------------------------------
+# Rebuild gmon data from an ENCODE_DELTA encoded sample and the gmon
+# data of the previous sample
+# - the encoding is a series of (copy length, literal length) pairs:
+#   copy that many bytes of the previous data (at the same offset),
+#   then take the literal bytes that follow the pair
+#---------------------------------------------------------------------
+def applyDelta(prev, delta, endian="<"):
+   parts = []
+   pos = 0
+   i = 0
+   pair = struct.Struct(endian + "II")
+   while i < len(delta):
+      (copy, literal) = pair.unpack_from(delta, i)
+      i += 8
+      if copy > 0:
+         parts.append(prev[pos:pos+copy])
+         pos += copy
+      parts.append(delta[i:i+literal])
+      i += literal
+      pos += literal
+   return b"".join(parts)
+
+#---------------------------------------------------------------------
+# Samples of a libipr sample container, memory-mapped
+# - the file is a header (magic, version, #samples, index offset), a
+#   (sample number, encoding, size) record before each sample's data,
+#   and at the end an index of (sample number, encoding, offset, size)
+# - the index is used if libipr got to write it, else the records are
+#   followed from the start (up to a partly written record, or the start
+#   of a partly written index)
+# - samples are in the order they were written, which is sample order
+# - encoded samples (IPR_COMPRESS) are decoded on access; a delta
+#   encoded sample needs the one before it, so the last decoded sample
+#   is kept, and reading the samples in order decodes each only once
+#---------------------------------------------------------------------
+class SampleContainer(object):
+   #
+   # constructor: map the file and find its samples
+   #
+   def __init__(self, filename):
+      self.filename = filename
+      self.samples = []    # (sample number, encoding, offset, size)
+      self.last = (-1, None)   # last decoded sample: (position, data)
+      self.inf = open(filename, "rb")
+      self.data = None
+      if os.fstat(self.inf.fileno()).st_size == 0:
+         return
+      self.data = mmap.mmap(self.inf.fileno(), 0, access=mmap.ACCESS_READ)
+      # the header says which byte order the file has
+      self.endian = "<"
+      if struct.unpack_from("<I", self.data, 8)[0] > 0xffff:
+         self.endian = ">"
+      e = self.endian
+      (magic, version, count, indexOffset) = \
+         struct.unpack_from(e + "8sIIQ", self.data, 0)
+      dlen = len(self.data)
+      if magic != CONTAINER_MAGIC:
+         sys.stderr.write("gmonread: {0} is not a sample container\n".format(
+                          filename))
+         return
+      if indexOffset > 0 and indexOffset + count*24 <= dlen:
+         index = struct.unpack_from(e + "IIQQ"*count, self.data, indexOffset)
+         for i in range(0, len(index), 4):
+            self.samples.append(index[i:i+4])
+         return
+      pos = 24
+      while pos + 16 <= dlen:
+         (sample, encoding, size) = struct.unpack_from(e + "IIQ", self.data,
+                                                       pos)
+         pos += 16
+         if pos + size > dlen or encoding > (ENCODE_DELTA | ENCODE_ZLIB):
+            break
+         if encoding == 0 and self.data[pos:pos+4] != GMON_MAGIC:
+            break
+         self.samples.append((sample, encoding, pos, size))
+         pos += size
+   #
+   # number of samples
+   #
+   def __len__(self):
+      return len(self.samples)
+   #
+   # sample number of the i'th sample
+   #
+   def sampleNumber(self, i):
+      return self.samples[i][0]
+   #
+   # gmon data of the i'th sample
+   #
+   def sampleData(self, i):
+      if self.last[0] == i:
+         return self.last[1]
+      # go back to the last sample that does not need the one before it
+      first = i
+      while (first > 0 and first != self.last[0]+1 and
+             self.samples[first][1] & ENCODE_DELTA):
+         first -= 1
+      data = self.last[1]
+      for j in range(first, i+1):
+         (sample, encoding, offset, size) = self.samples[j]
+         stored = self.data[offset:offset+size]
+         if encoding & ENCODE_ZLIB:
+            stored = zlib.decompress(stored)
+         if encoding & ENCODE_DELTA:
+            data = applyDelta(data, stored, self.endian)
+         else:
+            data = stored
+      self.last = (i, data)
+      return data
+   #
+   # unmap and close the file
+   #
+   def close(self):
+      if self.data is not None:
+         self.data.close()
+      self.inf.close()
+
+#---------------------------------------------------------------------
+# Check if a file is a libipr thread log
+#---------------------------------------------------------------------
+def isThreadLog(filename):
+   try:
+      inf = open(filename, "rb")
+   except IOError:
+      return False
+   magic = inf.read(len(THREADLOG_MAGIC))
+   inf.close()
+   return magic == THREADLOG_MAGIC
+
+#---------------------------------------------------------------------
+# Read the per-thread samples of a libipr thread log (ipr-threads.<pid>)
+# - the log is a header (magic, version, pointer size, sampling period
+#   in nanoseconds of thread CPU time, spare) followed by one record per
+#   thread per interval: (sample number, thread number, kernel thread
+#   id, #PCs, #dropped samples, spare) and then that many (pc, count)
+#   pairs
+# - the counts are of one interval, not cumulative as in gmon data
+# - this is a generator of (sample number, thread number, thread id,
+#   flat profile), the flat profile as from flatProfile() but without
+#   call counts; PCs outside the program's functions are left out
+# - a partly written last record (program killed) is ignored
+#---------------------------------------------------------------------
+def readThreadLog(filename, symtab):
+   e = symtab.endian
+   inf = open(filename, "rb")
+   data = inf.read()
+   inf.close()
+   header = struct.Struct(e + "8sIIII")
+   if len(data) < header.size or data[:8] != THREADLOG_MAGIC:
+      sys.stderr.write("gmonread: {0} is not a thread log\n".format(filename))
+      return
+   (magic, version, ptrSize, period, spare) = header.unpack_from(data, 0)
+   ptr = "Q" if ptrSize == 8 else "I"
+   record = struct.Struct(e + "IIIIII")
+   pos = header.size
+   dropped = 0
+   while pos + record.size <= len(data):
+      (sample, thread, tid, npcs, ndropped, spare) = \
+         record.unpack_from(data, pos)
+      pos += record.size
+      if pos + npcs*2*ptrSize > len(data):
+         break
+      pcs = struct.unpack_from(e + ptr*(2*npcs), data, pos)
+      pos += npcs*2*ptrSize
+      dropped += ndropped
+      ftime = {}
+      total = 0
+      for i in range(0, len(pcs), 2):
+         j = symtab.lookup(pcs[i])
+         total += pcs[i+1]
+         if j >= 0:
+            ftime[j] = ftime.get(j, 0) + pcs[i+1]
+      order = sorted(ftime, key=lambda j: (-ftime[j], symtab.rawNames[j]))
+      entries = []
+      accum = 0
+      for j in order:
+         accum += ftime[j]
+         entries.append((symtab.names[j],
+                         float("%.2f" % (100.0 * ftime[j] / total)),
+                         accum * period / 1e9, ftime[j] * period / 1e9, 0))
+      yield (sample, thread, tid, entries)
+   if dropped > 0:
+      sys.stderr.write("gmonread: {0} thread samples were dropped by "
+                       "libipr (full ring)\n".format(dropped))
+
+#---------------------------------------------------------------------
+# Read a libipr sample times file (ipr-times.<pid>)
+# - returns a dictionary of sample number to (wall, process CPU, main
+#   thread CPU, interval length) times in seconds; the length is on
+#   the clock libipr sampled on (IPR_CLOCK), and may vary between
+#   samples with IPR_ADAPTIVE
+#---------------------------------------------------------------------
+def readSampleTimes(filename):
+   times = {}
+   for line in open(filename):
+      fields = line.split()
+      if len(fields) == 0 or fields[0].startswith("#"):
+         continue
+      times[int(fields[0])] = tuple(float(v) for v in fields[1:5])
+   return times
+
+#---------------------------------------------------------------------
+# Scale factors that normalize each sample's interval to the mean
+# interval length of a libipr sample times file: mean length / length
+# - returns a dictionary of sample number to factor
+#---------------------------------------------------------------------
+def intervalScales(filename):
+   times = readSampleTimes(filename)
+   lengths = dict((s, times[s][3]) for s in times if times[s][3] > 0)
+   if len(lengths) == 0:
+      return {}
+   mean = sum(lengths.values()) / len(lengths)
+   return dict((s, mean / lengths[s]) for s in lengths)
+
+#---------------------------------------------------------------------
+# Compute the flat profile of one sample, like gprof does
+# - histogram bins are credited to functions in proportion to how much
+#   of the bin's address range each function covers
+# - calls of a function are the sum of all arcs into it from other
+#   functions (gprof leaves out recursive self calls here)
+# - returns a list of (name, fpct, fttime, fstime, fcalls) tuples in
+#   gprof flat profile order (most self time first); times are rounded
+#   to what gprof prints, so the values match a parsed gprof report
+#---------------------------------------------------------------------
+def flatProfile(gmon, symtab):
+   nsyms = len(symtab.addrs)
+   ftime = {}
+   fcalls = {}
+   totalTime = 0.0
+   rate = 1
+   for (lowpc, highpc, rate, counts) in gmon.hists:
+      if len(counts) == 0:
+         continue
+      lowpc = lowpc // HIST_UNIT
+      highpc = highpc // HIST_UNIT
+      histScale = float(highpc - lowpc) / len(counts)
+      for i, count in enumerate(counts):
+         if count == 0:
+            continue
+         binLow = lowpc + int(histScale * i)
+         binHigh = lowpc + int(histScale * (i+1))
+         totalTime += count
+         # credit all symbols that are covered by this bin
+         j = bisect.bisect_right(symtab.addrs, binLow * HIST_UNIT) - 1
+         if j < 0:
+            j = 0
+         while j < nsyms:
+            symLow = symtab.addrs[j] // HIST_UNIT
+            symHigh = symtab.ends[j] // HIST_UNIT
+            if symLow >= binHigh:
+               break
+            overlap = min(binHigh, symHigh) - max(binLow, symLow)
+            if overlap > 0:
+               ftime[j] = ftime.get(j, 0.0) + overlap * count / histScale
+            j += 1
+   for (frompc, selfpc, count) in gmon.arcs:
+      child = symtab.lookup(selfpc)
+      parent = symtab.lookup(frompc)
+      if child < 0 or parent < 0 or parent == child:
+         continue
+      fcalls[child] = fcalls.get(child, 0) + count
+   # order like gprof: self time, then calls, then (mangled) name
+   funcs = set(ftime) | set(fcalls)
+   order = sorted(funcs, key=lambda j: (-ftime.get(j, 0.0),
+                  -fcalls.get(j, 0), symtab.rawNames[j]))
+   entries = []
+   accum = 0.0
+   for j in order:
+      t = ftime.get(j, 0.0)
+      accum += t
+      if totalTime > 0:
+         fpct = float("%.2f" % (100.0 * t / totalTime))
+      else:
+         fpct = 0.0
+      entries.append((symtab.names[j], fpct, float("%.2f" % (accum / rate)),
+                      float("%.2f" % (t / rate)), fcalls.get(j, 0)))
+   return entries
@@ -1,3 +1,4 @@
+#define _GNU_SOURCE
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -9,13 +10,74 @@
 #include <errno.h>
 #include <pthread.h>
 #include <libgen.h>
+#include <sys/gmon.h>
+#include <sys/gmon_out.h>
+#include <fcntl.h>
+#include <link.h>
+#include <zlib.h>
+#include <math.h>
+#include <elf.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <ucontext.h>
+#include <regex.h>
 
 // Environment variables
+// IPR_APPNAME -- name of the program to profile (other programs that load
+//                libipr are left alone), or a comma-separated list of
+//                them, each an extended regular expression of the whole
+//                name (e.g. "lmp_.*,namd2"; escape metacharacters of
+//                plain names, e.g. "g\+\+"); required
 // IPR_DATADIR -- directory for sample data files; default none
-// IPR_GMONOFFSET -- offset (hex or dec) from "moncontrol" symbol to write_gmon begin
+// IPR_GMONOFFSET -- offset (hex or dec) from "moncontrol" symbol to write_gmon
+//                   begin; default found from the C library (and cached)
+// IPR_CACHEDIR -- directory for the cached write_gmon offsets; default
+//                 $HOME/.cache/libipr
 // IPR_SECONDS -- seconds between profile sample writes (added to useconds)
 // IPR_USECONDS -- microseconds between profile sample writes (added to seconds)
 // IPR_DEBUG -- 1 if want debug messages
+// IPR_PHASES -- 1 to also detect phases online and write a phase timeline
+//               file, 2 to do only that (no gmon sample files); default 0
+// IPR_PHASEDIST -- distance (0-2) from all phases at which an interval
+//                  starts a new phase; default 0.5
+// IPR_MAXPHASES -- maximum number of phases; default 16
+// IPR_CAPTURE -- "gmon" to write a gmon file per interval (default), or
+//                "delta" to append only what changed in each interval to
+//                one log file, ipr-delta.<pid>, or "container" to append
+//                each interval's gmon data to one file, ipr-samples.<pid>
+// IPR_COMPRESS -- with IPR_CAPTURE=container, "rle" to store each sample
+//                 as the byte runs that differ from the previous sample,
+//                 or "zlib" to also compress those with zlib; default none
+// IPR_ADAPTIVE -- 1 to shorten the interval while the profile changes and
+//                 lengthen it while it is steady; default 0
+// IPR_MININTERVAL, IPR_MAXINTERVAL -- adaptive interval bounds in
+//                 microseconds; default 1/4 and 4 times the interval
+// IPR_ADAPTDIST -- profile change (0-2) between intervals above which
+//                  the adaptive interval is halved; default 0.2
+// IPR_CLOCK -- clock the interval is measured on: "wall" (elapsed time,
+//              default), "process-cpu" (CPU time of the whole process) or
+//              "thread-cpu" (CPU time of the program's main thread); the
+//              sample times file ipr-times.<pid> is written only if this
+//              is set, with IPR_ADAPTIVE, or with IPR_CAPTURE=delta or
+//              container
+// IPR_THREADS -- 1 to also sample each thread's PC on its own CPU-time
+//                timer, written per interval to ipr-threads.<pid>; default 0
+// IPR_THREADPERIOD -- microseconds of a thread's CPU time between its PC
+//                     samples; default 1000
+// IPR_RANKDIRS -- 0 to keep the files of all ranks of a parallel job in
+//                 the data directory, instead of a rank-<rank> subdirectory
+//                 per rank; default 1
+// IPR_STATS -- N to write a line of libipr's own costs (bytes written,
+//              missed deadlines, CPU time, latency) to ipr-stats.<pid>
+//              every N samples, and the summary also to stderr; 0 for
+//              only the summary there at exit, which is also written
+//              with IPR_CAPTURE=delta or container; default none
+// IPR_ASYNC -- 0 to write samples from the sampling thread itself; default
+//              1, a separate writer thread writes them (needs _gmonparam)
+// IPR_GMONPARAMOFFSET -- offset (hex or dec) from "moncontrol" symbol to
+//                        the hidden _gmonparam data; default found from
+//                        moncontrol code
 
 //https://github.com/lattera/glibc/blob/master/gmon/gmon.c
 // looking at source, calling monstartup after moncleanup 
@@ -25,6 +87,7 @@
 // -- in looking at disassembled code, write_gmon code is in front of
 //    moncontrol() function, so we just found the beginning by hand and
 //    marked its file offset address
+// -- now found at startup (findGmonOffset()), these are just for reference
 //
 // For Acer laptop 32-bit
 //#define WRGMON_OFFSET (0xf43f0 - 0xf4940)
@@ -36,17 +99,2016 @@
 char sampleFilename[120] = "gmon-%d.out";
 char dataDirname[120] = "";
 
+static int debug = 0;
+
+//
+// Self-measurement: what libipr costs the program
+// - latencies of the sampler's work in each interval (from waking up
+//   to going back to sleep) and of writing each sample out (in the
+//   writer thread if there is one), counted in log2 microsecond buckets
+//   (bucket b holds latencies under 2^b us)
+// - bytes of sample data written, deadlines missed (intervals skipped
+//   because the sampler was held up), and the CPU time of libipr's
+//   sampler and writer threads (the per-thread sampling signal
+//   handlers run in the program's threads and are not counted)
+// - a summary is written at exit to ipr-stats.<pid>, if IPR_STATS is
+//   set or the samples go to one file (IPR_CAPTURE=delta or container),
+//   so that default runs do not make one more file per process; with
+//   IPR_STATS=N a stats line also goes there every N samples, and the
+//   summary also goes to stderr
+//
+#define STATS_BUCKETS 24
+#define STATS_SAMPLE 0
+#define STATS_WRITE 1
+struct latencyStats {
+   unsigned long count;
+   unsigned long long total;   // nanoseconds
+   unsigned long long max;
+   unsigned long buckets[STATS_BUCKETS];
+};
+static struct latencyStats latencies[2];
+static unsigned long long bytesWritten = 0;
+static unsigned long missedDeadlines = 0;
+static clockid_t libiprClocks[2];   // CPU clocks of the sampler and writer
+static double retiredCpu[2];        // CPU time of the ones that exited
+static int retiredClocks[2];
+static int numLibiprClocks = 0;
+static int statsEvery = 0;
+static int wantStats = 0;
+static FILE *statsFile = NULL;
+
+static long long monotonicNanos()
+{
+   struct timespec now;
+   clock_gettime(CLOCK_MONOTONIC, &now);
+   return now.tv_sec*1000000000LL + now.tv_nsec;
+}
+
+// count bytes of sample data written (by any of libipr's threads)
+static void countBytes(size_t size)
+{
+   __atomic_fetch_add(&bytesWritten, size, __ATOMIC_RELAXED);
+}
+
+// count a latency, from start (monotonicNanos()) to now; each kind is
+// only counted by one thread
+static void recordLatency(int kind, long long start)
+{
+   struct latencyStats *ls = &latencies[kind];
+   long long ns = monotonicNanos() - start;
+   unsigned long us = ns / 1000;
+   int b = 0;
+   while (us > 0 && b < STATS_BUCKETS-1) {
+      us >>= 1;
+      b++;
+   }
+   ls->count++;
+   ls->total += ns;
+   if (ns > ls->max)
+      ls->max = ns;
+   ls->buckets[b]++;
+}
+
+// add the calling thread's CPU clock to the ones counted as overhead;
+// returns its slot, for retireLibiprClock()
+static int addLibiprClock()
+{
+   clockid_t clock;
+   int i;
+   if (pthread_getcpuclockid(pthread_self(), &clock) != 0)
+      return -1;
+   i = __atomic_fetch_add(&numLibiprClocks, 1, __ATOMIC_RELAXED);
+   if (i >= 2)
+      return -1;
+   libiprClocks[i] = clock;
+   return i;
+}
+
+// keep the CPU time of a thread that is exiting (its clock goes away);
+// slot points to its slot, so this can be a thread cleanup handler
+static void retireLibiprClock(void *slot)
+{
+   struct timespec t;
+   int i = *(int*) slot;
+   if (i < 0 || clock_gettime(libiprClocks[i], &t) != 0)
+      return;
+   retiredCpu[i] = t.tv_sec + t.tv_nsec / 1e9;
+   retiredClocks[i] = 1;
+}
+
+//
+// Function pointer for write_gmon hidden C library function
+//  
+void (*write_gmon)(void) = NULL;
+
+// tried to use monstartup to reinitialize data after moncleanup was
+// called, but this totally failed, just kept segfaulting. So back to
+// trying to find write_gmon(), which does work all by itself
+//void (*gmon_start)(void) = NULL;
+// for monstartup
+//void (*gmon_start)(unsigned long lowpc, unsigned long highpc) = NULL;
+
+//
+// Gprof's runtime profiling state: the hidden _gmonparam structure in
+// the C library, which holds the histogram (kcount) and arc tables that
+// write_gmon() writes out
+//
+struct gmonparam *gmonParam = NULL;
+extern int __profile_frequency(void);
+
+//
+// Find _gmonparam from the code of moncontrol(), which starts by
+// checking the profiling state (the first field of _gmonparam): take
+// the first RIP-relative operand that points to a plausible gmonparam
+// inside the C library
+// - before profiling starts (our constructor runs before the program's
+//   __gmon_start__) _gmonparam is all zero except state GMON_PROF_OFF
+//
+static int plausibleGmonParam(struct gmonparam *p, void *libBase)
+{
+   Dl_info info;
+   if (!dladdr(p, &info) || info.dli_fbase != libBase)
+      return 0;
+   if (p->state < GMON_PROF_ON || p->state > GMON_PROF_OFF)
+      return 0;
+   if (p->kcount == NULL)
+      return p->state == GMON_PROF_OFF && p->kcountsize == 0;
+   return p->lowpc < p->highpc && p->textsize == p->highpc - p->lowpc;
+}
+
+static struct gmonparam* findGmonParam(unsigned char *code)
+{
+   Dl_info info;
+   int i, dpos, len;
+   int disp;
+   struct gmonparam *p;
+   if (!dladdr(code, &info))
+      return NULL;
+   for (i=0; i < 64; i++) {
+      dpos = len = 0;
+      if (code[i] == 0x48 && code[i+1] == 0x83 && code[i+2] == 0x3d) {
+         dpos = 3; len = 8;   // cmpq $imm8,disp(%rip)
+      } else if (code[i] == 0x48 && (code[i+1] == 0x8b || code[i+1] == 0x8d)
+                 && (code[i+2] & 0xc7) == 0x05) {
+         dpos = 3; len = 7;   // movq/leaq disp(%rip),%reg
+      } else if (code[i] == 0x83 && code[i+1] == 0x3d) {
+         dpos = 2; len = 7;   // cmpl $imm8,disp(%rip)
+      }
+      if (len == 0)
+         continue;
+      memcpy(&disp, code+i+dpos, sizeof(disp));
+      p = (struct gmonparam*) (code + i + len + disp);
+      if (plausibleGmonParam(p, info.dli_fbase))
+         return p;
+   }
+   return NULL;
+}
+
+//
+// Find write_gmon() when IPR_GMONOFFSET is not given: the hidden
+// function is the code just before moncontrol() in the C library
+// - a write_gmon symbol in the library's .symtab, or in its separate
+//   debug file (/usr/lib/debug/.build-id/xx/yyyy.debug), is used if
+//   there is one
+// - else write_gmon is the first function prologue after the end of
+//   the last exported (.dynsym) function before moncontrol
+// - else the code before moncontrol is scanned back for a 16-byte
+//   aligned function prologue right after the end of another function
+// - the offset found is cached per C library build-id, in the file
+//   gmonoffset-<build-id> of IPR_CACHEDIR (default $HOME/.cache/libipr),
+//   so later runs do not search again; an offset from the code (not
+//   a write_gmon symbol) is cached only if _mcleanup() calls it
+//
+#define GMON_SCAN_WINDOW 16384
+struct buildIdSearch {
+   unsigned long base;   // load address of the library to look for
+   char *hex;            // its build-id, in hex
+   size_t len;
+};
+
+// build-id from the PT_NOTE segments of the library at search->base
+static int findBuildId(struct dl_phdr_info *info, size_t size, void *data)
+{
+   struct buildIdSearch *search = (struct buildIdSearch*) data;
+   ElfW(Nhdr) *note;
+   char *p, *end;
+   unsigned int i;
+   int j;
+   if (info->dlpi_addr != search->base)
+      return 0;
+   for (j=0; j < info->dlpi_phnum; j++) {
+      if (info->dlpi_phdr[j].p_type != PT_NOTE)
+         continue;
+      p = (char*) (info->dlpi_addr + info->dlpi_phdr[j].p_vaddr);
+      end = p + info->dlpi_phdr[j].p_memsz;
+      while (p + sizeof(*note) <= end) {
+         note = (ElfW(Nhdr)*) p;
+         p += sizeof(*note) + ((note->n_namesz + 3) & ~3);
+         if (note->n_type == NT_GNU_BUILD_ID && note->n_namesz == 4 &&
+             !memcmp(note+1, "GNU", 4) && 2*note->n_descsz < search->len) {
+            for (i=0; i < note->n_descsz; i++)
+               sprintf(search->hex + 2*i, "%02x", (unsigned char) p[i]);
+            return 1;
+         }
+         p += (note->n_descsz + 3) & ~3;
+      }
+   }
+   return 1;
+}
+
+//
+// Look through the symbol tables of an ELF file (the C library or its
+// debug file) for write_gmon, and for the end of the last function
+// that ends before monAddr (addresses are the file's, that is,
+// relative to the load address)
+// - returns 1 and the address in *wrAddr if write_gmon is found
+//
+static int searchSymbols(const char *path, unsigned long monAddr,
+                         unsigned long *wrAddr, unsigned long *prevEnd)
+{
+   int fd, found = 0;
+   struct stat st;
+   char *data;
+   ElfW(Ehdr) *ehdr;
+   ElfW(Shdr) *shdr;
+   ElfW(Sym) *sym;
+   unsigned long i, n, end;
+   int j;
+   fd = open(path, O_RDONLY|O_CLOEXEC);
+   if (fd < 0)
+      return 0;
+   if (fstat(fd, &st) != 0 || st.st_size < sizeof(*ehdr)) {
+      close(fd);
+      return 0;
+   }
+   data = (char*) mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+   close(fd);
+   if (data == MAP_FAILED)
+      return 0;
+   ehdr = (ElfW(Ehdr)*) data;
+   if (memcmp(ehdr->e_ident, ELFMAG, SELFMAG) ||
+       ehdr->e_shentsize != sizeof(*shdr) ||
+       ehdr->e_shoff + ehdr->e_shnum*sizeof(*shdr) > st.st_size) {
+      munmap(data, st.st_size);
+      return 0;
+   }
+   shdr = (ElfW(Shdr)*) (data + ehdr->e_shoff);
+   for (j=0; j < ehdr->e_shnum && !found; j++) {
+      if ((shdr[j].sh_type != SHT_SYMTAB && shdr[j].sh_type != SHT_DYNSYM) ||
+          shdr[j].sh_link >= ehdr->e_shnum ||
+          shdr[j].sh_offset + shdr[j].sh_size > st.st_size ||
+          shdr[shdr[j].sh_link].sh_offset +
+          shdr[shdr[j].sh_link].sh_size > st.st_size)
+         continue;
+      sym = (ElfW(Sym)*) (data + shdr[j].sh_offset);
+      n = shdr[j].sh_size / sizeof(*sym);
+      for (i=0; i < n; i++) {
+         if (ELF64_ST_TYPE(sym[i].st_info) != STT_FUNC ||
+             sym[i].st_shndx == SHN_UNDEF)
+            continue;
+         if (sym[i].st_name < shdr[shdr[j].sh_link].sh_size &&
+             !strcmp(data + shdr[shdr[j].sh_link].sh_offset + sym[i].st_name,
+                     "write_gmon")) {
+            *wrAddr = sym[i].st_value;
+            found = 1;
+            break;
+         }
+         end = sym[i].st_value + sym[i].st_size;
+         if (sym[i].st_size > 0 && end <= monAddr && end > *prevEnd)
+            *prevEnd = end;
+      }
+   }
+   munmap(data, st.st_size);
+   return found;
+}
+
+//
+// Check for a function start at code: a common x86 prologue
+// instruction (endbr, push of a frame or callee-saved register, stack
+// allocation); other architectures trust the symbol tables
+//
+static int isPrologue(unsigned char *code)
+{
+#if defined(__x86_64__) || defined(__i386__)
+   if (code[0] == 0xf3 && code[1] == 0x0f && code[2] == 0x1e &&
+       (code[3] == 0xfa || code[3] == 0xfb))
+      return 1;   // endbr64/endbr32
+   if (code[0] == 0x55 || code[0] == 0x53 || code[0] == 0x56 ||
+       code[0] == 0x57)
+      return 1;   // push %rbp/%rbx/%rsi/%rdi
+   if (code[0] == 0x41 && code[1] >= 0x54 && code[1] <= 0x57)
+      return 1;   // push %r12-%r15
+   if (code[0] == 0x48 && (code[1] == 0x83 || code[1] == 0x81) &&
+       code[2] == 0xec)
+      return 1;   // sub $n,%rsp
+   if ((code[0] == 0x83 || code[0] == 0x81) && code[1] == 0xec)
+      return 1;   // sub $n,%esp
+   return 0;
+#else
+   return 1;
+#endif
+}
+
+//
+// Check that the byte before code can end a function or its padding:
+// ret, int3, nop, or the zero bytes that end multi-byte nops
+//
+static int followsFunctionEnd(unsigned char *code)
+{
+   return code[-1] == 0xc3 || code[-1] == 0xcc || code[-1] == 0x90 ||
+          code[-1] == 0x00;
+}
+
+//
+// Check a write_gmon address that was found in the code rather than
+// from a symbol: _mcleanup(), which is exported, calls write_gmon near
+// its start, so the address must be the target of one of its first
+// direct calls
+//
+static int calledFromMcleanup(unsigned char *code)
+{
+#if defined(__x86_64__) || defined(__i386__)
+   unsigned char *mc = (unsigned char*) dlsym(0, "_mcleanup");
+   int i, disp;
+   if (mc == NULL)
+      return 0;
+   for (i=0; i < 128; i++) {
+      if (mc[i] != 0xe8)
+         continue;   // call rel32
+      memcpy(&disp, mc+i+1, sizeof(disp));
+      if (mc + i + 5 + disp == code)
+         return 1;
+   }
+#endif
+   return 0;
+}
+
+//
+// Search the C library for write_gmon (see above)
+// - returns its address, or NULL if not found; *fromSymbol is set if
+//   the address is that of a write_gmon symbol
+//
+static unsigned char* searchGmonWriter(unsigned char *monCode, Dl_info *info,
+                                       const char *buildId, int *fromSymbol)
+{
+   char path[256];
+   unsigned char *base = (unsigned char*) info->dli_fbase;
+   unsigned char *code;
+   unsigned long monAddr = monCode - base;
+   unsigned long wrAddr = 0, prevEnd = 0;
+   *fromSymbol = 1;
+   if (searchSymbols(info->dli_fname, monAddr, &wrAddr, &prevEnd))
+      return base + wrAddr;
+   if (buildId[0] && buildId[1]) {
+      snprintf(path, sizeof(path), "/usr/lib/debug/.build-id/%c%c/%s.debug",
+               buildId[0], buildId[1], buildId+2);
+      if (searchSymbols(path, monAddr, &wrAddr, &prevEnd))
+         return base + wrAddr;
+   }
+   *fromSymbol = 0;
+   if (prevEnd > 0 && monAddr - prevEnd < GMON_SCAN_WINDOW) {
+      for (code = base + ((prevEnd + 15) & ~15UL); code < monCode; code += 16)
+         if (isPrologue(code))
+            return code;
+      return NULL;
+   }
+   for (code = (unsigned char*) ((unsigned long) monCode & ~15UL) - 16;
+        code > monCode - GMON_SCAN_WINDOW; code -= 16)
+      if (isPrologue(code) && followsFunctionEnd(code))
+         return code;
+   return NULL;
+}
+
+//
+// Find the offset of write_gmon from moncontrol, from the cache or by
+// searching the C library
+// - returns 0 if not found
+//
+static long findGmonOffset(unsigned char *monCode)
+{
+   Dl_info info;
+   char hex[128] = "";
+   char dir[200], fname[400], tmpname[420];
+   struct buildIdSearch search;
+   unsigned char *wrCode;
+   char *paramstr, *home;
+   long offset = 0;
+   int fromSymbol;
+   FILE *f;
+   if (monCode == NULL || !dladdr(monCode, &info) || info.dli_fname == NULL)
+      return 0;
+   search.base = (unsigned long) info.dli_fbase;
+   search.hex = hex;
+   search.len = sizeof(hex);
+   dl_iterate_phdr(findBuildId, &search);
+   // cached offset for this C library
+   dir[0] = 0;
+   paramstr = getenv("IPR_CACHEDIR");
+   home = getenv("HOME");
+   if (paramstr && strlen(paramstr) < sizeof(dir))
+      strcpy(dir, paramstr);
+   else if (!paramstr && home && strlen(home) < sizeof(dir)-16)
+      sprintf(dir, "%s/.cache/libipr", home);
+   if (hex[0] && dir[0]) {
+      sprintf(fname, "%s/gmonoffset-%s", dir, hex);
+      f = fopen(fname, "r");
+      if (f) {
+         if (fscanf(f, "%ld", &offset) != 1)
+            offset = 0;
+         fclose(f);
+         if (offset < 0 && offset > -GMON_SCAN_WINDOW) {
+            if (debug)
+               fprintf(stderr, "libipr: write_gmon offset %ld from %s\n",
+                       offset, fname);
+            return offset;
+         }
+         offset = 0;
+      }
+   }
+   wrCode = searchGmonWriter(monCode, &info, hex, &fromSymbol);
+   if (wrCode == NULL)
+      return 0;
+   offset = wrCode - monCode;
+   if (debug)
+      fprintf(stderr, "libipr: found write_gmon at offset %ld in %s\n",
+              offset, info.dli_fname);
+   // a guess from the code would be trusted by every later run, so it
+   // is not cached unless _mcleanup() confirms it
+   if (!fromSymbol && !calledFromMcleanup(wrCode)) {
+      if (debug)
+         fprintf(stderr, "libipr: write_gmon offset %ld not confirmed, "
+                 "not cached\n", offset);
+      return offset;
+   }
+   if (hex[0] && dir[0]) {
+      // write the cache file under a temporary name, so that processes
+      // starting together never read a partial file
+      if (!paramstr) {
+         sprintf(tmpname, "%s/.cache", home);
+         mkdir(tmpname, 0755);
+      }
+      mkdir(dir, 0755);
+      sprintf(tmpname, "%s.%d", fname, getpid());
+      f = fopen(tmpname, "w");
+      if (f) {
+         fprintf(f, "%ld\n", offset);
+         if (fclose(f) != 0 || rename(tmpname, fname) != 0)
+            unlink(tmpname);
+      }
+   }
+   return offset;
+}
+
+//
+// Deltas of the profiling data since the previous interval, read
+// straight from _gmonparam
+// - histDeltas are the (bucket index, count) of the nonzero histogram
+//   deltas, arcDeltas the (frompc, selfpc, count) of the nonzero arc
+//   deltas; PCs are relative to the program's load address, as
+//   write_gmon() writes them
+// - the previous counts are kept in prevKcount and prevArcCounts (the
+//   latter indexed like the tos arc table, whose entries never move)
+//
+struct histDelta {
+   unsigned int index;
+   unsigned int count;
+};
+struct arcDelta {
+   unsigned long frompc;
+   unsigned long selfpc;
+   long count;
+};
+static unsigned long textLow, textSize, loadAddress;
+static unsigned long numBuckets, numTos;
+static unsigned short *prevKcount = NULL;
+static long *prevArcCounts = NULL;
+static struct histDelta *histDeltas = NULL;
+static unsigned long numHistDeltas;
+static struct arcDelta *arcDeltas = NULL;
+static unsigned long numArcDeltas;
+
+// load address of the program, the first object dl_iterate_phdr sees
+static int findLoadAddress(struct dl_phdr_info *info, size_t size, void *data)
+{
+   *(unsigned long*) data = info->dlpi_addr;
+   return 1;
+}
+
+//
+// Set up the delta buffers, once profiling has started
+//
+static int initDeltas()
+{
+   numBuckets = gmonParam->kcountsize / sizeof(*gmonParam->kcount);
+   numTos = gmonParam->tossize / sizeof(*gmonParam->tos);
+   prevKcount = (unsigned short*) calloc(numBuckets, sizeof(*prevKcount));
+   histDeltas = (struct histDelta*) malloc(numBuckets*sizeof(*histDeltas));
+   prevArcCounts = (long*) calloc(numTos, sizeof(*prevArcCounts));
+   arcDeltas = (struct arcDelta*) malloc(numTos*sizeof(*arcDeltas));
+   if (!prevKcount || !histDeltas || !prevArcCounts || !arcDeltas)
+      return -1;
+   textLow = gmonParam->lowpc;
+   textSize = gmonParam->textsize;
+   dl_iterate_phdr(findLoadAddress, &loadAddress);
+   return 0;
+}
+
+//
+// Take the histogram deltas of this interval
+// - returns the number of samples, -1 if profiling is not running (not
+//   started yet, or stopped at exit, when the histogram gets freed)
+//
+static long takeHistogramDelta()
+{
+   unsigned long i;
+   unsigned short delta;
+   long total = 0;
+   if (gmonParam->kcount == NULL || (gmonParam->state != GMON_PROF_ON &&
+                                     gmonParam->state != GMON_PROF_BUSY))
+      return -1;
+   if (prevKcount == NULL && initDeltas() != 0)
+      return -1;
+   numHistDeltas = 0;
+   for (i=0; i < numBuckets; i++) {
+      if (gmonParam->kcount[i] == prevKcount[i])
+         continue;
+      // counters can wrap around, the difference is still right
+      delta = gmonParam->kcount[i] - prevKcount[i];
+      prevKcount[i] += delta;
+      histDeltas[numHistDeltas].index = i;
+      histDeltas[numHistDeltas].count = delta;
+      numHistDeltas++;
+      total += delta;
+   }
+   return total;
+}
+
+//
+// Take the arc deltas of this interval, walking the arc tables as
+// write_gmon() does
+//
+static void takeArcDelta()
+{
+   unsigned long fromIndex, fromLen, frompc;
+   long toIndex, count;
+   numArcDeltas = 0;
+   fromLen = gmonParam->fromssize / sizeof(*gmonParam->froms);
+   for (fromIndex=0; fromIndex < fromLen; fromIndex++) {
+      if (gmonParam->froms[fromIndex] == 0)
+         continue;
+      frompc = gmonParam->lowpc + fromIndex * gmonParam->hashfraction *
+               sizeof(*gmonParam->froms);
+      for (toIndex = gmonParam->froms[fromIndex]; toIndex != 0;
+           toIndex = gmonParam->tos[toIndex].link) {
+         if (toIndex >= numTos || numArcDeltas >= numTos)
+            return;
+         count = gmonParam->tos[toIndex].count - prevArcCounts[toIndex];
+         if (count == 0)
+            continue;
+         prevArcCounts[toIndex] += count;
+         arcDeltas[numArcDeltas].frompc = frompc - loadAddress;
+         arcDeltas[numArcDeltas].selfpc = gmonParam->tos[toIndex].selfpc -
+                                          loadAddress;
+         arcDeltas[numArcDeltas].count = count;
+         numArcDeltas++;
+      }
+   }
+}
+
+//
+// Online phase detection
+// - the histogram delta of each interval is summed into PHASE_DIMS
+//   equal address ranges of the profiled text, as fractions of the
+//   interval's samples
+// - an interval belongs to the closest phase (centroid) if within
+//   phaseDist (manhattan distance), else it starts a new phase; the
+//   phase centroid is the running mean of its intervals
+// - each interval's phase is written to the timeline file
+//   ipr-phases.<pid>, one line per interval: interval number, phase
+//   (-1 if no samples), distance to the phase, number of samples
+//
+#define PHASE_DIMS 256
+static int doPhases = 0;
+static double phaseDist = 0.5;
+static int maxPhases = 16;
+static int numPhases = 0;
+static double *phaseCentroids = NULL;
+static long *phaseSizes = NULL;
+static FILE *phaseFile = NULL;
+
+//
+// Set up phase detection: open the timeline file and allocate centroids
+//
+static int openPhaseFile();
+static int initPhases()
+{
+   char *paramstr;
+   paramstr = getenv("IPR_PHASEDIST");
+   if (paramstr)
+      phaseDist = strtod(paramstr,0);
+   paramstr = getenv("IPR_MAXPHASES");
+   if (paramstr)
+      maxPhases = strtol(paramstr,0,0);
+   if (maxPhases < 1)
+      maxPhases = 1;
+   phaseCentroids = (double*) calloc(maxPhases*PHASE_DIMS, sizeof(double));
+   phaseSizes = (long*) calloc(maxPhases, sizeof(long));
+   if (!phaseCentroids || !phaseSizes)
+      return -1;
+   return openPhaseFile();
+}
+
+//
+// Open the timeline file (of this process)
+//
+static int openPhaseFile()
+{
+   char fname[sizeof(dataDirname)+32];
+   sprintf(fname,"%sipr-phases.%d",dataDirname,getpid());
+   phaseFile = fopen(fname,"w");
+   if (!phaseFile)
+      return -1;
+   fprintf(phaseFile,"# libipr phase timeline: distance %g, max phases %d, "
+           "%d address ranges\n", phaseDist, maxPhases, PHASE_DIMS);
+   fprintf(phaseFile,"# interval phase distance samples\n");
+   fflush(phaseFile);
+   return 0;
+}
+
+//
+// Sum the histogram deltas into address ranges
+// - vec gets the fraction of the samples in each range
+//
+static void phaseVector(double *vec, long samples)
+{
+   unsigned long i;
+   memset(vec, 0, PHASE_DIMS*sizeof(*vec));
+   for (i=0; i < numHistDeltas; i++)
+      vec[(unsigned long) histDeltas[i].index * PHASE_DIMS / numBuckets] +=
+         histDeltas[i].count;
+   for (i=0; samples > 0 && i < PHASE_DIMS; i++)
+      vec[i] /= samples;
+}
+
+//
+// Assign an interval vector to a phase and update that phase
+// - returns the phase number and its distance in *dist
+//
+static int assignPhase(double *vec, double *dist)
+{
+   int p, i, best = -1;
+   double d, bestd = 0;
+   double *c;
+   for (p=0; p < numPhases; p++) {
+      c = phaseCentroids + p*PHASE_DIMS;
+      d = 0;
+      for (i=0; i < PHASE_DIMS; i++)
+         d += (vec[i] > c[i]) ? vec[i] - c[i] : c[i] - vec[i];
+      if (best < 0 || d < bestd) {
+         best = p;
+         bestd = d;
+      }
+   }
+   if ((best < 0 || bestd > phaseDist) && numPhases < maxPhases) {
+      best = numPhases++;
+      bestd = 0;
+   }
+   // running mean of the phase's intervals
+   phaseSizes[best]++;
+   c = phaseCentroids + best*PHASE_DIMS;
+   for (i=0; i < PHASE_DIMS; i++)
+      c[i] += (vec[i] - c[i]) / phaseSizes[best];
+   *dist = bestd;
+   return best;
+}
+
+//
+// Do phase detection for one interval (whose histogram deltas have
+// been taken) and add it to the timeline
+//
+static void recordPhase(int sampleNum, long samples)
+{
+   double vec[PHASE_DIMS];
+   double dist = 0;
+   int phase = -1;
+   if (samples > 0) {
+      phaseVector(vec, samples);
+      phase = assignPhase(vec, &dist);
+   }
+   fprintf(phaseFile,"%d %d %.3f %ld\n", sampleNum, phase, dist, samples);
+   fflush(phaseFile);
+}
+
+//
+// Finish the timeline with a summary of each phase: number of intervals
+// and the address range where it spends the most time
+//
+static void finishPhases()
+{
+   int p, i, maxi;
+   unsigned long rangeSize;
+   double *c;
+   if (!phaseFile)
+      return;
+   rangeSize = (textSize + PHASE_DIMS - 1) / PHASE_DIMS;
+   for (p=0; p < numPhases; p++) {
+      c = phaseCentroids + p*PHASE_DIMS;
+      maxi = 0;
+      for (i=1; i < PHASE_DIMS; i++)
+         if (c[i] > c[maxi])
+            maxi = i;
+      fprintf(phaseFile,"# phase %d: %ld intervals, %.0f%% in 0x%lx-0x%lx\n",
+              p, phaseSizes[p], c[maxi]*100,
+              textLow + maxi*rangeSize, textLow + (maxi+1)*rangeSize);
+   }
+   fclose(phaseFile);
+   phaseFile = NULL;
+}
+
+//
+// Adaptive interval: each interval's histogram delta is summed into
+// address ranges as for phase detection and compared with the mean of
+// the intervals since the profile last changed (manhattan distance,
+// 0-2); if they differ by more than adaptDist the profile is changing
+// and the next interval is halved, if by less than a quarter of that
+// it is steady and the next interval is a quarter longer, staying
+// within [minInterval,maxInterval]
+// - the sampling noise of a short interval's histogram alone makes it
+//   differ from the mean, so the distance allowed is adaptDist plus
+//   twice the noise expected for the interval's number of samples (the
+//   sum of the standard deviations of the range fractions); with fewer
+//   than ADAPT_MINSAMPLES samples the next interval is made longer
+// - the length of each interval is in the times file (ipr-times.<pid>)
+//
+#define ADAPT_MINSAMPLES 16
+static int adaptive = 0;
+static double adaptDist = 0.2;
+static long long minInterval, maxInterval;   // nanoseconds
+static double *adaptMean = NULL;
+static long adaptSamples = 0;   // samples in adaptMean
+
+//
+// Set up the adaptive interval around the configured interval
+//
+static int initAdaptive(long long interval)
+{
+   char *paramstr;
+   minInterval = interval / 4;
+   maxInterval = interval * 4;
+   paramstr = getenv("IPR_MININTERVAL");
+   if (paramstr)
+      minInterval = strtoll(paramstr,0,0) * 1000LL;
+   paramstr = getenv("IPR_MAXINTERVAL");
+   if (paramstr)
+      maxInterval = strtoll(paramstr,0,0) * 1000LL;
+   paramstr = getenv("IPR_ADAPTDIST");
+   if (paramstr)
+      adaptDist = strtod(paramstr,0);
+   if (minInterval < 1000000)   // 1 ms
+      minInterval = 1000000;
+   if (maxInterval < minInterval)
+      maxInterval = minInterval;
+   adaptMean = (double*) calloc(PHASE_DIMS, sizeof(double));
+   return adaptMean ? 0 : -1;
+}
+
+//
+// Return the length of the next interval, from the histogram delta
+// just taken (samples is its number of samples)
+//
+static long long adaptInterval(long long interval, long samples)
+{
+   double vec[PHASE_DIMS];
+   double dist = 0, noise = 0;
+   int i;
+   if (samples < ADAPT_MINSAMPLES) {
+      interval += interval/4;
+   } else {
+      phaseVector(vec, samples);
+      for (i=0; i < PHASE_DIMS; i++) {
+         dist += (vec[i] > adaptMean[i]) ? vec[i] - adaptMean[i] :
+                                           adaptMean[i] - vec[i];
+         noise += sqrt(adaptMean[i] * (1 - adaptMean[i]) / samples);
+      }
+      if (adaptSamples > 0 && dist > adaptDist + 2*noise) {
+         // changed: start a new mean from this interval
+         interval /= 2;
+         adaptSamples = 0;
+      } else if (dist < adaptDist/4 + 2*noise) {
+         interval += interval/4;
+      }
+      adaptSamples += samples;
+      for (i=0; i < PHASE_DIMS; i++)
+         adaptMean[i] += (vec[i] - adaptMean[i]) * samples / adaptSamples;
+   }
+   if (interval < minInterval)
+      interval = minInterval;
+   if (interval > maxInterval)
+      interval = maxInterval;
+   return interval;
+}
+
+//
+// Delta capture: instead of a complete gmon file per interval, append
+// only the interval's nonzero histogram and arc deltas to one log file,
+// ipr-delta.<pid> (read by gmonread.py)
+// - the log starts with a header (deltaLogHeader), written when
+//   profiling has started, and then has one record per interval: a
+//   deltaLogRecord followed by its histDeltas and arcDeltas
+// - each record is appended with a single write, so a reader never
+//   sees part of a record unless the program died while writing it
+//
+#define CAPTURE_GMON 0
+#define CAPTURE_DELTA 1
+#define DELTALOG_MAGIC "IPRDELTA"
+#define DELTALOG_VERSION 1
+struct deltaLogHeader {
+   char magic[8];
+   unsigned int version;
+   unsigned int ptrSize;      // sizeof(unsigned long) of the program
+   unsigned long lowpc;       // histogram range, as in the gmon header
+   unsigned long highpc;
+   unsigned int numBuckets;   // histogram size
+   int profRate;              // histogram samples per second
+};
+struct deltaLogRecord {
+   unsigned int sample;       // interval (sample) number
+   unsigned int numHist;      // number of histDeltas that follow
+   unsigned int numArcs;      // number of arcDeltas after those
+   unsigned int spare;
+};
+static int captureMode = CAPTURE_GMON;
+static int deltaLogFd = -1;
+static char *deltaRecord = NULL;
+
+//
+// Open the delta log file
+//
+static int initDeltaLog()
+{
+   char fname[sizeof(dataDirname)+32];
+   sprintf(fname,"%sipr-delta.%d",dataDirname,getpid());
+   deltaLogFd = open(fname, O_WRONLY|O_CREAT|O_TRUNC|O_APPEND, 0644);
+   return deltaLogFd < 0 ? -1 : 0;
+}
+
+//
+// Append the deltas of one interval to the delta log
+//
+static void writeDeltaRecord(int sampleNum)
+{
+   struct deltaLogHeader hdr;
+   struct deltaLogRecord *rec;
+   size_t size;
+   if (deltaRecord == NULL) {
+      // first record: profiling has started, so the header is known
+      memset(&hdr, 0, sizeof(hdr));
+      memcpy(hdr.magic, DELTALOG_MAGIC, sizeof(hdr.magic));
+      hdr.version = DELTALOG_VERSION;
+      hdr.ptrSize = sizeof(unsigned long);
+      hdr.lowpc = textLow - loadAddress;
+      hdr.highpc = textLow + textSize - loadAddress;
+      hdr.numBuckets = numBuckets;
+      hdr.profRate = __profile_frequency();
+      if (write(deltaLogFd, &hdr, sizeof(hdr)) != sizeof(hdr))
+         fprintf(stderr, "libipr: error writing delta log header\n");
+      else
+         countBytes(sizeof(hdr));
+      deltaRecord = (char*) malloc(sizeof(*rec) + numBuckets*sizeof(*histDeltas)
+                                   + numTos*sizeof(*arcDeltas));
+      if (deltaRecord == NULL)
+         return;
+   }
+   rec = (struct deltaLogRecord*) deltaRecord;
+   rec->sample = sampleNum;
+   rec->numHist = numHistDeltas;
+   rec->numArcs = numArcDeltas;
+   rec->spare = 0;
+   size = sizeof(*rec);
+   memcpy(deltaRecord+size, histDeltas, numHistDeltas*sizeof(*histDeltas));
+   size += numHistDeltas*sizeof(*histDeltas);
+   memcpy(deltaRecord+size, arcDeltas, numArcDeltas*sizeof(*arcDeltas));
+   size += numArcDeltas*sizeof(*arcDeltas);
+   if (write(deltaLogFd, deltaRecord, size) != size)
+      fprintf(stderr, "libipr: error writing delta log record %d\n", sampleNum);
+   else
+      countBytes(size);
+}
+
+//
+// Sample container: instead of a gmon file per interval, append each
+// interval's gmon data (the same bytes write_gmon() would write, built
+// from _gmonparam) to one file, ipr-samples.<pid> (read by gmonread.py)
+// - the file starts with a containerHeader; each sample is a
+//   containerRecord followed by its gmon data
+// - at the end of the run an index of the samples (one containerIndex
+//   per sample) is appended and its offset put in the header; a reader
+//   can still find the samples by their records if the index is missing
+// - with IPR_COMPRESS, a sample can be stored encoded (the encoding is
+//   in its record and index entry): ENCODE_DELTA data is a series of
+//   (copy length, literal length) unsigned int pairs, each followed by
+//   the literal bytes, that rebuilds the gmon data from the previous
+//   sample's (copy bytes at the same offset, then take the literal
+//   bytes); ENCODE_ZLIB data is zlib-compressed. Every
+//   CONTAINER_KEYFRAME'th sample is stored without ENCODE_DELTA, so a
+//   reader need not decode from the first sample to get at one
+//
+#define CAPTURE_CONTAINER 2
+#define CONTAINER_MAGIC "IPRSAMPL"
+#define CONTAINER_VERSION 1
+#define CONTAINER_KEYFRAME 64
+#define ENCODE_DELTA 1
+#define ENCODE_ZLIB 2
+// unchanged runs shorter than this are left in the literal bytes, as
+// a new run would cost more than it saves
+#define DELTA_MINRUN 16
+struct containerHeader {
+   char magic[8];
+   unsigned int version;
+   unsigned int numSamples;      // set with the index
+   unsigned long long indexOffset;  // 0 until the index is written
+};
+struct containerRecord {
+   unsigned int sample;          // interval (sample) number
+   unsigned int encoding;        // ENCODE_ flags, 0 for plain gmon data
+   unsigned long long size;      // size of the (encoded) data that follows
+};
+struct containerIndex {
+   unsigned int sample;
+   unsigned int encoding;
+   unsigned long long offset;    // file offset of the gmon data
+   unsigned long long size;
+};
+static int containerFd = -1;
+static unsigned long long containerOffset;
+static struct containerIndex *containerSamples = NULL;
+static unsigned int numContainerSamples, maxContainerSamples;
+static char *gmonImage = NULL;
+static size_t gmonImageMax;
+static pthread_mutex_t containerLock = PTHREAD_MUTEX_INITIALIZER;
+static int containerEncoding = 0;   // ENCODE_ flags from IPR_COMPRESS
+static char *prevImage = NULL;      // previous sample's gmon data
+static size_t prevImageSize;
+static char *deltaImage = NULL;     // encoded sample
+static char *zImage = NULL;         // compressed sample
+static unsigned long zImageMax;
+
+//
+// Open the container file and write its header
+//
+static int initContainer()
+{
+   char fname[sizeof(dataDirname)+32];
+   struct containerHeader hdr;
+   sprintf(fname,"%sipr-samples.%d",dataDirname,getpid());
+   containerFd = open(fname, O_WRONLY|O_CREAT|O_TRUNC, 0644);
+   if (containerFd < 0)
+      return -1;
+   memset(&hdr, 0, sizeof(hdr));
+   memcpy(hdr.magic, CONTAINER_MAGIC, sizeof(hdr.magic));
+   hdr.version = CONTAINER_VERSION;
+   if (write(containerFd, &hdr, sizeof(hdr)) != sizeof(hdr))
+      return -1;
+   containerOffset = sizeof(hdr);
+   countBytes(sizeof(hdr));
+   return 0;
+}
+
+//
+// Allocate a buffer for buildGmonImage(), big enough for any profile
+// of this run (that needs profiling to have started)
+// - returns NULL if profiling is not running or out of memory
+//
+static char *newGmonImage()
+{
+   if (gmonParam->kcount == NULL || (gmonParam->state != GMON_PROF_ON &&
+                                     gmonParam->state != GMON_PROF_BUSY))
+      return NULL;
+   if (prevKcount == NULL && initDeltas() != 0)
+      return NULL;
+   gmonImageMax = sizeof(struct gmon_hdr) + 1 + sizeof(struct gmon_hist_hdr) +
+                  gmonParam->kcountsize +
+                  numTos * (1 + sizeof(struct gmon_cg_arc_record));
+   return (char*) malloc(gmonImageMax);
+}
+
+//
+// Build the gmon data of the profile so far in image (from
+// newGmonImage()), the way write_gmon() lays it out: gmon header,
+// histogram record, arc records
+// - returns the size, or 0 if profiling is not running
+//
+static size_t buildGmonImage(char *image)
+{
+   struct gmon_hdr ghdr;
+   struct gmon_hist_hdr hhdr;
+   unsigned long fromIndex, fromLen, frompc, selfpc, pc;
+   long toIndex;
+   int value;
+   char *p;
+   if (gmonParam->kcount == NULL || (gmonParam->state != GMON_PROF_ON &&
+                                     gmonParam->state != GMON_PROF_BUSY))
+      return 0;
+   p = image;
+   memset(&ghdr, 0, sizeof(ghdr));
+   memcpy(ghdr.cookie, GMON_MAGIC, sizeof(ghdr.cookie));
+   value = GMON_VERSION;
+   memcpy(ghdr.version, &value, sizeof(ghdr.version));
+   memcpy(p, &ghdr, sizeof(ghdr));
+   p += sizeof(ghdr);
+   *p++ = GMON_TAG_TIME_HIST;
+   pc = textLow - loadAddress;
+   memcpy(hhdr.low_pc, &pc, sizeof(hhdr.low_pc));
+   pc = textLow + textSize - loadAddress;
+   memcpy(hhdr.high_pc, &pc, sizeof(hhdr.high_pc));
+   value = numBuckets;
+   memcpy(hhdr.hist_size, &value, sizeof(hhdr.hist_size));
+   value = __profile_frequency();
+   memcpy(hhdr.prof_rate, &value, sizeof(hhdr.prof_rate));
+   strncpy(hhdr.dimen, "seconds", sizeof(hhdr.dimen));
+   hhdr.dimen_abbrev = 's';
+   memcpy(p, &hhdr, sizeof(hhdr));
+   p += sizeof(hhdr);
+   memcpy(p, gmonParam->kcount, numBuckets*sizeof(*gmonParam->kcount));
+   p += numBuckets*sizeof(*gmonParam->kcount);
+   fromLen = gmonParam->fromssize / sizeof(*gmonParam->froms);
+   for (fromIndex=0; fromIndex < fromLen; fromIndex++) {
+      if (gmonParam->froms[fromIndex] == 0)
+         continue;
+      frompc = gmonParam->lowpc + fromIndex * gmonParam->hashfraction *
+               sizeof(*gmonParam->froms) - loadAddress;
+      for (toIndex = gmonParam->froms[fromIndex]; toIndex != 0;
+           toIndex = gmonParam->tos[toIndex].link) {
+         if (toIndex >= numTos)
+            break;
+         *p++ = GMON_TAG_CG_ARC;
+         memcpy(p, &frompc, sizeof(frompc));
+         p += sizeof(frompc);
+         selfpc = gmonParam->tos[toIndex].selfpc - loadAddress;
+         memcpy(p, &selfpc, sizeof(selfpc));
+         p += sizeof(selfpc);
+         value = gmonParam->tos[toIndex].count;
+         memcpy(p, &value, sizeof(value));
+         p += sizeof(value);
+      }
+   }
+   return p - image;
+}
+
+//
+// Encode the gmon data in image as the runs that differ from
+// prevImage, in deltaImage (see ENCODE_DELTA above)
+// - a pair starts only after an unchanged run of DELTA_MINRUN bytes,
+//   so the encoding is at most 8 bytes longer than the data
+// - returns the encoded size
+//
+static size_t encodeDelta(char *image, size_t size)
+{
+   size_t pos = 0, out = 0, limit, start, same;
+   unsigned int run[2];
+   limit = size < prevImageSize ? size : prevImageSize;
+   while (pos < size) {
+      // bytes the same as in the previous sample, a word at a time first
+      start = pos;
+      while (pos+8 <= limit && !memcmp(image+pos, prevImage+pos, 8))
+         pos += 8;
+      while (pos < limit && image[pos] == prevImage[pos])
+         pos++;
+      run[0] = pos - start;
+      // changed bytes, up to the next long enough unchanged run
+      start = pos;
+      while (pos < size) {
+         for (same = pos; same < limit && same-pos < DELTA_MINRUN &&
+                          image[same] == prevImage[same]; same++)
+            ;
+         if (same-pos == DELTA_MINRUN || same == size)
+            break;
+         pos = same + 1;
+      }
+      run[1] = pos - start;
+      memcpy(deltaImage+out, run, sizeof(run));
+      out += sizeof(run);
+      memcpy(deltaImage+out, image+start, run[1]);
+      out += run[1];
+   }
+   return out;
+}
+
+//
+// Encode the gmon data in image as containerEncoding says
+// - sets *data to the bytes to write and returns their size, or 0
+//   (and *encoding 0) to write the gmon data as it is
+//
+static size_t encodeSample(char *image, size_t size, char **data,
+                           unsigned int *encoding)
+{
+   unsigned long zsize;
+   *encoding = 0;
+   if (containerEncoding == 0)
+      return 0;
+   if (prevImage == NULL) {
+      prevImage = (char*) malloc(gmonImageMax);
+      deltaImage = (char*) malloc(gmonImageMax + 2*sizeof(unsigned int));
+      zImageMax = compressBound(gmonImageMax + 2*sizeof(unsigned int));
+      zImage = (char*) malloc(zImageMax);
+      if (prevImage == NULL || deltaImage == NULL || zImage == NULL) {
+         containerEncoding = 0;
+         return 0;
+      }
+      prevImageSize = 0;
+   }
+   *data = image;
+   if (prevImageSize > 0 && numContainerSamples % CONTAINER_KEYFRAME != 0) {
+      size = encodeDelta(image, size);
+      *data = deltaImage;
+      *encoding |= ENCODE_DELTA;
+   }
+   if (containerEncoding & ENCODE_ZLIB) {
+      zsize = zImageMax;
+      if (compress2((Bytef*) zImage, &zsize, (Bytef*) *data, size, 1) == Z_OK) {
+         size = zsize;
+         *data = zImage;
+         *encoding |= ENCODE_ZLIB;
+      }
+   }
+   return size;
+}
+
+//
+// Append the gmon data of one interval (in *image, gmonSize bytes) to
+// the container
+// - with an encoding, *image is swapped with prevImage, for the next
+//   sample to be encoded against
+//
+static void storeContainerSample(int sampleNum, char **image, size_t gmonSize)
+{
+   struct containerRecord rec;
+   struct containerIndex *grown;
+   size_t size;
+   char *data = NULL;
+   char *swap;
+   unsigned int encoding;
+   pthread_mutex_lock(&containerLock);
+   if (containerFd < 0 || gmonSize == 0) {
+      pthread_mutex_unlock(&containerLock);
+      return;
+   }
+   size = encodeSample(*image, gmonSize, &data, &encoding);
+   if (size == 0) {
+      size = gmonSize;
+      data = *image;
+   }
+   if (numContainerSamples == maxContainerSamples) {
+      maxContainerSamples = maxContainerSamples ? 2*maxContainerSamples : 1024;
+      grown = (struct containerIndex*) realloc(containerSamples,
+                         maxContainerSamples*sizeof(*containerSamples));
+      if (grown == NULL) {
+         pthread_mutex_unlock(&containerLock);
+         return;
+      }
+      containerSamples = grown;
+   }
+   rec.sample = sampleNum;
+   rec.encoding = encoding;
+   rec.size = size;
+   if (write(containerFd, &rec, sizeof(rec)) != sizeof(rec) ||
+       write(containerFd, data, size) != size) {
+      fprintf(stderr, "libipr: error writing sample %d\n", sampleNum);
+      // start over at the end of the last good sample
+      lseek(containerFd, containerOffset, SEEK_SET);
+      pthread_mutex_unlock(&containerLock);
+      return;
+   }
+   containerSamples[numContainerSamples].sample = sampleNum;
+   containerSamples[numContainerSamples].encoding = encoding;
+   containerSamples[numContainerSamples].offset = containerOffset + sizeof(rec);
+   containerSamples[numContainerSamples].size = size;
+   numContainerSamples++;
+   containerOffset += sizeof(rec) + size;
+   countBytes(sizeof(rec) + size);
+   if (containerEncoding) {
+      // this sample is what the next one is encoded against
+      swap = prevImage;
+      prevImage = *image;
+      *image = swap;
+      prevImageSize = gmonSize;
+   }
+   pthread_mutex_unlock(&containerLock);
+}
+
+//
+// Build the gmon data of one interval and append it to the container
+// (without the writer thread)
+//
+static void writeContainerSample(int sampleNum)
+{
+   if (gmonImage == NULL)
+      gmonImage = newGmonImage();
+   if (gmonImage != NULL)
+      storeContainerSample(sampleNum, &gmonImage, buildGmonImage(gmonImage));
+}
+
+//
+// Write the container's index and close it
+//
+static void finishContainer()
+{
+   struct containerHeader hdr;
+   size_t size;
+   pthread_mutex_lock(&containerLock);
+   if (containerFd < 0) {
+      pthread_mutex_unlock(&containerLock);
+      return;
+   }
+   size = numContainerSamples * sizeof(*containerSamples);
+   if (write(containerFd, containerSamples, size) == size) {
+      memset(&hdr, 0, sizeof(hdr));
+      memcpy(hdr.magic, CONTAINER_MAGIC, sizeof(hdr.magic));
+      hdr.version = CONTAINER_VERSION;
+      hdr.numSamples = numContainerSamples;
+      hdr.indexOffset = containerOffset;
+      if (pwrite(containerFd, &hdr, sizeof(hdr), 0) != sizeof(hdr))
+         fprintf(stderr, "libipr: error writing sample index\n");
+      countBytes(size);
+   }
+   close(containerFd);
+   containerFd = -1;
+   pthread_mutex_unlock(&containerLock);
+}
+
+//
+// Writer thread: the sampler thread only builds each interval's gmon
+// data (from _gmonparam) in one of WRITE_BUFFERS buffers, and this
+// thread writes it out, to a gmon file or to the container, so slow
+// storage delays the writes and not the sampling
+// - the sampler has to wait only if the writer is all the buffers behind
+// - on by default when _gmonparam is found; IPR_ASYNC=0 turns it off
+//
+#define WRITE_BUFFERS 2
+struct writeBuffer {
+   char *image;      // gmon data, from newGmonImage()
+   size_t size;
+   int sample;       // interval (sample) number
+   int full;         // waiting to be written
+};
+static int asyncWrite = 1;
+static struct writeBuffer writeBuffers[WRITE_BUFFERS];
+static int nextFill, nextWrite;
+static pthread_t writerThread;
+static pthread_mutex_t writeLock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t writeReady = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t writeDone = PTHREAD_COND_INITIALIZER;
+static int writerStop = 0;
+
+//
+// Write gmon data to the file write_gmon() would have written for the
+// sample, gmon-<sample>.<pid> in the data directory
+//
+static void writeGmonFile(int sampleNum, char *image, size_t size)
+{
+   char fname[sizeof(dataDirname)+48];
+   int fd;
+   sprintf(fname,"%sgmon-%d.%d",dataDirname,sampleNum,getpid());
+   fd = open(fname, O_WRONLY|O_CREAT|O_TRUNC|O_NOFOLLOW|O_CLOEXEC, 0666);
+   if (fd < 0 || write(fd, image, size) != size)
+      fprintf(stderr, "libipr: error writing %s\n", fname);
+   else
+      countBytes(size);
+   if (fd >= 0)
+      close(fd);
+}
+
+//
+// Build the gmon data of one interval in the next free buffer and hand
+// it to the writer thread
+//
+static void queueSample(int sampleNum)
+{
+   struct writeBuffer *buf = &writeBuffers[nextFill];
+   pthread_mutex_lock(&writeLock);
+   if (buf->full && debug)
+      fprintf(stderr, "libipr: waiting for the writer thread\n");
+   while (buf->full)
+      pthread_cond_wait(&writeDone, &writeLock);
+   pthread_mutex_unlock(&writeLock);
+   if (buf->image == NULL)
+      buf->image = newGmonImage();
+   if (buf->image == NULL)
+      return;
+   buf->size = buildGmonImage(buf->image);
+   if (buf->size == 0)
+      return;
+   buf->sample = sampleNum;
+   pthread_mutex_lock(&writeLock);
+   buf->full = 1;
+   nextFill = (nextFill+1) % WRITE_BUFFERS;
+   pthread_cond_signal(&writeReady);
+   pthread_mutex_unlock(&writeLock);
+}
+
+//
+// Writer thread: write out the buffers in the order they were filled
+//
+static void* libiprWriter(void *arg)
+{
+   struct writeBuffer *buf;
+   long long start;
+   int clockSlot = addLibiprClock();
+   while (1) {
+      pthread_mutex_lock(&writeLock);
+      while (!writeBuffers[nextWrite].full && !writerStop)
+         pthread_cond_wait(&writeReady, &writeLock);
+      if (!writeBuffers[nextWrite].full) {
+         // stopped, and all written out
+         pthread_mutex_unlock(&writeLock);
+         break;
+      }
+      buf = &writeBuffers[nextWrite];
+      pthread_mutex_unlock(&writeLock);
+      start = monotonicNanos();
+      if (captureMode == CAPTURE_CONTAINER)
+         storeContainerSample(buf->sample, &buf->image, buf->size);
+      else
+         writeGmonFile(buf->sample, buf->image, buf->size);
+      recordLatency(STATS_WRITE, start);
+      pthread_mutex_lock(&writeLock);
+      buf->full = 0;
+      nextWrite = (nextWrite+1) % WRITE_BUFFERS;
+      pthread_cond_broadcast(&writeDone);
+      pthread_mutex_unlock(&writeLock);
+   }
+   retireLibiprClock(&clockSlot);
+   return 0;
+}
+
+//
+// Let the writer thread write out the buffers it has, then stop it
+//
+static void finishWriter()
+{
+   pthread_mutex_lock(&writeLock);
+   writerStop = 1;
+   pthread_cond_signal(&writeReady);
+   pthread_mutex_unlock(&writeLock);
+   pthread_join(writerThread, NULL);
+}
+
+//
+// Sampling clock: the sampler sleeps to deadlines on sampleClock, one
+// of CLOCK_MONOTONIC (IPR_CLOCK=wall), CLOCK_PROCESS_CPUTIME_ID
+// (process-cpu) or the CPU clock of the thread that loaded libipr
+// (thread-cpu); a CPU clock only moves while the program runs, so time
+// waiting for I/O or for a CPU on a loaded node is not an interval
+// - the time of each sample on all three clocks (seconds since libipr
+//   started) goes to ipr-times.<pid>, one line per sample: interval
+//   number, wall time, process CPU time, main thread CPU time, and the
+//   length of the interval on the sampling clock; default runs (gmon
+//   files, wall clock, fixed interval) do not write it, so they do not
+//   make one more file per process
+//
+#define NUM_CLOCKS 3
+static clockid_t sampleClock = CLOCK_MONOTONIC;
+static clockid_t timeClocks[NUM_CLOCKS] = {CLOCK_MONOTONIC,
+                                           CLOCK_PROCESS_CPUTIME_ID,
+                                           CLOCK_PROCESS_CPUTIME_ID};
+static const char *clockNames[NUM_CLOCKS] = {"wall", "process-cpu",
+                                             "thread-cpu"};
+static int clockIndex = 0;
+static struct timespec startTimes[NUM_CLOCKS];
+static double lastSampleTime = 0;   // on the sampling clock
+static int wantTimes = 0;
+static FILE *timesFile = NULL;
+
+//
+// Set up the sampling clock from IPR_CLOCK and open the times file
+//
+static int openTimesFile();
+static int initClocks(char *clockName)
+{
+   int i;
+   // the constructor runs in the program's main thread
+   if (pthread_getcpuclockid(pthread_self(), &timeClocks[2]) != 0)
+      timeClocks[2] = CLOCK_PROCESS_CPUTIME_ID;
+   for (i=0; clockName && i < NUM_CLOCKS; i++)
+      if (!strcmp(clockName, clockNames[i]))
+         clockIndex = i;
+   if (clockName && strcmp(clockName, clockNames[clockIndex]))
+      fprintf(stderr, "libipr: unknown IPR_CLOCK %s, using wall\n", clockName);
+   sampleClock = timeClocks[clockIndex];
+   for (i=0; i < NUM_CLOCKS; i++)
+      clock_gettime(timeClocks[i], &startTimes[i]);
+   wantTimes = clockName != NULL || adaptive || captureMode != CAPTURE_GMON;
+   if (!wantTimes)
+      return 0;
+   return openTimesFile();
+}
+
+//
+// Open the times file (of this process)
+//
+static int openTimesFile()
+{
+   char fname[sizeof(dataDirname)+32];
+   sprintf(fname,"%sipr-times.%d",dataDirname,getpid());
+   timesFile = fopen(fname,"w");
+   if (!timesFile)
+      return -1;
+   fprintf(timesFile,"# libipr sample times: clock %s\n",
+           clockNames[clockIndex]);
+   fprintf(timesFile,"# interval wall process-cpu thread-cpu length\n");
+   fflush(timesFile);
+   return 0;
+}
+
+//
+// Write the time of a sample on each clock to the times file
+//
+static void recordSampleTime(int sampleNum)
+{
+   struct timespec now;
+   double t[NUM_CLOCKS];
+   int i;
+   if (!timesFile)
+      return;
+   for (i=0; i < NUM_CLOCKS; i++) {
+      clock_gettime(timeClocks[i], &now);
+      t[i] = (now.tv_sec - startTimes[i].tv_sec) +
+             (now.tv_nsec - startTimes[i].tv_nsec) / 1e9;
+   }
+   fprintf(timesFile,"%d %.6f %.6f %.6f %.6f\n", sampleNum, t[0], t[1], t[2],
+           t[clockIndex] - lastSampleTime);
+   fflush(timesFile);
+   lastSampleTime = t[clockIndex];
+}
+
+//
+// Move a sampling deadline (on sampleClock) on by interval nanoseconds;
+// deadlines that have already passed (the sampler was held up for a
+// whole interval or more) are skipped, so the samples stay on the same
+// time grid
+//
+static void nextDeadline(struct timespec *deadline, long long interval)
+{
+   struct timespec now;
+   long long next, current;
+   clock_gettime(sampleClock, &now);
+   next = deadline->tv_sec*1000000000LL + deadline->tv_nsec + interval;
+   current = now.tv_sec*1000000000LL + now.tv_nsec;
+   if (interval > 0 && next < current) {
+      missedDeadlines += (current - next) / interval + 1;
+      next += ((current - next) / interval + 1) * interval;
+   }
+   deadline->tv_sec = next / 1000000000LL;
+   deadline->tv_nsec = next % 1000000000LL;
+}
+
+//
+// Per-thread sampling (IPR_THREADS=1): gprof's histogram adds up all
+// the threads of the process, so libipr samples each thread's PC itself
+// - every thread (the main thread, and each thread the program starts
+//   with pthread_create(), which libipr wraps) gets a timer on its own
+//   CPU clock that sends it THREAD_SIGNAL every threadPeriod
+//   nanoseconds of its CPU time; the handler puts the interrupted PC,
+//   relative to the program's load address, into the thread's ring
+//   buffer, which only that thread writes and only the sampler reads,
+//   so no locks are needed
+// - CPU-time timers are only checked at scheduler ticks, so one signal
+//   can stand for several periods; the PC is counted that many times
+// - each interval the sampler empties the rings and appends one
+//   record per thread that was sampled to ipr-threads.<pid> (read by
+//   gmonread.py): a threadLogRecord followed by its (pc, count) pairs
+//   sorted by pc; the file starts with a threadLogHeader
+// - samples that do not fit in a full ring are dropped and counted
+// - a thread's ring is freed, and its slot reused, once the thread has
+//   exited and its last samples are written out
+//
+#define THREAD_SIGNAL (SIGRTMIN+4)
+#define THREAD_RING 8192   // PCs per ring, a power of 2
+#define MAX_THREADS 1024
+#define THREADLOG_MAGIC "IPRTHRDS"
+#define THREADLOG_VERSION 1
+#ifndef sigev_notify_thread_id
+#define sigev_notify_thread_id _sigev_un._tid
+#endif
+struct threadLogHeader {
+   char magic[8];
+   unsigned int version;
+   unsigned int ptrSize;      // sizeof(unsigned long) of the program
+   unsigned int period;       // nanoseconds of thread CPU time per sample
+   unsigned int spare;
+};
+struct threadLogRecord {
+   unsigned int sample;       // interval (sample) number
+   unsigned int thread;       // thread number, in order of start (main 0)
+   unsigned int tid;          // kernel thread id
+   unsigned int numPCs;       // number of threadPCs that follow
+   unsigned int dropped;      // samples lost to a full ring
+   unsigned int spare;
+};
+struct threadPC {
+   unsigned long pc;
+   unsigned long count;
+};
+struct threadRing {
+   unsigned long head;        // written by the thread's signal handler
+   unsigned long tail;        // written by the sampler
+   unsigned int dropped;
+   unsigned int thread, tid;
+   int exited;
+   timer_t timer;
+   struct threadPC pcs[THREAD_RING];
+};
+struct threadStart {
+   void *(*start)(void*);
+   void *arg;
+};
+static int threadSampling = 0;
+static long threadPeriod = 1000000;
+static int threadLogFd = -1;
+static struct threadRing *threadRings[MAX_THREADS];
+static int numThreadSlots = 0;      // slots used so far (high water)
+static unsigned int threadsStarted = 0;
+static struct threadPC *threadPCs = NULL;   // sampler's copy of a ring
+static char *threadRecord = NULL;
+static int (*realPthreadCreate)(pthread_t*, const pthread_attr_t*,
+                                void *(*)(void*), void*) = NULL;
+static __thread struct threadRing *myRing
+   __attribute__((tls_model("initial-exec"))) = NULL;
+
+//
+// PC of the interrupted code from a signal context
+//
+static unsigned long contextPC(void *context)
+{
+   ucontext_t *uc = (ucontext_t*) context;
+#if defined(__x86_64__)
+   return uc->uc_mcontext.gregs[REG_RIP];
+#elif defined(__i386__)
+   return uc->uc_mcontext.gregs[REG_EIP];
+#elif defined(__aarch64__)
+   return uc->uc_mcontext.pc;
+#else
+   return 0;
+#endif
+}
+
+//
+// THREAD_SIGNAL handler: add the PC to the thread's ring
+//
+static void threadSampleHandler(int sig, siginfo_t *si, void *context)
+{
+   struct threadRing *ring = myRing;
+   unsigned long head;
+   if (ring == NULL)
+      return;
+   head = ring->head;
+   if (head - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) >= THREAD_RING) {
+      __atomic_fetch_add(&ring->dropped, 1, __ATOMIC_RELAXED);
+      return;
+   }
+   ring->pcs[head & (THREAD_RING-1)].pc = contextPC(context) - loadAddress;
+   ring->pcs[head & (THREAD_RING-1)].count = 1 + (si->si_code == SI_TIMER ?
+                                                  si->si_overrun : 0);
+   __atomic_store_n(&ring->head, head+1, __ATOMIC_RELEASE);
+}
+
 //
-// Function pointer for write_gmon hidden C library function
-//  
-void (*write_gmon)(void) = NULL;
+// Start sampling the calling thread: take a free slot, and start a
+// timer on the thread's CPU clock
+//
+static void registerThread()
+{
+   struct threadRing *ring, *none;
+   struct sigevent sev;
+   struct itimerspec its;
+   int slot, slots;
+   ring = (struct threadRing*) calloc(1, sizeof(*ring));
+   if (ring == NULL)
+      return;
+   ring->thread = __atomic_fetch_add(&threadsStarted, 1, __ATOMIC_RELAXED);
+   ring->tid = syscall(SYS_gettid);
+   memset(&sev, 0, sizeof(sev));
+   sev.sigev_notify = SIGEV_THREAD_ID;
+   sev.sigev_signo = THREAD_SIGNAL;
+   sev.sigev_notify_thread_id = ring->tid;
+   if (timer_create(CLOCK_THREAD_CPUTIME_ID, &sev, &ring->timer) != 0) {
+      free(ring);
+      return;
+   }
+   for (slot=0; slot < MAX_THREADS; slot++) {
+      none = NULL;
+      if (__atomic_compare_exchange_n(&threadRings[slot], &none, ring, 0,
+                                      __ATOMIC_RELEASE, __ATOMIC_RELAXED))
+         break;
+   }
+   if (slot == MAX_THREADS) {
+      if (debug)
+         fprintf(stderr, "libipr: too many threads, thread %d not sampled\n",
+                 ring->tid);
+      timer_delete(ring->timer);
+      free(ring);
+      return;
+   }
+   slots = __atomic_load_n(&numThreadSlots, __ATOMIC_RELAXED);
+   while (slot >= slots &&
+          !__atomic_compare_exchange_n(&numThreadSlots, &slots, slot+1, 0,
+                                       __ATOMIC_RELEASE, __ATOMIC_RELAXED))
+      ;
+   myRing = ring;
+   its.it_interval.tv_sec = threadPeriod / 1000000000L;
+   its.it_interval.tv_nsec = threadPeriod % 1000000000L;
+   its.it_value = its.it_interval;
+   timer_settime(ring->timer, 0, &its, NULL);
+}
 
-// tried to use monstartup to reinitialize data after moncleanup was
-// called, but this totally failed, just kept segfaulting. So back to
-// trying to find write_gmon(), which does work all by itself
-//void (*gmon_start)(void) = NULL;
-// for monstartup
-//void (*gmon_start)(unsigned long lowpc, unsigned long highpc) = NULL;
+//
+// Stop sampling the calling thread; the sampler frees its ring
+//
+static void unregisterThread(void *arg)
+{
+   struct threadRing *ring = myRing;
+   if (ring == NULL)
+      return;
+   timer_delete(ring->timer);
+   myRing = NULL;
+   __atomic_store_n(&ring->exited, 1, __ATOMIC_RELEASE);
+}
+
+//
+// Start routine of the program's threads: sample the thread while it
+// runs its own start routine (the cleanup handler also covers
+// pthread_exit() and cancellation)
+//
+static void* threadTrampoline(void *arg)
+{
+   struct threadStart ts = *(struct threadStart*) arg;
+   void *result;
+   free(arg);
+   registerThread();
+   pthread_cleanup_push(unregisterThread, NULL);
+   result = ts.start(ts.arg);
+   pthread_cleanup_pop(1);
+   return result;
+}
+
+//
+// Wrapper of pthread_create(), so that the program's threads are
+// sampled; libipr's own threads are started with realPthreadCreate
+// - it also counts the program's threads, and restarts libipr in a
+//   forked child (see libiprChildFork())
+//
+static int programThreads = 0;
+static void checkChildRestart();
+int pthread_create(pthread_t *thread, const pthread_attr_t *attr,
+                   void *(*start)(void*), void *arg)
+{
+   struct threadStart *ts;
+   int err;
+   if (realPthreadCreate == NULL)
+      realPthreadCreate = dlsym(RTLD_NEXT, "pthread_create");
+   checkChildRestart();
+   __atomic_fetch_add(&programThreads, 1, __ATOMIC_RELAXED);
+   if (!threadSampling)
+      return realPthreadCreate(thread, attr, start, arg);
+   ts = (struct threadStart*) malloc(sizeof(*ts));
+   if (ts == NULL)
+      return EAGAIN;
+   ts->start = start;
+   ts->arg = arg;
+   err = realPthreadCreate(thread, attr, threadTrampoline, ts);
+   if (err != 0)
+      free(ts);
+   return err;
+}
+
+//
+// Start one of libipr's own threads, which are not sampled
+// - they block SIGPROF (the new thread inherits the signal mask), so the
+//   kernel never picks them for the program's gprof histogram ticks
+//
+static int startLibiprThread(pthread_t *thread, void *(*start)(void*))
+{
+   sigset_t block, old;
+   int err;
+   if (realPthreadCreate == NULL)
+      realPthreadCreate = dlsym(RTLD_NEXT, "pthread_create");
+   sigemptyset(&block);
+   sigaddset(&block, SIGPROF);
+   pthread_sigmask(SIG_BLOCK, &block, &old);
+   err = realPthreadCreate(thread, NULL, start, NULL);
+   pthread_sigmask(SIG_SETMASK, &old, NULL);
+   return err;
+}
+
+//
+// Set up per-thread sampling: open the thread log, install the signal
+// handler and start sampling the main thread (the constructor runs in
+// it)
+//
+static int openThreadLog();
+static int initThreads()
+{
+   struct sigaction sa;
+   threadPCs = (struct threadPC*) malloc(THREAD_RING*sizeof(*threadPCs));
+   threadRecord = (char*) malloc(sizeof(struct threadLogRecord) +
+                                 THREAD_RING*sizeof(struct threadPC));
+   if (!threadPCs || !threadRecord)
+      return -1;
+   dl_iterate_phdr(findLoadAddress, &loadAddress);
+   if (openThreadLog() != 0)
+      return -1;
+   memset(&sa, 0, sizeof(sa));
+   sa.sa_sigaction = threadSampleHandler;
+   sa.sa_flags = SA_SIGINFO | SA_RESTART;
+   sigemptyset(&sa.sa_mask);
+   // a thread's own signal is delivered before the process's SIGPROF of
+   // the same tick, which would then land in this handler and be lost
+   // to gprof's histogram (its PC is outside the program's text)
+   sigaddset(&sa.sa_mask, SIGPROF);
+   if (sigaction(THREAD_SIGNAL, &sa, NULL) != 0)
+      return -1;
+   threadSampling = 1;
+   registerThread();
+   return 0;
+}
+
+//
+// Open the thread log (of this process) and write its header
+//
+static int openThreadLog()
+{
+   char fname[sizeof(dataDirname)+32];
+   struct threadLogHeader hdr;
+   sprintf(fname,"%sipr-threads.%d",dataDirname,getpid());
+   threadLogFd = open(fname, O_WRONLY|O_CREAT|O_TRUNC|O_APPEND, 0644);
+   if (threadLogFd < 0)
+      return -1;
+   memset(&hdr, 0, sizeof(hdr));
+   memcpy(hdr.magic, THREADLOG_MAGIC, sizeof(hdr.magic));
+   hdr.version = THREADLOG_VERSION;
+   hdr.ptrSize = sizeof(unsigned long);
+   hdr.period = threadPeriod;
+   if (write(threadLogFd, &hdr, sizeof(hdr)) != sizeof(hdr))
+      return -1;
+   countBytes(sizeof(hdr));
+   return 0;
+}
+
+static int comparePCs(const void *a, const void *b)
+{
+   unsigned long x = ((const struct threadPC*) a)->pc;
+   unsigned long y = ((const struct threadPC*) b)->pc;
+   return x < y ? -1 : x > y;
+}
+
+//
+// Empty the threads' rings and append their records to the thread log
+//
+static void writeThreadRecords(int sampleNum)
+{
+   struct threadLogRecord *rec = (struct threadLogRecord*) threadRecord;
+   struct threadPC *pcs = (struct threadPC*) (rec+1);
+   struct threadRing *ring;
+   unsigned long head, tail, i, j, n;
+   unsigned int dropped;
+   int slot, exited, slots;
+   size_t size;
+   slots = __atomic_load_n(&numThreadSlots, __ATOMIC_ACQUIRE);
+   for (slot=0; slot < slots; slot++) {
+      ring = __atomic_load_n(&threadRings[slot], __ATOMIC_ACQUIRE);
+      if (ring == NULL)
+         continue;
+      // read exited first: no samples come in after it is set
+      exited = __atomic_load_n(&ring->exited, __ATOMIC_ACQUIRE);
+      head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+      tail = ring->tail;
+      for (i=0; tail+i < head; i++)
+         threadPCs[i] = ring->pcs[(tail+i) & (THREAD_RING-1)];
+      __atomic_store_n(&ring->tail, head, __ATOMIC_RELEASE);
+      dropped = __atomic_exchange_n(&ring->dropped, 0, __ATOMIC_RELAXED);
+      n = 0;
+      if (i > 0) {
+         qsort(threadPCs, i, sizeof(*threadPCs), comparePCs);
+         for (j=0; j < i; j++) {
+            if (n > 0 && pcs[n-1].pc == threadPCs[j].pc) {
+               pcs[n-1].count += threadPCs[j].count;
+               continue;
+            }
+            pcs[n++] = threadPCs[j];
+         }
+      }
+      if (n > 0 || dropped > 0) {
+         rec->sample = sampleNum;
+         rec->thread = ring->thread;
+         rec->tid = ring->tid;
+         rec->numPCs = n;
+         rec->dropped = dropped;
+         rec->spare = 0;
+         size = sizeof(*rec) + n*sizeof(*pcs);
+         if (write(threadLogFd, threadRecord, size) != size)
+            fprintf(stderr, "libipr: error writing thread log record %d\n",
+                    sampleNum);
+         else
+            countBytes(size);
+      }
+      if (exited) {
+         __atomic_store_n(&threadRings[slot], NULL, __ATOMIC_RELEASE);
+         free(ring);
+      }
+   }
+}
+
+//
+// Rank of the process in a parallel (MPI) job, from the environment of
+// common launchers: Open MPI, PMIx, MPICH/Hydra and Intel MPI,
+// MVAPICH2, Slurm (srun) and Cray ALPS
+// - the rank, job size, host and pid go to ipr-rank.<pid>, so that
+//   aggregateranks.py can tell the processes of a job apart
+// - the size comes from the same launcher as the rank (-1 if it does
+//   not give one); Slurm's is that of the job step (srun), so a serial
+//   program in the batch script of a multi-task job has no size
+// - in a job of more than one process, each rank's files go to a
+//   subdirectory rank-<rank> of the data directory (unless
+//   IPR_RANKDIRS=0), since pids of different hosts can be the same
+//
+static const char *launcherVariables[][2] = {
+   {"OMPI_COMM_WORLD_RANK", "OMPI_COMM_WORLD_SIZE"},
+   {"PMIX_RANK", NULL},
+   {"PMI_RANK", "PMI_SIZE"},
+   {"MV2_COMM_WORLD_RANK", "MV2_COMM_WORLD_SIZE"},
+   {"SLURM_PROCID", "SLURM_STEP_NUM_TASKS"},
+   {"ALPS_APP_PE", NULL},
+   {NULL, NULL}};
+static int jobRank = -1, jobSize = -1;
+
+// value of an environment variable, or -1 if it is not set
+static int launcherValue(const char *name)
+{
+   char *value = name ? getenv(name) : NULL;
+   if (value && *value)
+      return strtol(value,0,10);
+   return -1;
+}
+
+//
+// Find the rank of the process, move the data directory to the rank's
+// subdirectory, and write the rank file
+//
+static void writeRankFile();
+static void initRank()
+{
+   char *paramstr;
+   int i;
+   for (i=0; launcherVariables[i][0] && jobRank < 0; i++) {
+      jobRank = launcherValue(launcherVariables[i][0]);
+      if (jobRank >= 0)
+         jobSize = launcherValue(launcherVariables[i][1]);
+   }
+   if (jobRank < 0)
+      return;
+   paramstr = getenv("IPR_RANKDIRS");
+   if (jobSize > 1 && (!paramstr || strtol(paramstr,0,0)) &&
+       strlen(dataDirname) < sizeof(dataDirname) - 20) {
+      sprintf(dataDirname+strlen(dataDirname), "rank-%d", jobRank);
+      if (mkdir(dataDirname, 0755) != 0 && errno != EEXIST)
+         fprintf(stderr, "libipr: cannot create %s (%s)\n", dataDirname,
+                 strerror(errno));
+      strcat(dataDirname, "/");
+   }
+   writeRankFile();
+}
+
+//
+// Write the rank file (of this process)
+//
+static void writeRankFile()
+{
+   char fname[sizeof(dataDirname)+32];
+   char host[256];
+   FILE *f;
+   if (jobRank < 0)
+      return;
+   if (gethostname(host, sizeof(host)) != 0)
+      strcpy(host, "unknown");
+   host[sizeof(host)-1] = 0;
+   sprintf(fname,"%sipr-rank.%d",dataDirname,getpid());
+   f = fopen(fname,"w");
+   if (!f)
+      return;
+   fprintf(f,"# libipr process: rank size host pid\n");
+   fprintf(f,"%d %d %s %d\n", jobRank, jobSize, host, getpid());
+   fclose(f);
+   if (debug)
+      fprintf(stderr, "libipr: rank %d of %d on %s, data in %s\n", jobRank,
+              jobSize, host, dataDirname[0] ? dataDirname : ".");
+}
+
+//
+// Reporting of the self-measurement counters (see above)
+//
+
+// CPU seconds of libipr's sampler and writer threads
+static double libiprCpuTime()
+{
+   struct timespec t;
+   double total = 0;
+   int i;
+   for (i=0; i < numLibiprClocks && i < 2; i++)
+      if (retiredClocks[i])
+         total += retiredCpu[i];
+      else if (clock_gettime(libiprClocks[i], &t) == 0)
+         total += t.tv_sec + t.tv_nsec / 1e9;
+   return total;
+}
+
+//
+// Check if the stats summary is wanted (see above), and open the stats
+// file if stats lines are too (IPR_STATS=N)
+//
+static void initStats(char *every)
+{
+   char fname[sizeof(dataDirname)+32];
+   if (every) {
+      statsEvery = strtol(every,0,0);
+      wantStats = 1;
+   }
+   if (captureMode != CAPTURE_GMON)
+      wantStats = 1;
+   if (statsEvery <= 0)
+      return;
+   sprintf(fname,"%sipr-stats.%d",dataDirname,getpid());
+   statsFile = fopen(fname,"w");
+   if (statsFile)
+      fprintf(statsFile,"# libipr stats every %d samples\n", statsEvery);
+}
+
+//
+// End of one interval's work in the sampler: count its latency, and
+// write a stats line every statsEvery samples
+//
+static void sampleDone(int sampleNum, long long start)
+{
+   struct latencyStats *ls = &latencies[STATS_SAMPLE];
+   recordLatency(STATS_SAMPLE, start);
+   if (!statsFile || (sampleNum+1) % statsEvery != 0)
+      return;
+   fprintf(statsFile,"sample %d bytes %llu missed %lu cpu %.6f "
+           "latency-mean-us %.1f latency-max-us %.1f\n", sampleNum,
+           __atomic_load_n(&bytesWritten, __ATOMIC_RELAXED), missedDeadlines,
+           libiprCpuTime(), ls->total / 1e3 / ls->count, ls->max / 1e3);
+   fflush(statsFile);
+}
+
+// one latency summary line: count, mean, max and the nonzero buckets
+static void printLatency(FILE *f, const char *name, struct latencyStats *ls)
+{
+   int b;
+   fprintf(f,"%s count %lu mean-us %.1f max-us %.1f buckets", name,
+           ls->count, ls->count ? ls->total / 1e3 / ls->count : 0.0,
+           ls->max / 1e3);
+   for (b=0; b < STATS_BUCKETS; b++)
+      if (ls->buckets[b])
+         fprintf(f," <%luus:%lu", 1UL << b, ls->buckets[b]);
+   fprintf(f,"\n");
+}
+
+//
+// Write the summary to the stats file (and to stderr with IPR_STATS=N),
+// if it is wanted
+//
+static void finishStats()
+{
+   char fname[sizeof(dataDirname)+32];
+   struct timespec t;
+   double cpu, processCpu;
+   FILE *f;
+   int i;
+   if (!wantStats)
+      return;
+   if (!statsFile) {
+      sprintf(fname,"%sipr-stats.%d",dataDirname,getpid());
+      statsFile = fopen(fname,"w");
+      if (!statsFile)
+         return;
+   }
+   cpu = libiprCpuTime();
+   clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &t);
+   processCpu = t.tv_sec + t.tv_nsec / 1e9;
+   for (i=0; i < 2; i++) {
+      f = i == 0 ? statsFile : stderr;
+      if (i == 1 && statsEvery <= 0)
+         break;
+      fprintf(f,"# libipr summary\n");
+      fprintf(f,"samples %lu missed %lu bytes %llu cpu %.6f process-cpu %.6f "
+              "overhead %.3f%%\n", latencies[STATS_SAMPLE].count,
+              missedDeadlines, __atomic_load_n(&bytesWritten, __ATOMIC_RELAXED),
+              cpu, processCpu, processCpu > 0 ? 100 * cpu / processCpu : 0.0);
+      printLatency(f, "sample-latency", &latencies[STATS_SAMPLE]);
+      printLatency(f, "write-latency", &latencies[STATS_WRITE]);
+   }
+   fclose(statsFile);
+   statsFile = NULL;
+}
 
 //
 // Initialization
@@ -61,10 +2123,311 @@ void (*write_gmon)(void) = NULL;
 // - nothing?
 
 void* libiprSigHandler();
-static int debug = 0;
 pthread_t pth;
 struct itimerval itv;
 struct itimerval old_itv;
+static int samplerStarted = 0;
+static int sampleCount = 0;         // number of the next sample
+static long long sampleInterval;    // nanoseconds
+static int mcleanupRegistered = 0;
+static int libiprDone = 0;          // shut down
+static int childFilesPending = 0;   // forked child, files not opened
+static pthread_mutex_t sampleLock = PTHREAD_MUTEX_INITIALIZER;
+static int takeSample();
+
+//
+// Shut libipr down at exit: stop the sampler, take a last sample of
+// the time since the last interval (if lastSample and the profiling
+// data is still there), write out the samples the writer thread still
+// has, and close the files; the last line of the times file is the
+// end of the run
+// - runs at exit right before gprof's _mcleanup() (see __cxa_atexit()
+//   below), else (a program without -pg) from the destructor
+//
+static void libiprShutdown(int lastSample)
+{
+   checkChildRestart();
+   if (libiprDone || !samplerStarted)
+      return;
+   libiprDone = 1;
+   if (debug)
+      fprintf(stderr, "libipr: shutting down after %d samples\n",
+              sampleCount);
+   pthread_cancel(pth);
+   pthread_join(pth, NULL);
+   if (lastSample)
+      takeSample();
+   if (doPhases)
+      finishPhases();
+   if (asyncWrite)
+      finishWriter();
+   if (captureMode == CAPTURE_CONTAINER)
+      finishContainer();
+   if (timesFile) {
+      fclose(timesFile);
+      timesFile = NULL;
+   }
+   finishStats();
+}
+
+static void libiprExitHandler(void *arg)
+{
+   libiprShutdown(1);
+}
+
+//
+// Wrapper of __cxa_atexit(), through which the program's
+// __gmon_start__() registers gprof's _mcleanup() with atexit(), which
+// frees the profiling data; exit handlers run in reverse order, so one
+// registered right after it runs right before it
+//
+int __cxa_atexit(void (*func)(void*), void *arg, void *dso)
+{
+   static int (*realCxaAtexit)(void (*)(void*), void*, void*) = NULL;
+   static void *mcleanup = NULL;
+   int err;
+   checkChildRestart();
+   if (realCxaAtexit == NULL) {
+      realCxaAtexit = dlsym(RTLD_NEXT, "__cxa_atexit");
+      mcleanup = dlsym(RTLD_NEXT, "_mcleanup");
+   }
+   err = realCxaAtexit(func, arg, dso);
+   if (err == 0 && !mcleanupRegistered && mcleanup != NULL &&
+       (void*) func == mcleanup) {
+      mcleanupRegistered = 1;
+      realCxaAtexit(libiprExitHandler, NULL, NULL);
+   }
+   return err;
+}
+
+//
+// Fork: a child process has only the thread that called fork(), so
+// libipr's sampler and writer threads are gone from it, and it would
+// share the parent's files and sample numbers
+// - before the fork, the sampler finishes the sample it is taking, the
+//   writer the write it is doing, and the files are flushed
+// - the child of a program with threads may only make async-signal-safe
+//   calls until it execs, so the child handler only resets libipr's
+//   state (closing the parent's descriptors, zeroing counters) and
+//   marks the child for a restart; restartChild() then drops the rest
+//   of the parent's files and threads and starts a new sampler (and
+//   writer) when the child next calls into libipr: creating a thread,
+//   registering an exit handler, forking, or exiting. If the program
+//   had no threads of its own, the fork() wrapper restarts it as soon
+//   as fork() returns in the child
+// - the child's files are named by its own pid, and only opened when it
+//   takes its first sample, so a child that just execs another program
+//   leaves no files behind (the new program starts libipr afresh, if
+//   IPR_APPNAME matches it)
+// - the child's samples are numbered from 0, its times are from the
+//   fork, and its deltas and thread samples are of its own run; gmon
+//   data (as in gprof's own gmon.out of a child) also has the parent's
+//   counts from before the fork
+// - interval timers are not inherited, so gprof's histogram would get
+//   no ticks in the child; its ITIMER_PROF is set again as the parent's
+//   (a plain system call) in the child handler
+//
+static int forkLocked = 0;
+static int childRestartPending = 0;
+static struct itimerval profTimer;
+static const pthread_mutex_t initialMutex = PTHREAD_MUTEX_INITIALIZER;
+static const pthread_cond_t initialCond = PTHREAD_COND_INITIALIZER;
+
+static void libiprPrepareFork()
+{
+   checkChildRestart();
+   if (!samplerStarted || libiprDone)
+      return;
+   pthread_mutex_lock(&sampleLock);
+   pthread_mutex_lock(&containerLock);
+   pthread_mutex_lock(&writeLock);
+   if (timesFile)
+      fflush(timesFile);
+   if (phaseFile)
+      fflush(phaseFile);
+   if (statsFile)
+      fflush(statsFile);
+   getitimer(ITIMER_PROF, &profTimer);
+   forkLocked = 1;
+}
+
+static void libiprParentFork()
+{
+   if (!forkLocked)
+      return;
+   forkLocked = 0;
+   pthread_mutex_unlock(&writeLock);
+   pthread_mutex_unlock(&containerLock);
+   pthread_mutex_unlock(&sampleLock);
+}
+
+static void libiprChildFork()
+{
+   struct timespec t;
+   int i;
+   if (!forkLocked)
+      return;
+   forkLocked = 0;
+   // the locks are held by the parent's threads, and the condition
+   // variables may have waiters that are not in the child
+   writeLock = containerLock = sampleLock = initialMutex;
+   writeReady = writeDone = initialCond;
+   if (profTimer.it_interval.tv_sec || profTimer.it_interval.tv_usec)
+      setitimer(ITIMER_PROF, &profTimer, NULL);
+   // the parent's descriptors (its stdio files are closed by
+   // restartChild(); they are flushed, so that writes nothing)
+   if (deltaLogFd >= 0)
+      close(deltaLogFd);
+   if (containerFd >= 0)
+      close(containerFd);
+   if (threadLogFd >= 0)
+      close(threadLogFd);
+   deltaLogFd = containerFd = threadLogFd = -1;
+   // the parent's samples and counters
+   sampleCount = 0;
+   numContainerSamples = 0;
+   prevImageSize = 0;
+   for (i=0; i < WRITE_BUFFERS; i++)
+      writeBuffers[i].full = 0;
+   nextFill = nextWrite = 0;
+   writerStop = 0;
+   memset(latencies, 0, sizeof(latencies));
+   bytesWritten = missedDeadlines = 0;
+   numLibiprClocks = 0;
+   memset(retiredClocks, 0, sizeof(retiredClocks));
+   // the next deltas are from the fork (if the delta buffers are set up)
+   if (gmonParam && prevKcount &&
+       (doPhases || captureMode == CAPTURE_DELTA || adaptive) &&
+       takeHistogramDelta() >= 0 && captureMode == CAPTURE_DELTA)
+      takeArcDelta();
+   // times are from the fork; this thread is the child's main thread
+   for (i=0; i < 2; i++)
+      clock_gettime(timeClocks[i], &startTimes[i]);
+   clock_gettime(CLOCK_THREAD_CPUTIME_ID, &t);
+   startTimes[2] = t;
+   lastSampleTime = 0;
+   childFilesPending = 1;
+   childRestartPending = 1;
+   samplerStarted = 0;
+}
+
+//
+// Restart libipr in a forked child (see above), from its main thread:
+// close the parent's stdio files, start sampling this thread (its
+// timer is not inherited) and start a new sampler and writer
+//
+static void restartChild()
+{
+   struct threadRing *ring;
+   int i;
+   childRestartPending = 0;
+   if (timesFile)
+      fclose(timesFile);
+   if (phaseFile)
+      fclose(phaseFile);
+   if (statsFile)
+      fclose(statsFile);
+   timesFile = phaseFile = statsFile = NULL;
+   if (pthread_getcpuclockid(pthread_self(), &timeClocks[2]) != 0)
+      timeClocks[2] = CLOCK_PROCESS_CPUTIME_ID;
+   if (clockIndex == 2)
+      sampleClock = timeClocks[2];
+   if (threadSampling) {
+      for (i=0; i < numThreadSlots; i++) {
+         ring = threadRings[i];
+         threadRings[i] = NULL;
+         free(ring);
+      }
+      numThreadSlots = 0;
+      threadsStarted = 0;
+      myRing = NULL;
+      registerThread();
+   }
+   if (asyncWrite && startLibiprThread(&writerThread, &libiprWriter) != 0)
+      asyncWrite = 0;
+   samplerStarted = startLibiprThread(&pth, &libiprSigHandler) == 0;
+   if (!samplerStarted)
+      fprintf(stderr, "libipr: can't create thread in child process %d\n",
+              getpid());
+}
+
+// the child calls into libipr: restart it, if that is still to be done
+static void checkChildRestart()
+{
+   if (childRestartPending)
+      restartChild();
+}
+
+//
+// Wrapper of fork(): the child of a program without threads of its own
+// restarts libipr right away (see above)
+//
+pid_t fork(void)
+{
+   static pid_t (*realFork)(void) = NULL;
+   pid_t pid;
+   if (realFork == NULL)
+      realFork = dlsym(RTLD_NEXT, "fork");
+   pid = realFork();
+   if (pid == 0 && childRestartPending &&
+       !__atomic_load_n(&programThreads, __ATOMIC_RELAXED))
+      restartChild();
+   return pid;
+}
+
+//
+// Open the files of a forked child, before its first sample
+//
+static void openChildFiles()
+{
+   int err = 0;
+   childFilesPending = 0;
+   writeRankFile();
+   if (doPhases)
+      err |= openPhaseFile();
+   if (captureMode == CAPTURE_DELTA)
+      err |= initDeltaLog();
+   if (captureMode == CAPTURE_CONTAINER)
+      err |= initContainer();
+   if (threadSampling)
+      err |= openThreadLog();
+   if (wantTimes)
+      err |= openTimesFile();
+   initStats(NULL);
+   if (err)
+      fprintf(stderr, "libipr: cannot open all files of child process %d\n",
+              getpid());
+}
+
+//
+// Whether IPR_APPNAME (names) matches the executable name: a
+// comma-separated list of extended regular expressions, each of which
+// has to match the whole name
+//
+static int matchAppName(const char *names, const char *exeName)
+{
+   char pattern[1024];
+   const char *end;
+   regex_t re;
+   size_t len;
+   int match = 0;
+   while (!match && *names) {
+      end = strchr(names, ',');
+      len = end ? end - names : strlen(names);
+      if (len > 0 && len < sizeof(pattern) - 8) {
+         sprintf(pattern, "^(%.*s)$", (int) len, names);
+         if (regcomp(&re, pattern, REG_EXTENDED|REG_NOSUB) == 0) {
+            match = regexec(&re, exeName, 0, NULL, 0) == 0;
+            regfree(&re);
+         } else {
+            fprintf(stderr, "libipr: bad IPR_APPNAME pattern %.*s\n",
+                    (int) len, names);
+         }
+      }
+      names += len + (end != NULL);
+   }
+   return match;
+}
 
 
 __attribute__((constructor))
@@ -74,7 +2437,7 @@ static void libiprInitialize()
 //   struct itimerval old_itv;
    void (*old_sh)(int);
    char *paramstr;
-   long int gmonOffset = WRGMON_OFFSET;
+   long int gmonOffset = 0;
    int err;
    char exeName[1024];
    int len;
@@ -94,19 +2457,20 @@ static void libiprInitialize()
    }
    exeName[len] = 0;
 
-   //fprintf(stderr, "libipr: IPR_APPNAME = %s and path = %s\n", paramstr, exeName);
-   /* if the excutable name is not similar to IPR_APPNAME then return */
-   if (strcmp(basename(exeName), paramstr) != 0) {
-      fprintf(stderr, "libipr: wrong exec file, path is %s \n", exeName);
-      return;
-   }
-
-  
    paramstr = getenv("IPR_DEBUG");
    if (paramstr) {
       debug = strtol(paramstr,0,0);
    }
 
+   //fprintf(stderr, "libipr: IPR_APPNAME = %s and path = %s\n", paramstr, exeName);
+   /* if the excutable name is not similar to IPR_APPNAME then return */
+   /* (quietly: a driver script runs many programs before the real one) */
+   if (!matchAppName(getenv("IPR_APPNAME"), basename(exeName))) {
+      if (debug)
+         fprintf(stderr, "libipr: wrong exec file, path is %s \n", exeName);
+      return;
+   }
+
    if (debug)
       fprintf(stderr, "libipr: in library constructor\n");
    if (write_gmon != NULL) {
@@ -128,10 +2492,10 @@ static void libiprInitialize()
          strcat(sampleFilename,"gmon-%d.out");
       }
    }
+   initRank();
 
-   // Set up pointer to write_gmon function, using offset found by hand
-   // TODO: make this an environment variable offset and create python
-   // script to find it automatically
+   // Set up pointer to write_gmon function, using the offset given or
+   // else the one found in the C library
    paramstr = getenv("IPR_GMONOFFSET");
    if (paramstr) {
       errno = 0;
@@ -139,8 +2503,10 @@ static void libiprInitialize()
       if (errno) {
          // do something
       }
+   } else {
+      gmonOffset = findGmonOffset((unsigned char*) dlsym(0, "moncontrol"));
    }
-   if (write_gmon == NULL)
+   if (write_gmon == NULL && gmonOffset != 0 && dlsym(0, "moncontrol"))
        write_gmon = (void (*)(void))dlsym(0, "moncontrol") + gmonOffset;
    if (write_gmon == NULL) {
        fprintf(stderr, "libipr: Unable to find moncontrol (write_gmon) function\n");
@@ -149,6 +2515,75 @@ static void libiprInitialize()
    if (debug)
       fprintf(stderr, "libipr: done setting up write_gmon pointer\n");
 
+   // Set up online phase detection and delta capture, which read the
+   // profiling data directly
+   paramstr = getenv("IPR_PHASES");
+   if (paramstr) {
+      doPhases = strtol(paramstr,0,0);
+   }
+   paramstr = getenv("IPR_CAPTURE");
+   if (paramstr && !strcmp(paramstr,"delta")) {
+      captureMode = CAPTURE_DELTA;
+   } else if (paramstr && !strcmp(paramstr,"container")) {
+      captureMode = CAPTURE_CONTAINER;
+   }
+   paramstr = getenv("IPR_COMPRESS");
+   if (paramstr && !strcmp(paramstr,"rle")) {
+      containerEncoding = ENCODE_DELTA;
+   } else if (paramstr && !strcmp(paramstr,"zlib")) {
+      containerEncoding = ENCODE_DELTA | ENCODE_ZLIB;
+   }
+   paramstr = getenv("IPR_ASYNC");
+   if (paramstr) {
+      asyncWrite = strtol(paramstr,0,0);
+   }
+   // nothing for a writer thread to write with only deltas or phases
+   if (captureMode == CAPTURE_DELTA ||
+       (captureMode == CAPTURE_GMON && doPhases == 2))
+      asyncWrite = 0;
+   paramstr = getenv("IPR_ADAPTIVE");
+   if (paramstr) {
+      adaptive = strtol(paramstr,0,0);
+   }
+   if (doPhases || captureMode != CAPTURE_GMON || asyncWrite || adaptive) {
+      paramstr = getenv("IPR_GMONPARAMOFFSET");
+      if (paramstr)
+         gmonParam = (struct gmonparam*) ((char*) dlsym(0, "moncontrol") +
+                                          strtol(paramstr,0,0));
+      else if (dlsym(0, "moncontrol") != NULL)
+         gmonParam = findGmonParam((unsigned char*) dlsym(0, "moncontrol"));
+      if (gmonParam == NULL)
+         fprintf(stderr, "libipr: Unable to find profiling data (_gmonparam)\n");
+   }
+   if (doPhases && (gmonParam == NULL || initPhases() != 0)) {
+      fprintf(stderr, "libipr: Unable to set up online phase detection\n");
+      doPhases = 0;
+   }
+   if (captureMode == CAPTURE_DELTA &&
+       (gmonParam == NULL || initDeltaLog() != 0)) {
+      fprintf(stderr, "libipr: Unable to set up delta capture, "
+              "writing gmon files\n");
+      captureMode = CAPTURE_GMON;
+   }
+   if (captureMode == CAPTURE_CONTAINER &&
+       (gmonParam == NULL || initContainer() != 0)) {
+      fprintf(stderr, "libipr: Unable to set up sample container, "
+              "writing gmon files\n");
+      captureMode = CAPTURE_GMON;
+   }
+   if (initClocks(getenv("IPR_CLOCK")) != 0)
+      fprintf(stderr, "libipr: Unable to open sample times file\n");
+   if (asyncWrite && (gmonParam == NULL ||
+       startLibiprThread(&writerThread, &libiprWriter) != 0)) {
+      fprintf(stderr, "libipr: Unable to start writer thread, "
+              "writing samples from the sampling thread\n");
+      asyncWrite = 0;
+   }
+   if (debug)
+      fprintf(stderr, "libipr: phase detection %d, capture mode %d, "
+              "async write %d, _gmonparam at %p\n", doPhases, captureMode,
+              asyncWrite, gmonParam);
+
    // set up timer and signal handler
    itv.it_interval.tv_sec = 0;
    itv.it_interval.tv_usec = 125000;  // 1/8 second
@@ -169,6 +2604,12 @@ static void libiprInitialize()
       }
    }
    itv.it_value = itv.it_interval;
+   if (adaptive && (gmonParam == NULL ||
+                    initAdaptive(itv.it_interval.tv_sec*1000000000LL +
+                                 itv.it_interval.tv_usec*1000LL) != 0)) {
+      fprintf(stderr, "libipr: Unable to set up adaptive interval\n");
+      adaptive = 0;
+   }
    old_itv.it_interval.tv_sec = 0;
    old_itv.it_interval.tv_usec = 0;
    //setitimer(ITIMER_VIRTUAL, &itv, &old_itv);
@@ -179,9 +2620,24 @@ static void libiprInitialize()
    if (debug)
       fprintf(stderr, "libipr: done setting up interval timer\n");
 
-   err = pthread_create(&pth, NULL, &libiprSigHandler, NULL);
+   paramstr = getenv("IPR_THREADS");
+   if (paramstr && strtol(paramstr,0,0)) {
+      paramstr = getenv("IPR_THREADPERIOD");
+      if (paramstr && strtol(paramstr,0,0) > 0)
+         threadPeriod = strtol(paramstr,0,0) * 1000L;
+      if (initThreads() != 0) {
+         fprintf(stderr, "libipr: Unable to set up per-thread sampling\n");
+         threadSampling = 0;
+      }
+   }
+
+   initStats(getenv("IPR_STATS"));
+   err = startLibiprThread(&pth, &libiprSigHandler);
    if (err != 0)
    fprintf(stderr, "libipr: can't create thread :[%s]", strerror(err));
+   samplerStarted = err == 0;
+   if (samplerStarted)
+      pthread_atfork(libiprPrepareFork, libiprParentFork, libiprChildFork);
 
    // NOW USING threads -- must refactor code in signal handler to say this!
    // man page: use sigaction instead?
@@ -199,60 +2655,153 @@ static void libiprFinalize()
 {
    if (debug)
       fprintf(stderr, "libipr: in library destructor\n");
-   // nothing to do here? call to make sure one write-out
-   //libiprSigHandler();
+   // gprof's profiling data is gone once _mcleanup() has run
+   libiprShutdown(!mcleanupRegistered);
 }
 
-void* libiprSigHandler(void *arg)
+//
+// Take the sample of one interval (number sampleCount), when the
+// sampler wakes up, or the last one at exit; a fork waits for it
+// - returns -1 if no more samples can be taken (no write_gmon)
+//
+static int writeSample();
+static int takeSample()
+{
+   int err;
+   pthread_mutex_lock(&sampleLock);
+   if (childFilesPending)
+      openChildFiles();
+   err = writeSample();
+   pthread_mutex_unlock(&sampleLock);
+   return err;
+}
+
+static int writeSample()
 {
-   static int sampleCount = 0;
    char ofname[128];
-   char nfname[128];
+   // putenv() keeps the string itself
+   static char nfname[sizeof(dataDirname)+48];
    struct timespec stime;
    double ftime;
    FILE *lf;
+   long samples;
+   struct stat st;
+   char sfname[sizeof(dataDirname)+48];
+   long long start, writeStart;
 
-   while (1) {
-      // JEC: sleep first, then sample
-      int t = (itv.it_interval.tv_sec*1000000 + itv.it_interval.tv_usec);
-      usleep(t);
+   start = monotonicNanos();
+   recordSampleTime(sampleCount);
+   if (threadSampling)
+      writeThreadRecords(sampleCount);
 
-      if (debug)
-         fprintf(stderr, "libipr: in signal handler\n");
-
-      sprintf(nfname,"GMON_OUT_PREFIX=%sgmon-%d",dataDirname,sampleCount);
-      /* OMAR */
-      putenv(nfname);
-
-      // check function pointer to be safe
-      if (write_gmon == NULL)
-          return 0;
-      write_gmon();
-      strcpy(ofname,"gmon.out");
-     // sprintf(nfname,sampleFilename,sampleCount);
-      if (debug)
-         fprintf(stderr, "moving (%s) to (%s)\n",ofname,nfname);
-
-      if (debug) {
-         // record time of sample -- doesn't work in new thread!
-         //clock_gettime(CLOCK_THREAD_CPUTIME_ID, &stime);
-         clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &stime);
-         ftime = stime.tv_sec;
-         ftime += ((double)stime.tv_nsec)/1e9;
-         lf = fopen("ipr.log","a");
-         if (lf) {
-            fprintf(lf,"sample %d at %g ( %s )\n",sampleCount,ftime,ctime(0));
-            fclose(lf);
-         }
+   if (debug)
+      fprintf(stderr, "libipr: in signal handler\n");
+
+   if (doPhases || captureMode == CAPTURE_DELTA || adaptive) {
+      samples = takeHistogramDelta();
+      if (samples >= 0 && adaptive)
+         sampleInterval = adaptInterval(sampleInterval, samples);
+      if (samples >= 0 && doPhases)
+         recordPhase(sampleCount, samples);
+      if (samples >= 0 && captureMode == CAPTURE_DELTA) {
+         writeStart = monotonicNanos();
+         takeArcDelta();
+         writeDeltaRecord(sampleCount);
+         recordLatency(STATS_WRITE, writeStart);
       }
+   }
+   if (asyncWrite) {
+      queueSample(sampleCount);
+   } else if (captureMode == CAPTURE_CONTAINER) {
+      writeStart = monotonicNanos();
+      writeContainerSample(sampleCount);
+      recordLatency(STATS_WRITE, writeStart);
+   }
+   if (asyncWrite || doPhases == 2 || captureMode != CAPTURE_GMON) {
+      // no gmon sample files (or written by the writer thread)
+      sampleDone(sampleCount, start);
       sampleCount++;
-      // redo timer and handler?
-      if (debug)
-      fprintf(stderr, "libipr: done with signal handler\n");
+      return 0;
+   }
+
+   sprintf(nfname,"GMON_OUT_PREFIX=%sgmon-%d",dataDirname,sampleCount);
+   /* OMAR */
+   putenv(nfname);
+
+   // check function pointer to be safe
+   if (write_gmon == NULL)
+       return -1;
+   writeStart = monotonicNanos();
+   write_gmon();
+   recordLatency(STATS_WRITE, writeStart);
+   sprintf(sfname,"%sgmon-%d.%d",dataDirname,sampleCount,getpid());
+   if (stat(sfname, &st) == 0)
+      countBytes(st.st_size);
+   strcpy(ofname,"gmon.out");
+  // sprintf(nfname,sampleFilename,sampleCount);
+   if (debug)
+      fprintf(stderr, "moving (%s) to (%s)\n",ofname,nfname);
+
+   if (debug) {
+      // record time of sample -- doesn't work in new thread!
+      //clock_gettime(CLOCK_THREAD_CPUTIME_ID, &stime);
+      clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &stime);
+      ftime = stime.tv_sec;
+      ftime += ((double)stime.tv_nsec)/1e9;
+      lf = fopen("ipr.log","a");
+      if (lf) {
+         fprintf(lf,"sample %d at %g ( %s )\n",sampleCount,ftime,ctime(0));
+         fclose(lf);
+      }
+   }
+   sampleDone(sampleCount, start);
+   sampleCount++;
+   // redo timer and handler?
+   if (debug)
+   fprintf(stderr, "libipr: done with signal handler\n");
+   return 0;
+}
+
+//
+// Sampler thread: sleep to each interval's deadline, then sample
+// - it can only be cancelled (by libiprShutdown()) while it sleeps,
+//   never in the middle of a sample
+//
+void* libiprSigHandler(void *arg)
+{
+   struct timespec deadline;
+   int err, clockSlot;
+
+   pthread_setcancelstate(PTHREAD_CANCEL_DISABLE, NULL);
+   clockSlot = addLibiprClock();
+   pthread_cleanup_push(retireLibiprClock, &clockSlot);
+   sampleInterval = itv.it_interval.tv_sec*1000000000LL +
+                    itv.it_interval.tv_usec*1000LL;
+   clock_gettime(sampleClock, &deadline);
+   while (1) {
+      // JEC: sleep first, then sample
+      // - sleep until an absolute deadline, so the time taken by
+      //   sampling does not stretch the intervals
+      nextDeadline(&deadline, sampleInterval);
+      pthread_setcancelstate(PTHREAD_CANCEL_ENABLE, NULL);
+      while ((err = clock_nanosleep(sampleClock, TIMER_ABSTIME, &deadline,
+                                    NULL)) == EINTR)
+         ;
+      pthread_setcancelstate(PTHREAD_CANCEL_DISABLE, NULL);
+      if (err != 0 && sampleClock != CLOCK_MONOTONIC) {
+         fprintf(stderr, "libipr: cannot sleep on the %s clock (%s), "
+                 "using wall\n", clockNames[clockIndex], strerror(err));
+         sampleClock = CLOCK_MONOTONIC;
+         clock_gettime(sampleClock, &deadline);
+         continue;
+      }
+      if (takeSample() != 0)
+         break;
       // JEC: moved sleep to top
       //int t = (itv.it_interval.tv_sec*1000000 + itv.it_interval.tv_usec);
       //usleep(t);
    }
+   pthread_cleanup_pop(1);
    return 0;
 }
 
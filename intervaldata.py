@@ -0,0 +1,167 @@
+#---------------------------------------------------------------------
+#
+# Binary interval dataset, an alternative to the libsvm-style text
+# files passed between gensvm.py/gendata.py, findmostused.py,
+# cluster.py and findinstr.py
+#
+# The dataset is one uncompressed NumPy .npz file with these arrays:
+#   labels   int64[n]       label (step number) of each interval
+#   indptr   int64[n+1]     entries of interval i are indptr[i]:indptr[i+1]
+#   indices  int64[nnz]     feature index of each entry, as in the text
+#                           files (function ID*10+1); the call count of
+#                           an entry is in calls, not in an entry of
+#                           its own (only findmostused.py passes on
+#                           ID*10+2 count entries of older text files,
+#                           with the count in calls and time 0)
+#   time     float64[nnz]   time value of each entry
+#   calls    int64[nnz]     call count value of each entry (0 where the
+#                           input has no counts, e.g. thread samples)
+#   names    uint8[]        function names (UTF-8), all concatenated
+#   nameptr  int64[nf+1]    name of function ID f is in
+#                           names[nameptr[f]:nameptr[f+1]]
+#
+# Since the members are not compressed, loadIntervals() memory-maps
+# them rather than reading and parsing the file.
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import struct
+import zipfile
+import numpy
+import numpy.lib.format
+
+#---------------------------------------------------------------------
+# Writer of an interval dataset; intervals are added one at a time,
+# and the file is written by close()
+# - the entries are appended to flat arrays that grow by doubling, so
+#   memory holds only the columns themselves, not objects per interval
+#---------------------------------------------------------------------
+class IntervalWriter(object):
+   #
+   # constructor: filename is the .npz file to write
+   #
+   def __init__(self, filename):
+      self.filename = filename
+      self.labels = numpy.zeros(1024, dtype=numpy.int64)
+      self.indptr = numpy.zeros(1025, dtype=numpy.int64)
+      self.indices = numpy.zeros(1024, dtype=numpy.int64)
+      self.time = numpy.zeros(1024, dtype=numpy.float64)
+      self.calls = numpy.zeros(1024, dtype=numpy.int64)
+      self.n = 0
+      self.nnz = 0
+   #
+   # add one interval; indices, time and calls are sequences of the
+   # same length (one item per entry)
+   #
+   def add(self, label, indices, time, calls):
+      if self.n == len(self.labels):
+         self.labels = grow(self.labels, self.n+1)
+         self.indptr = grow(self.indptr, self.n+2)
+      end = self.nnz + len(indices)
+      if end > len(self.indices):
+         self.indices = grow(self.indices, end)
+         self.time = grow(self.time, end)
+         self.calls = grow(self.calls, end)
+      self.labels[self.n] = label
+      self.indices[self.nnz:end] = indices
+      self.time[self.nnz:end] = time
+      self.calls[self.nnz:end] = calls
+      self.n += 1
+      self.nnz = end
+      self.indptr[self.n] = end
+   #
+   # write the dataset; funcIDMap maps function names to function IDs
+   #
+   def close(self, funcIDMap):
+      names = [b""] * (max(funcIDMap.values())+1 if funcIDMap else 1)
+      for name in funcIDMap:
+         if isinstance(name, bytes):
+            names[funcIDMap[name]] = name
+         else:
+            names[funcIDMap[name]] = name.encode("utf-8")
+      nameptr = numpy.zeros(len(names)+1, dtype=numpy.int64)
+      numpy.cumsum([len(n) for n in names], out=nameptr[1:])
+      outf = open(self.filename, "wb")
+      numpy.savez(outf,
+                  labels=self.labels[:self.n],
+                  indptr=self.indptr[:self.n+1],
+                  indices=self.indices[:self.nnz],
+                  time=self.time[:self.nnz],
+                  calls=self.calls[:self.nnz],
+                  names=numpy.frombuffer(b"".join(names), dtype=numpy.uint8),
+                  nameptr=nameptr)
+      outf.close()
+
+#---------------------------------------------------------------------
+# Return a copy of an array grown to at least size items (at least
+# double its size), with the new items zero
+#---------------------------------------------------------------------
+def grow(array, size):
+   bigger = numpy.zeros(max(size, 2*len(array)), dtype=array.dtype)
+   bigger[:len(array)] = array
+   return bigger
+
+#---------------------------------------------------------------------
+# Check if a file is an interval dataset (rather than a text file)
+#---------------------------------------------------------------------
+def isIntervalFile(filename):
+   return filename.endswith(".npz") and zipfile.is_zipfile(filename)
+
+#---------------------------------------------------------------------
+# Load an interval dataset
+# - returns a dictionary of the arrays described above; they are
+#   read-only memory maps of the file (compressed members, which this
+#   module does not write, are read normally)
+#---------------------------------------------------------------------
+def loadIntervals(filename):
+   arrays = {}
+   zf = zipfile.ZipFile(filename)
+   inf = open(filename, "rb")
+   for info in zf.infolist():
+      name = info.filename[:-4]   # strip ".npy"
+      if info.compress_type != zipfile.ZIP_STORED:
+         arrays[name] = numpy.load(zf.open(info))
+         continue
+      # array data follows the local file header and the .npy header
+      inf.seek(info.header_offset)
+      header = inf.read(30)
+      (nameLen, extraLen) = struct.unpack("<HH", header[26:30])
+      inf.seek(info.header_offset + 30 + nameLen + extraLen)
+      version = numpy.lib.format.read_magic(inf)
+      if version == (1, 0):
+         (shape, fortran, dtype) = numpy.lib.format.read_array_header_1_0(inf)
+      else:
+         (shape, fortran, dtype) = numpy.lib.format.read_array_header_2_0(inf)
+      if numpy.prod(shape) == 0:
+         arrays[name] = numpy.zeros(shape, dtype=dtype)
+         continue
+      arrays[name] = numpy.memmap(filename, dtype=dtype, mode="r",
+                                  offset=inf.tell(), shape=shape,
+                                  order="F" if fortran else "C")
+   inf.close()
+   zf.close()
+   return arrays
+
+#---------------------------------------------------------------------
+# Return the function name table of a dataset, as a dictionary of
+# function ID to function name
+#---------------------------------------------------------------------
+def functionNames(data):
+   names = data["names"].tobytes()
+   nameptr = data["nameptr"]
+   idmap = {}
+   for f in range(1, len(nameptr)-1):
+      name = names[nameptr[f]:nameptr[f+1]]
+      if len(name) > 0:
+         idmap[f] = name.decode("utf-8")
+   return idmap
+
+#---------------------------------------------------------------------
+# Return the entries of interval i as (indices, time, calls) arrays
+#---------------------------------------------------------------------
+def intervalEntries(data, i):
+   start = data["indptr"][i]
+   end = data["indptr"][i+1]
+   return (data["indices"][start:end], data["time"][start:end],
+           data["calls"][start:end])
@@ -0,0 +1,203 @@
+#---------------------------------------------------------------------
+#
+# K-means sweep: run k-means clustering for a range of K values, as
+# cluster.py and MohammedVersion/algorithm2.py do to pick the number
+# of phases
+#
+# The data is converted once (a CSR matrix of float64 with 32-bit
+# indices, what KMeans wants) and shared with the worker processes
+# when they start, rather than being validated and copied for every K.
+# The K values are then clustered concurrently by a process pool. With
+# a warm start, each K is instead started from the centroids of the
+# previous K plus the data point farthest from them, which needs only
+# one k-means run per K but makes the sweep sequential.
+#
+# The exact silhouette score is O(n^2) in the number of intervals, so
+# it can also be approximated (see silhouetteScore()).
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import math
+import multiprocessing
+import numpy
+import scipy.sparse
+import sklearn.cluster
+import sklearn.metrics
+try:
+   import threadpoolctl
+except ImportError:
+   threadpoolctl = None
+
+# data being clustered, set in the main process and in each worker
+sweepData = None
+
+#---------------------------------------------------------------------
+# Convert data to the form KMeans works on, so that it is not
+# converted again for every K
+#---------------------------------------------------------------------
+def prepareData(X):
+   if not scipy.sparse.issparse(X):
+      return numpy.array(X, dtype=numpy.float64, order="C")
+   X = scipy.sparse.csr_matrix(X, dtype=numpy.float64, copy=True)
+   X.sort_indices()
+   if X.nnz < 2**31 and X.indices.dtype != numpy.int32:
+      X.indices = X.indices.astype(numpy.int32)
+      X.indptr = X.indptr.astype(numpy.int32)
+   return X
+
+#---------------------------------------------------------------------
+# Set up a worker process: keep the data, and split the CPUs among
+# the workers so their k-means threads do not oversubscribe them
+#---------------------------------------------------------------------
+def initWorker(X, threads):
+   global sweepData
+   sweepData = X
+   if threadpoolctl is not None:
+      threadpoolctl.threadpool_limits(threads)
+
+#---------------------------------------------------------------------
+# Silhouette values of some data points (rows of X given by points)
+# - a is the mean distance to the other points of the same cluster, b
+#   the lowest mean distance to the points of another cluster; the
+#   value is (b-a)/max(a,b), or 0 in a cluster of one, as sklearn does
+# - distances are computed a block of points at a time, so that only
+#   a block of rows of the distance matrix is in memory
+#---------------------------------------------------------------------
+def pointSilhouettes(X, labels, points):
+   (clusterIds, clusterOf) = numpy.unique(labels, return_inverse=True)
+   sizes = numpy.bincount(clusterOf).astype(numpy.float64)
+   members = scipy.sparse.csr_matrix((numpy.ones(len(labels)),
+                                      (numpy.arange(len(labels)), clusterOf)))
+   block = max(1, 10000000 // X.shape[0])
+   values = numpy.zeros(len(points))
+   for start in range(0, len(points), block):
+      rows = points[start:start+block]
+      dists = sklearn.metrics.pairwise_distances(X[rows], X,
+                                                 metric='euclidean')
+      sums = numpy.asarray(members.T.dot(dists.T).T)
+      own = clusterOf[rows]
+      ownSizes = sizes[own]
+      a = sums[numpy.arange(len(rows)), own] / numpy.maximum(ownSizes-1, 1)
+      sums[numpy.arange(len(rows)), own] = numpy.inf
+      b = numpy.min(sums / sizes, axis=1)
+      denom = numpy.maximum(a, b)
+      s = numpy.where(denom > 0, (b-a) / numpy.where(denom > 0, denom, 1), 0)
+      values[start:start+block] = numpy.where(ownSizes > 1, s, 0)
+   return values
+
+#---------------------------------------------------------------------
+# Silhouette score of a clustering
+# - method is one of
+#   "exact":      the mean silhouette of all points (sklearn)
+#   "sampled":    estimated from a random sample of up to sampleSize
+#                 points per cluster (stratified, so small clusters are
+#                 represented), each against all points; O(n) per point
+#   "simplified": a and b are the distances to the point's own and to
+#                 the nearest other centroid instead of mean distances
+#                 to points; O(n*K), but a different measure
+# - returns (score, error bound): the bound is 0 for "exact", the 95%
+#   confidence half-width of the estimate for "sampled" (the exact
+#   score is within it 19 times out of 20), and None for "simplified"
+#---------------------------------------------------------------------
+def silhouetteScore(X, labels, kmeans, method, sampleSize=300):
+   if len(numpy.unique(labels)) < 2:
+      return (1, 0.0)
+   if method == "exact":
+      return (sklearn.metrics.silhouette_score(X, labels, metric='euclidean'),
+              0.0)
+   if method == "simplified":
+      dists = kmeans.transform(X)
+      rows = numpy.arange(len(labels))
+      a = dists[rows, labels]
+      dists[rows, labels] = numpy.inf
+      b = numpy.min(dists, axis=1)
+      denom = numpy.maximum(a, b)
+      s = numpy.where(denom > 0, (b-a) / numpy.where(denom > 0, denom, 1), 0)
+      return (float(numpy.mean(s)), None)
+   if method != "sampled":
+      raise ValueError("unknown silhouette method: {0}".format(method))
+   random = numpy.random.RandomState(len(labels))
+   n = float(len(labels))
+   score = 0.0
+   variance = 0.0
+   for c in numpy.unique(labels):
+      members = numpy.flatnonzero(labels == c)
+      m = min(sampleSize, len(members))
+      chosen = numpy.sort(random.choice(members, m, replace=False))
+      s = pointSilhouettes(X, labels, chosen)
+      weight = len(members) / n
+      score += weight * numpy.mean(s)
+      if 1 < m < len(members):
+         variance += (weight * weight * numpy.var(s, ddof=1) / m *
+                      (1 - float(m) / len(members)))
+   return (float(score), 1.96 * math.sqrt(variance))
+
+#---------------------------------------------------------------------
+# Run k-means for one K
+# - task is (K, #inits, initial centroids or None, silhouette method
+#   or None, sample size)
+# - returns (fitted KMeans object, predicted labels, silhouette score
+#   or None, silhouette error bound), as from silhouetteScore(); the
+#   silhouette of K=1 is taken as 1
+#---------------------------------------------------------------------
+def fitKMeans(task):
+   (k, nInit, init, silhouette, sampleSize) = task
+   if init is None:
+      kmeans = sklearn.cluster.KMeans(n_clusters=k, n_init=nInit)
+   else:
+      kmeans = sklearn.cluster.KMeans(n_clusters=k, init=init, n_init=1)
+   kmeans.fit(sweepData)
+   labels = kmeans.predict(sweepData)
+   if silhouette is None:
+      return (kmeans, labels, None, None)
+   if k == 1:
+      return (kmeans, labels, 1, 0.0)
+   (score, bound) = silhouetteScore(sweepData, labels, kmeans, silhouette,
+                                    sampleSize)
+   return (kmeans, labels, score, bound)
+
+#---------------------------------------------------------------------
+# Initial centroids for K+1 clusters from a K-cluster result: its
+# centroids plus the data point farthest from its closest centroid
+#---------------------------------------------------------------------
+def warmStartCentroids(kmeans):
+   farthest = numpy.argmax(kmeans.transform(sweepData).min(axis=1))
+   point = sweepData[farthest]
+   if scipy.sparse.issparse(point):
+      point = point.toarray()
+   return numpy.vstack([kmeans.cluster_centers_, point])
+
+#---------------------------------------------------------------------
+# Run k-means for each K in kvalues (in the order given)
+# - nInit is the number of k-means runs per K (best one is kept)
+# - jobs is the number of worker processes (not used with warmStart)
+# - silhouette is the silhouette method (see silhouetteScore()), or
+#   None for no silhouette scores
+# - returns a list of (KMeans, labels, silhouette, silhouette error
+#   bound) as from fitKMeans
+#---------------------------------------------------------------------
+def sweepKMeans(X, kvalues, nInit, jobs=1, warmStart=False, silhouette=None,
+                sampleSize=300):
+   global sweepData
+   sweepData = prepareData(X)
+   kvalues = list(kvalues)
+   if warmStart:
+      results = []
+      prevK = None
+      for k in kvalues:
+         init = None
+         if prevK is not None and prevK == k-1:
+            init = warmStartCentroids(results[-1][0])
+         results.append(fitKMeans((k, nInit, init, silhouette, sampleSize)))
+         prevK = k
+      return results
+   tasks = [(k, nInit, None, silhouette, sampleSize) for k in kvalues]
+   if jobs <= 1 or len(tasks) <= 1:
+      return [fitKMeans(t) for t in tasks]
+   threads = max(1, multiprocessing.cpu_count() // jobs)
+   pool = multiprocessing.Pool(jobs, initWorker, (sweepData, threads))
+   results = pool.map(fitKMeans, tasks, 1)
+   pool.close()
+   pool.join()
+   return results
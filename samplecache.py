@@ -0,0 +1,152 @@
+#---------------------------------------------------------------------
+#
+# Persistent cache of parsed sample data, one SQLite file per data
+# directory
+#
+# Entries are keyed by the content hashes of the executable and of the
+# gmon sample file, plus a "kind" string that says what was stored
+# (e.g., the flat profile tuples of gensvm.py, or a gprof report). A
+# rebuilt executable or a rewritten sample file therefore never hits
+# an old entry. File hashes are remembered by (path, size, mtime), so
+# an unchanged dataset costs only a scan of the cache, not a re-read
+# of every sample file. Samples that are not files of their own (those
+# in a libipr sample container) are keyed by the hash of their data.
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import os
+import sys
+import json
+import zlib
+import sqlite3
+import hashlib
+
+cacheFilename = "gprofcache.db"
+
+#---------------------------------------------------------------------
+# Cache of parsed sample data for one executable in one directory
+#---------------------------------------------------------------------
+class SampleCache(object):
+   #
+   # constructor: open (or create) the cache file in dirname
+   #
+   def __init__(self, dirname, exeFile):
+      if dirname == "":
+         dirname = "."
+      self.filename = os.path.join(dirname, cacheFilename)
+      self.db = sqlite3.connect(self.filename)
+      self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                      "(path TEXT PRIMARY KEY, size INTEGER, "
+                      "mtime REAL, hash TEXT)")
+      self.db.execute("CREATE TABLE IF NOT EXISTS samples "
+                      "(exehash TEXT, hash TEXT, kind TEXT, data BLOB, "
+                      "PRIMARY KEY (exehash, hash, kind))")
+      self.pending = 0
+      self.exeHash = self.fileHash(exeFile)
+   #
+   # content hash of a file; reuses the stored hash if the file's
+   # size and modification time have not changed
+   #
+   def fileHash(self, filename):
+      path = os.path.abspath(filename)
+      st = os.stat(path)
+      row = self.db.execute("SELECT size, mtime, hash FROM files "
+                            "WHERE path = ?", (path,)).fetchone()
+      if row is not None and row[0] == st.st_size and \
+         row[1] == st.st_mtime:
+         return row[2]
+      h = hashlib.sha1()
+      inf = open(path, "rb")
+      while True:
+         block = inf.read(1 << 20)
+         if len(block) == 0:
+            break
+         h.update(block)
+      inf.close()
+      digest = h.hexdigest()
+      self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                      (path, st.st_size, st.st_mtime, digest))
+      self.pending += 1
+      return digest
+   #
+   # check if there is cached data for a sample file
+   #
+   def has(self, filename, kind):
+      return self.lookup(filename, kind, "1") is not None
+   #
+   # return the cached data for a sample file, or None if not cached
+   #
+   def get(self, filename, kind):
+      row = self.lookup(filename, kind, "data")
+      if row is None:
+         return None
+      return json.loads(zlib.decompress(bytes(row[0])).decode("utf-8"))
+   #
+   # check if there is cached data for a sample given by its contents
+   #
+   def hasData(self, sampleData, kind):
+      h = hashlib.sha1(sampleData).hexdigest()
+      return self.lookupHash(h, kind, "1") is not None
+   #
+   # return the cached data for a sample given by its contents (bytes),
+   # or None if not cached
+   #
+   def getData(self, sampleData, kind):
+      row = self.lookupHash(hashlib.sha1(sampleData).hexdigest(), kind, "data")
+      if row is None:
+         return None
+      return json.loads(zlib.decompress(bytes(row[0])).decode("utf-8"))
+   #
+   # find the row of a sample file's entry, selecting the given column
+   #
+   def lookup(self, filename, kind, column):
+      try:
+         h = self.fileHash(filename)
+      except OSError:
+         return None
+      return self.lookupHash(h, kind, column)
+   #
+   # find the row of the entry for a sample hash
+   #
+   def lookupHash(self, h, kind, column):
+      return self.db.execute("SELECT " + column + " FROM samples WHERE "
+                             "exehash = ? AND hash = ? AND kind = ?",
+                             (self.exeHash, h, kind)).fetchone()
+   #
+   # store data (anything JSON can write) for a sample file
+   #
+   def put(self, filename, kind, data):
+      try:
+         h = self.fileHash(filename)
+      except OSError:
+         return False
+      return self.putHash(h, kind, data)
+   #
+   # store data for a sample given by its contents (bytes)
+   #
+   def putData(self, sampleData, kind, data):
+      return self.putHash(hashlib.sha1(sampleData).hexdigest(), kind, data)
+   #
+   # store data under a sample hash
+   #
+   def putHash(self, h, kind, data):
+      blob = zlib.compress(json.dumps(data).encode("utf-8"), 1)
+      self.db.execute("INSERT OR REPLACE INTO samples VALUES (?,?,?,?)",
+                      (self.exeHash, h, kind, sqlite3.Binary(blob)))
+      self.pending += 1
+      if self.pending >= 1000:
+         self.commit()
+      return True
+   #
+   # write out changes
+   #
+   def commit(self):
+      self.db.commit()
+      self.pending = 0
+   #
+   # write out changes and close the cache file
+   #
+   def close(self):
+      self.commit()
+      self.db.close()
@@ -0,0 +1,306 @@
+#---------------------------------------------------------------------
+#
+# Read the per-interval flat profiles of a profiled run, and turn them
+# into the interval steps that gensvm.py and gendata.py write out
+#
+# The samples of a run are either gmon files, one per interval (named
+# "<prefix>-%d.<pid>", with %d running from 0 to #samples-1), which are
+# read by running gprof on them or by decoding them directly (see
+# gmonread.py), or one libipr delta log (IPR_CAPTURE=delta) or sample
+# container (IPR_CAPTURE=container), which hold all samples and are
+# always decoded directly, the container from its memory map. Parsed
+# samples are kept in the parse cache of the sample directory (see
+# samplecache.py), and with jobs > 1 the rest are read by worker
+# processes; either way they come back in sample order.
+#
+# SampleSteps gives the functions stable IDs (gprof's own index numbers
+# change from one report to another) and diffs each sample against the
+# last one that changed, keeping only that sample in memory.
+#
+# Works with both Python 2 and Python 3
+#---------------------------------------------------------------------
+
+import os
+import multiprocessing
+import numpy
+import gmonread
+import samplecache
+import flatprofile
+
+# the profiled executable, and its symbol table if samples are decoded
+# directly; module globals, so that worker processes have them
+progFile = None
+symbolTable = None
+# libipr sample container being read, if any
+container = None
+
+#---------------------------------------------------------------------
+# Set the executable whose samples are read; with native, gmon files
+# are decoded directly instead of running gprof on them, and the
+# symbol table is loaded only once
+#---------------------------------------------------------------------
+def setup(exeFile, native=False):
+   global progFile, symbolTable
+   progFile = exeFile
+   symbolTable = None
+   if native:
+      symbolTable = gmonread.SymbolTable(exeFile)
+
+#---------------------------------------------------------------------
+# Read the flat profile of one sample, either by running gprof on it
+# and parsing the report, or by decoding the gmon file directly
+# - returns a list of (name, fpct, fttime, fstime, fcalls) tuples, in
+#   the order the functions appear in the flat profile
+#---------------------------------------------------------------------
+def readSample(filename):
+   if symbolTable is not None:
+      gmon = gmonread.readGmonFile(filename, symbolTable)
+      if gmon is None:
+         return []
+      return gmonread.flatProfile(gmon, symbolTable)
+   # rerun gprof if the report is missing or older than its inputs; if
+   # the gmon file itself is gone, an existing report is reused as is
+   if not os.path.isfile(filename):
+      if not os.path.isfile(filename+".new"):
+         return []
+   elif not(os.path.isfile(filename+".new")) or \
+      os.path.getmtime(filename+".new") < os.path.getmtime(progFile) or \
+      os.path.getmtime(filename+".new") < os.path.getmtime(filename):
+      os.system("gprof -b {0} {1} > {1}.new".format(progFile,filename))
+   inf = open("{0}.new".format(filename))
+   # only the flat profile is used (see SampleSteps)
+   entries = flatprofile.readFlatProfile(inf)
+   inf.close()
+   return entries
+
+#---------------------------------------------------------------------
+# Read the flat profiles of all samples, in sample order
+# - samples found in the parse cache are not read again, and newly
+#   read ones are added to it
+# - the rest are read by worker processes if jobs > 1; imap gives back
+#   the results in sample order, so function IDs are assigned in the
+#   same order (first seen sample first) as in a serial run
+#---------------------------------------------------------------------
+def readSamples(sampleFiles, jobs, cache):
+   kind = "flat-native" if symbolTable is not None else "flat-gprof"
+   cached = set()
+   todo = []
+   for fname in sampleFiles:
+      if cache is not None and cache.has(fname, kind):
+         cached.add(fname)
+      else:
+         todo.append(fname)
+   if jobs > 1 and len(todo) > 1:
+      pool = multiprocessing.Pool(jobs)
+      results = pool.imap(readSample, todo, 8)
+   else:
+      pool = None
+      results = (readSample(fname) for fname in todo)
+   for fname in sampleFiles:
+      if fname in cached:
+         yield cache.get(fname, kind)
+         continue
+      entries = next(results)
+      if cache is not None:
+         cache.put(fname, kind, entries)
+      yield entries
+   if pool is not None:
+      pool.close()
+      pool.join()
+   if cache is not None:
+      cache.commit()
+
+#---------------------------------------------------------------------
+# Read the flat profiles of all samples in a libipr delta log, in
+# sample order; the log has only what changed in each sample, so it is
+# decoded in order, directly (no gprof, cache or worker processes)
+#---------------------------------------------------------------------
+def readDeltaLogSamples(logFile):
+   for (sample, gmon) in gmonread.readDeltaLog(logFile, symbolTable):
+      yield gmonread.flatProfile(gmon, symbolTable)
+
+#---------------------------------------------------------------------
+# Decode the i'th sample of the sample container
+#---------------------------------------------------------------------
+def readContainerSample(i):
+   gmon = gmonread.decodeGmonData(container.sampleData(i), symbolTable,
+                                  container.filename)
+   if gmon is None:
+      return []
+   return gmonread.flatProfile(gmon, symbolTable)
+
+#---------------------------------------------------------------------
+# Read the flat profiles of the samples in a libipr sample container,
+# in sample order, as readSamples() does for sample files
+# - cached samples are found by the hash of their data
+# - worker processes are forked after the container is mapped, so they
+#   read the samples from the same mapping
+#---------------------------------------------------------------------
+def readContainerSamples(containerFile, jobs, cache):
+   global container
+   container = gmonread.SampleContainer(containerFile)
+   kind = "flat-native"
+   cached = set()
+   todo = []
+   for i in range(len(container)):
+      if cache is not None and cache.hasData(container.sampleData(i), kind):
+         cached.add(i)
+      else:
+         todo.append(i)
+   if jobs > 1 and len(todo) > 1:
+      pool = multiprocessing.Pool(jobs)
+      results = pool.imap(readContainerSample, todo, 8)
+   else:
+      pool = None
+      results = (readContainerSample(i) for i in todo)
+   for i in range(len(container)):
+      if i in cached:
+         yield cache.getData(container.sampleData(i), kind)
+         continue
+      entries = next(results)
+      if cache is not None:
+         cache.putData(container.sampleData(i), kind, entries)
+      yield entries
+   if pool is not None:
+      pool.close()
+      pool.join()
+   if cache is not None:
+      cache.commit()
+   container.close()
+
+#---------------------------------------------------------------------
+# Return the gmon sample file names of a run, in sample order, given
+# the files its glob pattern matched
+#---------------------------------------------------------------------
+def sampleFileNames(listOfFiles):
+   total = len(listOfFiles)
+   proc_num = listOfFiles[total-1].split(".")[1]
+   pref_filename = listOfFiles[total-1].split("-")[0]
+   sampleFiles = []
+   for i in range(total):
+      sampleFiles.append(pref_filename+"-"+str(i)+"."+str(proc_num))
+   return sampleFiles
+
+#---------------------------------------------------------------------
+# Read the flat profiles of all samples of a run, in sample order,
+# given the files its glob pattern matched: gmon files, or one delta
+# log or sample container
+# - the parse cache is used unless useCache is False
+#---------------------------------------------------------------------
+def readRun(listOfFiles, jobs, useCache=True):
+   global symbolTable
+   cache = None
+   if len(listOfFiles) == 1 and (gmonread.isDeltaLog(listOfFiles[0]) or
+                                 gmonread.isSampleContainer(listOfFiles[0])):
+      # all samples are in one libipr file
+      if symbolTable is None:
+         symbolTable = gmonread.SymbolTable(progFile)
+      if gmonread.isDeltaLog(listOfFiles[0]):
+         samples = readDeltaLogSamples(listOfFiles[0])
+      else:
+         if useCache:
+            cache = samplecache.SampleCache(os.path.dirname(listOfFiles[0]),
+                                            progFile)
+         samples = readContainerSamples(listOfFiles[0], jobs, cache)
+   else:
+      sampleFiles = sampleFileNames(listOfFiles)
+      # parsed samples are kept in a cache file next to the sample files
+      if useCache:
+         cache = samplecache.SampleCache(os.path.dirname(sampleFiles[0]),
+                                         progFile)
+      samples = readSamples(sampleFiles, jobs, cache)
+   for entries in samples:
+      yield entries
+   if cache is not None:
+      cache.close()
+
+#---------------------------------------------------------------------
+# Interval steps of a run: samples are added in order, and each is
+# diffed against the last sample that changed
+# - only that sample is kept (prevTime/prevCalls, dense arrays indexed
+#   by function ID, grown as new functions show up), so memory does not
+#   grow with the number of samples
+# - gprof outputs can change the index number of functions from one
+#   file to another, so functions get their own IDs here (funcIDMap),
+#   in the order they are first seen
+#---------------------------------------------------------------------
+class SampleSteps(object):
+   #
+   # constructor
+   #
+   def __init__(self):
+      self.funcIDMap = {}
+      self.nextFunctionID = 1
+      self.prevTime = numpy.zeros(1)
+      self.prevCalls = numpy.zeros(1, dtype=numpy.int64)
+      self.prevFids = numpy.zeros(0, dtype=numpy.int64)
+      self.stepNum = 0
+      self.changedFids = []
+   #
+   # return the step of one sample's flat profile entries: only the
+   # functions present in the sample, as parallel arrays of function
+   # ID, self time and number of calls, sorted by function ID; a
+   # function missing from a sample has zero time/calls
+   #
+   def step(self, entries):
+      fdata = {}
+      for (fname, fpct, fttime, fstime, fcalls) in entries:
+         if not (fname in self.funcIDMap):
+            self.funcIDMap[fname] = self.nextFunctionID
+            self.nextFunctionID += 1
+         fdata[self.funcIDMap[fname]] = (fstime, fcalls)
+      fids = sorted(fdata)
+      return (numpy.array(fids, dtype=numpy.int64),
+              numpy.array([fdata[f][0] for f in fids], dtype=numpy.float64),
+              numpy.array([fdata[f][1] for f in fids], dtype=numpy.int64))
+   #
+   # diff the next step against the last step that changed
+   # - the step is compared over the functions up to its highest
+   #   function ID, with one vector subtraction
+   # - returns (stepNum, fids, times, calls) for the functions whose
+   #   time changed by more than 0.001 (times rounded to 3 places), or
+   #   None if there is no line to output: an empty step, or one that
+   #   did not change after one that did not either; a step that did
+   #   not change after one that did gives zeros for the functions
+   #   that changed in that one
+   # - times are multiplied by scale (the previous step is kept
+   #   unscaled, since it is subtracted from the next one)
+   #
+   def diff(self, step, scale=1.0):
+      (fids, stime, calls) = step
+      if len(fids) == 0:
+         return None
+      n = fids[-1] + 1
+      if n > len(self.prevTime):
+         grow = max(n, 2*len(self.prevTime)) - len(self.prevTime)
+         self.prevTime = numpy.append(self.prevTime, numpy.zeros(grow))
+         self.prevCalls = numpy.append(self.prevCalls,
+                                       numpy.zeros(grow, dtype=numpy.int64))
+      dtime = numpy.zeros(n)
+      dtime[fids] = stime
+      dtime -= self.prevTime[:n]
+      if not dtime.any():
+         if not self.changedFids:
+            return None
+         zeros = [0]*len(self.changedFids)
+         line = (self.stepNum, self.changedFids, zeros, zeros)
+         self.stepNum += 1
+         return line
+      dtime *= scale
+      # added skip if close to zero since getting many 0s on minixyce
+      self.changedFids = [int(f) for f in numpy.nonzero(abs(dtime) > 0.001)[0]]
+      dcalls = numpy.zeros(n, dtype=numpy.int64)
+      dcalls[fids] = calls
+      dcalls -= self.prevCalls[:n]
+      line = (self.stepNum, self.changedFids,
+              [round(float(dtime[f]),3) for f in self.changedFids],
+              [int(dcalls[f]) for f in self.changedFids])
+      # this step becomes the previous step (functions it does not
+      # have go back to zero)
+      self.prevTime[self.prevFids] = 0.0
+      self.prevCalls[self.prevFids] = 0
+      self.prevTime[fids] = stime
+      self.prevCalls[fids] = calls
+      self.prevFids = fids
+      self.stepNum += 1
+      return line